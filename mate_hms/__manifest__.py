@@ -86,6 +86,8 @@
         'wizard/reschedule_appointments_view.xml',
         'wizard/handle_consumed_services.xml',
 
+        'views/mate_excel_import_job_view.xml',
+
         'views/hms_base_views.xml',
         'views/patient_view.xml',
         'views/physician_view.xml',
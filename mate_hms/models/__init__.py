@@ -16,3 +16,4 @@ from . import res_config_settings
 from . import digest
 from . import res_users
 from . import mate_excel_handler_base
+from . import mate_excel_import_job
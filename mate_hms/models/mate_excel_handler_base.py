@@ -1,39 +1,239 @@
-from odoo import models, _
-from odoo.exceptions import ValidationError
+from odoo import models, fields, _
+from odoo.exceptions import UserError, ValidationError
 import base64
 from io import BytesIO
+from itertools import islice
 from openpyxl import load_workbook
 from zoneinfo import ZoneInfo
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Số dòng được kiểm tra và xử lý trong mỗi lô khi import
+IMPORT_CHUNK_SIZE = 1000
+# Số lỗi tối đa hiển thị trong thông báo lỗi (báo cáo đầy đủ vẫn giữ mọi lỗi)
+IMPORT_MAX_DISPLAYED_ERRORS = 20
+
+MATE_EXCEL_IMPORT_JOB = 'mate.excel.import.job'
+IMPORT_MANAGER_GROUP = 'mate_hms_base.group_hms_manager'
+
 
 class MateExcelHandlerBase(models.AbstractModel):
     _name = 'mate.excel.handler.base'
     _description = 'Base Excel handler for uploading and validating'
 
+    # - background_import: Lưu file và import bằng cron theo lô (mate.excel.import.job) thay vì xử lý trong request
+    background_import = fields.Boolean(string='Import in Background',
+                                       help="Process the uploaded file in committed chunks by a scheduled job. "
+                                            "Recommended for files with thousands of lines.")
+
     def _validate_file_name(self, filename):
         if not filename.endswith(('.xls', '.xlsx')):
             raise ValidationError(_("Please upload files in .xls, .xlsx format!"))
 
-    def _get_header_and_data(self, excel_file):
-        file_content = base64.b64decode(excel_file)
-        file_io = BytesIO(file_content)
+    def _open_excel_file(self, excel_file):
+        """
+        Mở workbook ở chế độ chỉ đọc (openpyxl đọc dần từng dòng, không nạp cả sheet)
+
+        :param excel_file: nội dung base64 của trường Binary hoặc file-like object (ví dụ file đính kèm)
+        """
+        file_io = BytesIO(base64.b64decode(excel_file)) if isinstance(excel_file, (bytes, str)) else excel_file
+        return load_workbook(filename=file_io, read_only=True)
+
+    def _iter_excel_rows(self, excel_file, normalize_header=None):
+        """
+        Đọc file excel theo luồng
+
+        Dòng đầu tiên là tiêu đề, các dòng dữ liệu hoàn toàn trống được bỏ qua.
+        :param normalize_header: hàm chuẩn hóa tiêu đề cột (tùy chọn)
+        :return: generator, phần tử đầu là tiêu đề (tuple), sau đó là (row_index, row)
+        """
+        workbook = self._open_excel_file(excel_file)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                raise ValidationError(_("The uploaded excel file has no data."))
+            yield tuple(normalize_header(h) if normalize_header and h else h for h in header)
+            for row_index, row in enumerate(rows, start=2):
+                if any(cell is not None for cell in row):
+                    yield row_index, row
+        finally:
+            workbook.close()
+
+    def _get_column_map(self, header, columns, required=None):
+        """
+        Ánh xạ tiêu đề cột sang vị trí cột
+
+        :param columns: {khóa: tiêu đề cột trong file}
+        :param required: các khóa bắt buộc phải có cột trong file (mặc định tất cả)
+        :return: {khóa: vị trí cột hoặc None nếu file không có cột này}
+        """
+        positions = {name: index for index, name in enumerate(header) if name}
+        column_map = {key: positions.get(name) for key, name in columns.items()}
+        missing = [columns[key] for key in (columns if required is None else required) if column_map[key] is None]
+        if missing:
+            raise ValidationError(_("The uploaded excel file is missing the columns: %s") % ', '.join(missing))
+        return column_map
+
+    def _iter_excel_records(self, excel_file, columns, required=None, normalize_header=None):
+        """
+        Đọc file excel theo luồng thành các dòng dạng dict theo khóa của columns
+
+        :return: generator (row_index, {khóa: giá trị ô})
+        """
+        rows = self._iter_excel_rows(excel_file, normalize_header=normalize_header)
+        column_map = self._get_column_map(next(rows), columns, required=required)
+        for row_index, row in rows:
+            yield row_index, {
+                key: row[index] if index is not None and index < len(row) else None
+                for key, index in column_map.items()
+            }
+
+    def _count_excel_rows(self, excel_file):
+        """Số dòng dữ liệu theo kích thước sheet (ước tính, có thể gồm cả dòng trống)"""
+        workbook = self._open_excel_file(excel_file)
+        try:
+            return max((workbook.active.max_row or 1) - 1, 0)
+        finally:
+            workbook.close()
+
+    def _split_chunks(self, iterable, size=IMPORT_CHUNK_SIZE):
+        """Chia iterable thành các lô có kích thước cố định mà không nạp hết vào bộ nhớ"""
+        iterator = iter(iterable)
+        while chunk := list(islice(iterator, size)):
+            yield chunk
+
+    def _run_import(self, records, validate, process, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Kiểm tra và xử lý các dòng theo lô, gom lỗi từng dòng thay vì dừng ở dòng lỗi đầu tiên
 
-        workbook = load_workbook(filename=file_io, read_only=True)
-        sheet = workbook.active
+        :param records: iterable (row_index, values), thường là _iter_excel_records
+        :param validate: hàm (row_index, values) -> thông báo lỗi hoặc False
+        :param process: hàm nhận danh sách (row_index, values) hợp lệ của một lô
+        :return: {'total': số dòng, 'processed': số dòng hợp lệ, 'errors': [(row_index, thông báo)]}
+        """
+        report = {'total': 0, 'processed': 0, 'errors': []}
+        for chunk in self._split_chunks(records, chunk_size):
+            valid_rows, errors = self._validate_chunk(chunk, validate)
+            report['errors'] += errors
+            if valid_rows:
+                process(valid_rows)
+            report['total'] += len(chunk)
+            report['processed'] += len(valid_rows)
+        return report
 
-        rows = list(sheet.iter_rows(values_only=True))
-        if not rows or len(rows) < 2:
-            raise ValidationError(_("The uploaded excel file has no data."))
-        empty_row = 0
-        for row in rows[1:]:
-            if all(cell is None for cell in row):
-                empty_row += 1
-        if empty_row == len(rows[1:]):
-            return rows[0], None
-        return rows[0], rows[1:]
+    def _validate_chunk(self, chunk, validate):
+        """
+        Tách một lô thành các dòng hợp lệ và các lỗi
+        :return: ([(row_index, values)], [(row_index, thông báo)])
+        """
+        valid_rows, errors = [], []
+        for row_index, values in chunk:
+            error = validate(row_index, values)
+            if error:
+                errors.append((row_index, error))
+            else:
+                valid_rows.append((row_index, values))
+        return valid_rows, errors
+
+    def _format_import_errors(self, errors):
+        """Nội dung thông báo cho danh sách lỗi [(row_index, thông báo)]"""
+        lines = [_("Line %(line)s: %(error)s", line=row_index, error=error)
+                 for row_index, error in errors[:IMPORT_MAX_DISPLAYED_ERRORS]]
+        if len(errors) > IMPORT_MAX_DISPLAYED_ERRORS:
+            lines.append(_("... and %s more errors", len(errors) - IMPORT_MAX_DISPLAYED_ERRORS))
+        return _("The uploaded excel file has %s invalid lines:", len(errors)) + '\n' + '\n'.join(lines)
+
+    def _get_or_create_records(self, model_name, key_field, values_by_key):
+        """
+        Lấy hoặc tạo bản ghi theo khóa cho cả lô dòng import
+
+        Tìm các khóa đã có bằng một truy vấn, các khóa còn thiếu được tạo bằng một lệnh
+        create nhiều bản ghi (compute và constraint chạy một lần cho cả lô).
+        :param values_by_key: {khóa: giá trị tạo mới (không gồm key_field)}
+        :return: {khóa: record}
+        """
+        model = self.env[model_name]
+        if not values_by_key:
+            return {}
+        records = {
+            record[key_field]: record
+            for record in model.search_fetch([(key_field, 'in', list(values_by_key))], [key_field])
+        }
+        missing_keys = [key for key in values_by_key if key not in records]
+        if missing_keys:
+            created = model.create([dict(values_by_key[key], **{key_field: key}) for key in missing_keys])
+            records.update(zip(missing_keys, created))
+        return records
+
+    # ------------------------------------------------------------------
+    # Import nền (mate.excel.import.job)
+    # ------------------------------------------------------------------
+
+    def _get_import_columns(self):
+        """
+        Cột của file cho import nền, mặc định không có cột nào (wizard không hỗ trợ import nền)
+        :return: (columns, required, normalize_header) như tham số của _iter_excel_records
+        """
+        return {}, (), None
+
+    def _validate_import_row(self, row_index, values):
+        """Kiểm tra một dòng trong import nền, trả về thông báo lỗi hoặc False"""
+        return False
+
+    def _prepare_import_job_options(self):
+        """Tham số của wizard cần giữ lại cho import nền (wizard là bản ghi tạm, sẽ bị dọn)"""
+        return {}
+
+    def _import_job_rows(self, job, rows):
+        """
+        Ghi một lô dòng hợp lệ của import nền, chạy trong cùng giao dịch với tiến độ của lô
+        :param rows: [(row_index, values)]
+        :return: các dòng bị từ chối khi ghi [(row_index, thông báo)]
+
+        Mặc định không ghi gì và từ chối mọi dòng, wizard hỗ trợ import nền định nghĩa lại.
+        """
+        return [(row_index, _("This file cannot be imported in the background.")) for row_index, _values in rows]
+
+    def _finalize_import_job(self, job):
+        """Xử lý sau khi import nền đã ghi xong mọi lô"""
+        return True
+
+    def _create_import_job(self, excel_file, excel_file_name):
+        """
+        Lưu file tải lên thành attachment và tạo job import nền
+
+        Job chỉ dành cho quản lý, người tải file lên tạo job bằng sudo (create_uid vẫn là
+        người tải lên, dữ liệu được ghi với quyền của họ).
+        :return: action mở job cho quản lý, thông báo cho người dùng khác
+        """
+        if not self._get_import_columns()[0]:
+            raise UserError(_("This file cannot be imported in the background."))
+        job = self.env[MATE_EXCEL_IMPORT_JOB].sudo().create({
+            'name': excel_file_name,
+            'handler_model': self._name,
+            'import_options': self._prepare_import_job_options(),
+        })
+        job.attachment_id = self.env['ir.attachment'].sudo().create({
+            'name': excel_file_name,
+            'datas': excel_file,
+            'res_model': MATE_EXCEL_IMPORT_JOB,
+            'res_id': job.id,
+        })
+        self.env.ref('mate_hms.ir_cron_process_excel_import_jobs').sudo()._trigger()
+        if self.env.user.has_group(IMPORT_MANAGER_GROUP):
+            return job.get_formview_action()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _("Import queued"),
+                'message': _("%s will be imported in the background.", excel_file_name),
+                'type': 'info',
+                'next': {'type': 'ir.actions.act_window_close'},
+            },
+        }
 
     def _validate_row_not_empty(self, row_index, row):
         if not any(row):
@@ -42,6 +242,10 @@ class MateExcelHandlerBase(models.AbstractModel):
     def _notify_error(self, line, error_type):
         raise ValidationError(_("Data in row %s of column %s is incorrect type or missing") % (line, error_type))
 
+    def _get_field_error(self, error_type):
+        """Thông báo lỗi cho một cột sai kiểu hoặc thiếu dữ liệu (dùng khi gom lỗi từng dòng)"""
+        return _("Data of column %s is incorrect type or missing") % error_type
+
     def _parse_request_time(self, time_str):
         if not time_str:
             return False
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import logging
+import time
+from io import BytesIO, StringIO
+
+from odoo import models, fields, api, _
+
+_logger = logging.getLogger(__name__)
+
+MATE_EXCEL_IMPORT_JOB = 'mate.excel.import.job'
+
+# Thời gian tối đa (giây) một lần chạy cron được xử lý trước khi nhường lại,
+# cron được kích hoạt lại ngay để xử lý tiếp phần còn lại
+IMPORT_JOB_TIME_LIMIT = 120
+
+
+class MateExcelImportJob(models.Model):
+    """
+    Import file excel nền theo lô
+
+    File tải lên được lưu thành attachment, cron đọc file theo luồng và ghi từng lô
+    trong một giao dịch riêng cùng với tiến độ (last_row). Nếu worker bị dừng giữa chừng,
+    lần chạy sau bỏ qua các dòng đã commit và tiếp tục từ lô kế tiếp.
+    Việc đọc và ghi từng dòng do wizard kế thừa mate.excel.handler.base đảm nhận
+    (handler_model), xem các hàm _get_import_columns, _import_job_rows.
+    """
+    _name = MATE_EXCEL_IMPORT_JOB
+    _description = 'Excel Import Job'
+    _order = 'id desc'
+
+    name = fields.Char(string='File Name', required=True)
+    handler_model = fields.Char(string='Handler', required=True)
+    attachment_id = fields.Many2one('ir.attachment', string='Uploaded File', ondelete='restrict')
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='Status', default='queued', required=True, index=True)
+    # - import_options: tham số của wizard (appointment, gói...), import_data: trạng thái tích lũy giữa các lô
+    import_options = fields.Json(string='Options')
+    import_data = fields.Json(string='Import State')
+    # - last_row: số thứ tự dòng cuối cùng đã được commit, dùng để tiếp tục khi chạy lại
+    last_row = fields.Integer(string='Last Committed Row', default=1)
+    total_rows = fields.Integer(string='Total Lines')
+    processed_rows = fields.Integer(string='Imported Lines')
+    error_count = fields.Integer(string='Errors')
+    errors = fields.Json(string='Error List')
+    progress = fields.Float(string='Progress', compute='_compute_progress')
+    error_report = fields.Binary(string='Error Report', attachment=True)
+    error_report_name = fields.Char(string='Error Report Name')
+    summary = fields.Text(string='Summary')
+    date_start = fields.Datetime(string='Started At')
+    date_end = fields.Datetime(string='Finished At')
+
+    @api.depends('state', 'last_row', 'total_rows')
+    def _compute_progress(self):
+        for job in self:
+            if job.state == 'done':
+                job.progress = 100.0
+            elif job.total_rows:
+                job.progress = min(100.0, (job.last_row - 1) * 100.0 / job.total_rows)
+            else:
+                job.progress = 0.0
+
+    def action_retry(self):
+        """Chạy lại job lỗi từ lô chưa commit"""
+        self.filtered(lambda job: job.state == 'failed').write({'state': 'running', 'summary': False})
+        self.env.ref('mate_hms.ir_cron_process_excel_import_jobs')._trigger()
+
+    @api.model
+    def _cron_process_jobs(self, time_limit=IMPORT_JOB_TIME_LIMIT):
+        """Xử lý các job đang chờ, mỗi lô được commit riêng"""
+        deadline = time.monotonic() + time_limit
+        done = 0
+        while time.monotonic() < deadline:
+            self.env.cr.execute(f"""
+                SELECT id FROM {self._table}
+                 WHERE state IN ('queued', 'running')
+                 ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            """)
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            done += 1
+            if not self.browse(row[0])._process(deadline):
+                break
+        remaining = self.search_count([('state', 'in', ('queued', 'running'))])
+        self.env['ir.cron']._notify_progress(done=done, remaining=remaining)
+
+    def _process(self, deadline):
+        """
+        Xử lý job đến khi xong hoặc hết thời gian
+        :return: True nếu job đã kết thúc (xong hoặc lỗi)
+        """
+        self.ensure_one()
+        # Dữ liệu được ghi với quyền của người tải file lên, không chạy thay người dùng đã bị lưu trữ
+        if not self.create_uid.active:
+            self.write({
+                'state': 'failed',
+                'date_end': fields.Datetime.now(),
+                'summary': _("The user who uploaded %s is archived. Reactivate the user, then retry the job.",
+                             self.name),
+            })
+            self.env.cr.commit()
+            return True
+        handler = self.env[self.handler_model].with_user(self.create_uid)
+        if self.state == 'queued':
+            self.write({
+                'state': 'running',
+                'date_start': fields.Datetime.now(),
+                'total_rows': handler._count_excel_rows(BytesIO(self.attachment_id.raw)),
+            })
+            self.env.cr.commit()
+
+        try:
+            columns, required, normalize_header = handler._get_import_columns()
+            records = handler._iter_excel_records(BytesIO(self.attachment_id.raw), columns, required=required,
+                                                  normalize_header=normalize_header)
+            pending = ((row_index, values) for row_index, values in records if row_index > self.last_row)
+            for chunk in handler._split_chunks(pending):
+                with self.env.cr.savepoint():
+                    self._process_chunk(handler, chunk)
+                self.env.cr.commit()
+                if time.monotonic() >= deadline:
+                    return False
+
+            with self.env.cr.savepoint():
+                handler._finalize_import_job(self)
+                self._finish()
+            self.env.cr.commit()
+        except Exception as e:
+            _logger.exception("Excel import job %s failed", self.id)
+            self.env.invalidate_all(flush=False)
+            self.write({
+                'state': 'failed',
+                'date_end': fields.Datetime.now(),
+                'summary': _("Import stopped after line %(line)s: %(error)s", line=self.last_row, error=e),
+            })
+            self.env.cr.commit()
+        return True
+
+    def _process_chunk(self, handler, chunk):
+        """Kiểm tra và ghi một lô, tiến độ được ghi cùng giao dịch với dữ liệu"""
+        valid_rows, errors = handler._validate_chunk(chunk, handler._validate_import_row)
+        if valid_rows:
+            errors += handler._import_job_rows(self, valid_rows) or []
+        self.write({
+            'last_row': chunk[-1][0],
+            'processed_rows': self.processed_rows + len(chunk) - len(errors),
+            'error_count': self.error_count + len(errors),
+            'errors': (self.errors or []) + sorted(errors),
+        })
+
+    def _finish(self):
+        values = {
+            'state': 'done',
+            'date_end': fields.Datetime.now(),
+            'summary': _("%(processed)s lines imported, %(errors)s lines rejected.",
+                         processed=self.processed_rows, errors=self.error_count),
+        }
+        if self.errors:
+            values.update({
+                'error_report': self._build_error_report(),
+                'error_report_name': _("%s - errors.csv", self.name),
+            })
+        self.write(values)
+
+    def _build_error_report(self):
+        """File csv các dòng bị từ chối (base64)"""
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow([_('Line'), _('Error')])
+        writer.writerows(self.errors)
+        return base64.b64encode(output.getvalue().encode('utf-8-sig'))
@@ -7,6 +7,17 @@ from odoo.exceptions import ValidationError
 from datetime import timedelta
 
 MATE_HMS_APPOINTMENT = 'mate_hms.appointment'
+MATE_HMS_CONSUMED_SERVICES_LINE = 'mate_hms.consumed.services.line'
+
+# Cột trong file excel dịch vụ đã sử dụng: {khóa: tiêu đề cột}
+CONSUMED_SERVICE_COLUMNS = {
+    'code': 'Mã',
+    'name': 'Nội dung',
+    'unit_price': 'Đơn giá',
+    'quantity': 'Số lượng',
+    'request_time': 'Thời gian yêu cầu',
+}
+CONSUMED_SERVICE_REQUIRED_COLUMNS = ('code', 'name', 'unit_price', 'quantity')
 
 _logger = logging.getLogger(__name__)
 
@@ -26,7 +37,7 @@ class MateHandleConsumedServices(models.TransientModel):
     excel_file = fields.Binary()
     excel_file_name = fields.Char()
     # - consumed_services_line_ids: Dùng để lưu những services được upload lên từ file excel.
-    consumed_services_line_ids = fields.One2many('mate_hms.consumed.services.line', 'handle_consumed_services_id', string='Consumed Services Line', required=True)
+    consumed_services_line_ids = fields.One2many(MATE_HMS_CONSUMED_SERVICES_LINE, 'handle_consumed_services_id', string='Consumed Services Line', required=True)
     date = fields.Datetime(string='Date', store=True)
     date_to = fields.Datetime(string='Date To', store=True)
 
@@ -45,10 +56,12 @@ class MateHandleConsumedServices(models.TransientModel):
     def onchange_excel_file(self):
         if self.excel_file and load_workbook:
             self._validate_file_name(self.excel_file_name)
-            header, data_rows = self._get_header_and_data(self.excel_file)
-            if not data_rows:
-                raise ValidationError(_("No data found in the uploaded file."))
-            list_data, codes, earliest_time = self._process_excel_rows(header, data_rows)
+            if self.background_import:
+                # File được xử lý bởi job nền khi lưu
+                return
+            records = self._iter_excel_records(self.excel_file, CONSUMED_SERVICE_COLUMNS,
+                                               required=CONSUMED_SERVICE_REQUIRED_COLUMNS)
+            list_data, codes, earliest_time = self._process_excel_rows(records)
 
             # Set appointment date if we found a earliest time
             if earliest_time:
@@ -58,51 +71,55 @@ class MateHandleConsumedServices(models.TransientModel):
             list_data = self._handle_duplicate_code(list_data, codes)
             self.consumed_services_line_ids = [(0, 0, line) for line in list_data]
 
-    def _process_excel_rows(self, header, data_rows):
+    def _process_excel_rows(self, records):
+        """
+        Đọc các dòng dịch vụ theo lô, gom lỗi của mọi dòng rồi báo một lần
+        :param records: generator (row_index, values) từ _iter_excel_records
+        :return: list_data, codes, earliest_time
+        """
         list_data = []
         codes = []
         earliest_time = None
 
-        for row_index, row in enumerate(data_rows, start=2):
-            self._validate_row_not_empty(row_index, row)
-
-            row_data = dict(zip(header, row))
-            code = row_data.get('Mã')
-            product_name = row_data.get('Nội dung')
-            unit_price = row_data.get('Đơn giá')
-            quantity = row_data.get('Số lượng')
-            request_time_str = row_data.get('Thời gian yêu cầu')
+        def process(rows):
+            nonlocal earliest_time
+            for _row_index, values in rows:
+                # Parse datetime if available
+                request_time = self._parse_request_time(values['request_time'])
+                if request_time and (earliest_time is None or request_time < earliest_time):
+                    earliest_time = request_time
 
-            # Parse datetime if available
-            request_time = self._parse_request_time(request_time_str)
+                codes.append(values['code'])
+                list_data.append(self._prepare_consumed_service_line(values))
 
-            if request_time and (earliest_time is None or request_time < earliest_time):
-                earliest_time = request_time
-
-            no_error = self._validate_fields_excel(row_index, [code, product_name, unit_price, quantity])
-
-            if no_error:
-                codes.append(code)
-                list_data.append({
-                    'code': code,
-                    'name': product_name,
-                    'unit_price': unit_price or 0,
-                    'quantity': quantity or 1,
-                    'duplicated': False
-                })
+        report = self._run_import(records, self._validate_fields_excel, process)
+        if report['errors']:
+            raise ValidationError(self._format_import_errors(report['errors']))
+        if not list_data:
+            raise ValidationError(_("No data found in the uploaded file."))
 
         return list_data, codes, earliest_time
 
-    def _validate_fields_excel(self, index, data):
+    def _prepare_consumed_service_line(self, values):
+        return {
+            'code': values['code'],
+            'name': values['name'],
+            'unit_price': values['unit_price'] or 0,
+            'quantity': values['quantity'] or 1,
+            'duplicated': False
+        }
+
+    def _validate_fields_excel(self, index, values):
         """
         Hàm validate các trường dữ liệu trong file excel
-        :param index:
-        :param data:
-        :return:
+        :param index: số thứ tự dòng
+        :param values: {khóa: giá trị} theo CONSUMED_SERVICE_COLUMNS
+        :return: thông báo lỗi hoặc False
         """
         error_type = None
 
-        code, product_name, unit_price, quantity = data
+        code, product_name, unit_price, quantity = (
+            values['code'], values['name'], values['unit_price'], values['quantity'])
 
         if not code or not isinstance(code, (int, str)):
             error_type = _('Code')
@@ -116,10 +133,7 @@ class MateHandleConsumedServices(models.TransientModel):
         elif not quantity or not isinstance(quantity, (int, float)):
             error_type = _('Quantity')
 
-        if error_type:
-            self._notify_error(str(index), error_type)
-
-        return True
+        return self._get_field_error(error_type) if error_type else False
 
     def _check_duplicate_code(self, codes):
         """
@@ -170,50 +184,81 @@ class MateHandleConsumedServices(models.TransientModel):
         if not self.excel_file:
             raise ValidationError(_("Please upload excel file!"))
 
+        if self.background_import:
+            return self._create_import_job(self.excel_file, self.excel_file_name)
+
         if not self.consumed_services_line_ids:
             raise ValidationError(_("There is no consumed services in the uploaded excel file!"))
 
         appointment = self._get_appointment()
-
-        product_model = self.env['product.product']
-        consumable_line_model = self.env['mate_hms.consumable.line']
         total_price = appointment.amount_total or 0
-
-        # Lấy danh sách code trong consumed_services_line_ids
-        codes = [item.code for item in self.consumed_services_line_ids]
-
-        # Tìm sản phẩm trong database theo danh sách code
-        products = product_model.search([('default_code', 'in', codes)])
-
-        # Tạo 1 dictionary dạng {code: product}
-        product_dict = {prod.default_code: prod for prod in products}
-
-        for item in self.consumed_services_line_ids:
-            # Xem sản phẩm đã tồn tại trong dictionary chưa
-            product = product_dict.get(item.code)
-
-            # Nếu không tồn tại, thì tạo sản phẩm mới
-            if not product:
-
-                product = product_model.create({
-                    'name': item.name,
-                    'default_code': item.code,
-                    'standard_price': item.unit_price,
-                    'list_price': item.unit_price,
-                    'type': 'service',
-                })
-                # Thêm vào dictionary để tái sử dụng sau này
-                product_dict[item.code] = product
-
-            # Tính tổng giá của tất cả dịch vụ mà bệnh nhân sử dụng
-            total_price += item.unit_price * item.quantity
-
-            # Tạo consumable services và gắn vào appointment hiện tại
-            consumable_line_model.create(self._generate_consumable_line(appointment, product, item))
+        total_price += self._create_consumed_services(appointment, self.consumed_services_line_ids)
         appointment.write({'amount_total': total_price})
 
         return appointment
 
+    def _create_consumed_services(self, appointment, items):
+        """
+        Tạo consumable line cho các dịch vụ đã sử dụng, tạo sản phẩm nếu chưa có
+        :param items: các dòng có code, name, unit_price, quantity (mate_hms.consumed.services.line)
+        :return: tổng tiền của các dòng
+        """
+        # Sản phẩm chưa có được tạo một lần cho cả lô theo giá trị của dòng đầu tiên có mã đó
+        product_values = {}
+        for item in items:
+            product_values.setdefault(item.code, {
+                'name': item.name,
+                'standard_price': item.unit_price,
+                'list_price': item.unit_price,
+                'type': 'service',
+            })
+        product_dict = self._get_or_create_records('product.product', 'default_code', product_values)
+
+        # Tạo consumable services và gắn vào appointment hiện tại
+        self.env['mate_hms.consumable.line'].create([
+            self._generate_consumable_line(appointment, product_dict[item.code], item) for item in items
+        ])
+
+        # Tính tổng giá của tất cả dịch vụ mà bệnh nhân sử dụng
+        total_price = sum(item.unit_price * item.quantity for item in items)
+        return total_price
+
+    # ------------------------------------------------------------------
+    # Import nền
+    # ------------------------------------------------------------------
+
+    def _get_import_columns(self):
+        return CONSUMED_SERVICE_COLUMNS, CONSUMED_SERVICE_REQUIRED_COLUMNS, None
+
+    def _validate_import_row(self, row_index, values):
+        return self._validate_fields_excel(row_index, values)
+
+    def _prepare_import_job_options(self):
+        options = super()._prepare_import_job_options()
+        options['appointment_id'] = self._get_appointment().id
+        return options
+
+    def _import_job_rows(self, job, rows):
+        """Ghi một lô dịch vụ vào appointment, cộng dồn tổng tiền và thời gian yêu cầu sớm nhất"""
+        appointment = self.env[MATE_HMS_APPOINTMENT].browse(job.import_options['appointment_id'])
+        line_model = self.env[MATE_HMS_CONSUMED_SERVICES_LINE]
+        items = line_model.concat(*(
+            line_model.new(self._prepare_consumed_service_line(values)) for _row_index, values in rows
+        ))
+        total_price = self._create_consumed_services(appointment, items)
+        appointment.write({'amount_total': (appointment.amount_total or 0) + total_price})
+
+        request_times = [self._parse_request_time(values['request_time']) for _row_index, values in rows]
+        request_times = [request_time for request_time in request_times if request_time]
+        if request_times:
+            import_data = dict(job.import_data or {})
+            earliest_time = min(request_times)
+            if import_data.get('earliest_time'):
+                earliest_time = min(earliest_time, fields.Datetime.to_datetime(import_data['earliest_time']))
+            import_data['earliest_time'] = fields.Datetime.to_string(earliest_time)
+            job.import_data = import_data
+        return []
+
     def download_template_file(self):
         """Download the template file"""
         return {
@@ -1,4 +1,5 @@
 from odoo import models, fields, api, _
+from collections import defaultdict
 import logging
 from odoo.exceptions import ValidationError
 import re
@@ -8,6 +9,7 @@ _logger = logging.getLogger(__name__)
 RES_CONFIG_SETTINGS = 'res.config.settings'
 MATE_HMS_APPOINTMENT = 'mate_hms.appointment'
 MATE_HMS_SUBSCRIPTIONS = 'mate_hms.subscriptions'
+MATE_HMS_SUBSCRIPTION_LINE = 'mate_hms.subscription.line'
 MATE_HMS_CONSUMABLE_LINE = 'mate_hms.consumable.line'
 MATE_HMS_APPOINTMENT_PACKAGE_USAGE = 'mate_hms.appointment.package.usage'
 IR_CONFIG_PARAMETER = 'ir.config_parameter'
@@ -111,21 +113,30 @@ class MateAppointment(models.Model):
         list_new_consumable = []
         list_new_package_usage = []
 
-        for consumable in self.consumable_line_ids:
-            subscription_line = self.get_subscription_line(consumable.subscription_id, consumable.product_id.id)
+        # Dòng đăng ký được tra theo (đăng ký, sản phẩm) qua chỉ mục dựng một lần,
+        # số lượng còn lại được trừ dần trong bộ nhớ và ghi một lần ở cuối
+        consumables = self.consumable_line_ids
+        subscription_line_index = consumables.subscription_id._get_subscription_line_index()
+        remaining_qty = {}
+        group_types = defaultdict(lambda: self.env[MATE_HMS_CONSUMABLE_LINE])
+        consumables_to_unlink = self.env[MATE_HMS_CONSUMABLE_LINE]
+
+        for consumable in consumables:
+            subscription_line = subscription_line_index.get((consumable.subscription_id.id, consumable.product_id.id))
             if not subscription_line:
-                consumable.package_group_type = 'out_package'
+                group_types['out_package'] |= consumable
                 continue
 
-            if subscription_line.remaining_qty == 0:
-                consumable.package_group_type = 'over_package'
+            line_remaining_qty = remaining_qty.get(subscription_line, subscription_line.remaining_qty)
+            if line_remaining_qty == 0:
+                group_types['over_package'] |= consumable
                 continue
 
-            qty_diff = subscription_line.remaining_qty - consumable.qty
+            qty_diff = line_remaining_qty - consumable.qty
 
             if qty_diff >= 0:
-                subscription_line.remaining_qty = qty_diff
-                consumable.package_group_type = 'in_package'
+                remaining_qty[subscription_line] = qty_diff
+                group_types['in_package'] |= consumable
                 list_new_package_usage.append({
                     'appointment_id': self.id,
                     'subscription_line_id': subscription_line.id,
@@ -135,7 +146,7 @@ class MateAppointment(models.Model):
                     'remaining_qty': qty_diff,
                 })
             else:
-                used_qty = subscription_line.remaining_qty
+                used_qty = line_remaining_qty
                 remaining_usage = abs(qty_diff)
                 list_new_consumable.extend([
                     self._prepare_consumable_dict(subscription_line, consumable, used_qty, False, True, group_type='in_package'),
@@ -149,8 +160,13 @@ class MateAppointment(models.Model):
                     'qty': subscription_line.qty,
                     'remaining_qty': 0,
                 })
-                consumable.unlink()
-                subscription_line.remaining_qty = 0
+                consumables_to_unlink |= consumable
+                remaining_qty[subscription_line] = 0
+
+        for group_type, group_consumables in group_types.items():
+            group_consumables.write({'package_group_type': group_type})
+        self._write_subscription_remaining_qty(remaining_qty)
+        consumables_to_unlink.unlink()
 
         if list_new_consumable:
             self.env[MATE_HMS_CONSUMABLE_LINE].create(list_new_consumable)
@@ -159,6 +175,18 @@ class MateAppointment(models.Model):
         self.update_amount_total()
         return True
 
+    def _write_subscription_remaining_qty(self, remaining_qty):
+        """
+        Ghi số lượng còn lại của các dòng đăng ký, mỗi giá trị một lệnh ghi
+        :param remaining_qty: {dòng đăng ký: số lượng còn lại}
+        """
+        lines_by_qty = defaultdict(lambda: self.env[MATE_HMS_SUBSCRIPTION_LINE])
+        for line, qty in remaining_qty.items():
+            if line.remaining_qty != qty:
+                lines_by_qty[qty] |= line
+        for qty, lines in lines_by_qty.items():
+            lines.write({'remaining_qty': qty})
+
     @api.model
     def action_create_appointment_import_services_excel(self):
         action = self.env.ref('mate_hms.action_mate_hms_handle_consumed_services').read()[0]
@@ -183,18 +211,6 @@ class MateAppointment(models.Model):
             'package_group_type': group_type if sub_line_id else 'out_package',
         }
 
-    def get_subscription_line(self, subscription, product_id):
-        """
-        Lấy dòng đăng ký tương ứng với sản phẩm và đăng ký.
-        :param subscription: Đối tượng đăng ký.
-        :param product_id: ID của sản phẩm.
-        :return: Dòng đăng ký tương ứng hoặc None nếu không tìm thấy.
-        """
-        for line in subscription.package_ids:
-            if line.product_id.id == product_id:
-                return line
-        return None
-
     def get_appointment_product_data(self):
         setting = self.env[RES_CONFIG_SETTINGS].sudo().search([('company_id', '=', self.env.company.id)], limit=1)
         return self.acs_appointment_inv_product_data(with_product=setting.service_generation_option == 'invoice')
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from odoo import api, fields, models, _
+from collections import defaultdict
 import secrets
 import string
 import logging
 from datetime import datetime
-from odoo.exceptions import UserError, ValidationError
+from odoo.exceptions import UserError
 
 _logger = logging.getLogger(__name__)
 
@@ -29,6 +30,8 @@ class MateSubscriptions(models.Model):
         package_id (fields.Many2one): Trường liên kết đến gói dịch vụ, bắt buộc phải có.
         start_date (fields.Datetime): Ngày bắt đầu của đăng ký, bắt buộc phải có.
         end_date (fields.Datetime): Ngày kết thúc của đăng ký, bắt buộc phải có.
+        history_count, total_used, remaining_qty: Tổng hợp sử dụng của các dòng đăng ký, được lưu và
+            cập nhật khi lịch sử sử dụng thay đổi để danh sách / xuất dữ liệu không phải đếm lại.
         _sql_constraints (list): Ràng buộc SQL để đảm bảo mỗi bệnh nhân chỉ có một bản ghi cho mỗi gói dịch vụ.
     """
     _name = "mate_hms.subscriptions"
@@ -46,7 +49,9 @@ class MateSubscriptions(models.Model):
     package_id = fields.Many2one(MATE_HMS_PACKAGE, string='Package', required=True, domain="[('end_date', '>=', context_today())]")
     start_date = fields.Date("Start Date", required=True)
     end_date = fields.Date("End Date", required=True)
-    history_count = fields.Integer(string='History Count', compute='_compute_history_count', store=True)
+    history_count = fields.Integer(string='History Count', compute='_compute_usage_stats', store=True)
+    total_used = fields.Float(string='Total Used', compute='_compute_usage_stats', store=True)
+    remaining_qty = fields.Float(string='Remaining Quantity', compute='_compute_usage_stats', store=True)
     package_ids = fields.One2many(MATE_HMS_SUBSCRIPTIONS_LINE, 'subscription_id', string='Patient Packages')
     subscriptions_line_ids = fields.One2many(MATE_HMS_SUBSCRIPTIONS_LINE, 'subscription_id', string='Subscription Lines')
     subscriptions_usage_history_ids = fields.One2many(MATE_HMS_SUBSCRIPTIONS_UPDATE_HISTORY, 'subscription_id', string='Update History')
@@ -54,6 +59,13 @@ class MateSubscriptions(models.Model):
 
     _sql_constraints = [
         ('subscription_date', "CHECK (start_date <= end_date)", "The start date must be anterior to the end date."),
+        # Một bệnh nhân không có hai đăng ký đang hoạt động cùng gói với khoảng thời gian giao nhau.
+        # Khoảng số nguyên một phần tử thay cho so sánh bằng để dùng GiST mà không cần extension btree_gist.
+        ('unique_patient_package',
+         "EXCLUDE USING gist (int4range(patient_id, patient_id, '[]') WITH =, "
+         "int4range(package_id, package_id, '[]') WITH =, "
+         "daterange(start_date, end_date, '[]') WITH &&) WHERE (active)",
+         "Each patient can only register once for each package."),
     ]
 
     def _check_validate(self):
@@ -67,28 +79,16 @@ class MateSubscriptions(models.Model):
             return True
         return False
 
-    @api.constrains('patient_id', 'package_id')
-    def _check_unique_patient_package(self):
-        for record in self:
-            duplicate = self.search([
-                ('id', '!=', record.id),
-                ('patient_id', '=', record.patient_id.id),
-                ('package_id', '=', record.package_id.id),
-                ('start_date', '<=', record.end_date),
-                ('end_date', '>=', record.start_date)
-            ], limit=1)
-            if duplicate:
-                raise ValidationError(_("Each patient can only register once for each package."))
-
-    @api.depends('package_ids.appointment_usage_ids')
-    def _compute_history_count(self):
+    @api.depends('package_ids.history_count', 'package_ids.total_used', 'package_ids.remaining_qty')
+    def _compute_usage_stats(self):
         """
-        Tính toán số lượng lịch sử sử dụng gói dịch vụ của bệnh nhân.
+        Tổng hợp lịch sử sử dụng gói dịch vụ của bệnh nhân từ các dòng đăng ký.
         """
         for record in self:
-            record.history_count = self.env[MATE_HMS_PACKAGE_USAGE].search_count([
-                ('subscription_line_id.subscription_id', '=', record.id)
-            ])
+            lines = record.package_ids
+            record.history_count = sum(lines.mapped('history_count'))
+            record.total_used = sum(lines.mapped('total_used'))
+            record.remaining_qty = sum(lines.mapped('remaining_qty'))
 
     @api.model
     def create(self, vals):
@@ -113,6 +113,22 @@ class MateSubscriptions(models.Model):
         ])
         return subcriptions
 
+    def _get_subscription_line_index(self):
+        """
+        Chỉ mục dòng đăng ký theo sản phẩm của các đăng ký, đọc bằng một truy vấn.
+        Nếu một sản phẩm có nhiều dòng trong cùng đăng ký thì lấy dòng đầu tiên (như package_ids).
+        :return: {(subscription_id, product_id): dòng đăng ký}
+        """
+        lines = self.env[MATE_HMS_SUBSCRIPTIONS_LINE].search_fetch(
+            [('subscription_id', 'in', self.ids)],
+            ['subscription_id', 'product_id', 'package_id', 'name', 'qty', 'remaining_qty'],
+            order='id',
+        )
+        index = {}
+        for line in lines:
+            index.setdefault((line.subscription_id.id, line.product_id.id), line)
+        return index
+
     def action_view_package_lines(self):
         self.ensure_one()
         return {
@@ -173,6 +189,8 @@ class MateSubscriptionLine(models.Model):
         qty (Float): Số lượng còn lại của gói dịch vụ y tế. Bắt buộc phải có.
         usage (Float): Số lượng đã sử dụng, được tính toán từ số lượng còn lại.
         remaining_qty (Float): Số lượng còn lại của gói dịch vụ y tế. Mặc định là 0.0.
+        history_count (Integer): Số lần sử dụng (appointment_usage_ids), được lưu.
+        total_used (Float): Tổng số lượng đã dùng theo lịch sử sử dụng, được lưu.
     """
     _name = MATE_HMS_SUBSCRIPTIONS_LINE
     _description = 'Patient Package Line (Usage tracking)'
@@ -190,9 +208,12 @@ class MateSubscriptionLine(models.Model):
     name = fields.Char(related='package_id.name', store=True, readonly=True)
 
     qty = fields.Float(string='In Package Quantity', required=True)
-    usage = fields.Float(string='Used Quantity', default=0.0, compute='_compute_usage_qty')
+    usage = fields.Float(string='Used Quantity', default=0.0, compute='_compute_usage_qty', store=True)
     remaining_qty = fields.Float(string='Remaining Quantity', default=0.0)
+    history_count = fields.Integer(string='History Count', compute='_compute_usage_stats', store=True)
+    total_used = fields.Float(string='Total Used', compute='_compute_usage_stats', store=True)
 
+    @api.depends('qty', 'remaining_qty')
     def _compute_usage_qty(self):
         """
         Tính toán số lượng đã sử dụng dựa trên số lượng còn lại.
@@ -200,6 +221,22 @@ class MateSubscriptionLine(models.Model):
         for record in self:
             record.usage = record.qty - record.remaining_qty
 
+    @api.depends('appointment_usage_ids.usage')
+    def _compute_usage_stats(self):
+        """
+        Số lần và tổng số lượng sử dụng của các dòng, một truy vấn gom nhóm cho cả lô
+        (được tính lại khi lịch sử sử dụng được tạo, sửa hoặc xóa).
+        """
+        stats = {
+            line.id: (count, usage)
+            for line, count, usage in self.env[MATE_HMS_PACKAGE_USAGE]._read_group(
+                [('subscription_line_id', 'in', self._origin.ids)],
+                ['subscription_line_id'], ['__count', 'usage:sum'],
+            )
+        }
+        for record in self:
+            record.history_count, record.total_used = stats.get(record._origin.id, (0, 0.0))
+
     def action_package_history(self):
         """
         Mở cửa sổ hiển thị lịch sử sử dụng gói dịch vụ y tế của bệnh nhân.
@@ -303,35 +340,45 @@ class MateSubscriptionUpdateHistory(models.Model):
     def calulate_subscription(self):
         """
         Tính toán số lượng đăng ký dựa trên các dòng lịch sử cập nhật đăng ký.
+        Dòng đăng ký và dòng gói mới được tra theo sản phẩm qua chỉ mục dựng một lần cho mỗi bản ghi,
+        các dòng mới được tạo và các dòng bỏ đi được xóa theo lô.
         """
+        subscription_line_model = self.env[MATE_HMS_SUBSCRIPTIONS_LINE]
+        new_line_vals = []
+        lines_to_unlink = subscription_line_model
         for rec in self:
+            subscription_lines = defaultdict(lambda: subscription_line_model)
+            for line in rec.subscription_id.subscriptions_line_ids:
+                subscription_lines[line.product_id.id] |= line
+            package_lines = defaultdict(lambda: self.env['mate_hms.package.line'])
+            for line in rec.to_package_id.order_line:
+                package_lines[line.product_id.id] |= line
+
             for rec_line in rec.subscription_update_history_line_ids:
-                subscription_line = rec.subscription_id.subscriptions_line_ids.filtered(
-                    lambda x, rec_line=rec_line: x.product_id.id == rec_line.product_id.id
-                )
+                subscription_line = subscription_lines[rec_line.product_id.id]
                 if not subscription_line:
-                    package_line = self.to_package_id.order_line.filtered(
-                        lambda x, rec_line=rec_line: x.product_id.id == rec_line.product_id.id
-                    )
-                    self.env[MATE_HMS_SUBSCRIPTIONS_LINE].create({
+                    new_line_vals.append({
                         'subscription_id': rec.subscription_id.id,
                         'package_id': rec.to_package_id.id,
-                        'package_line_id': package_line.id,
+                        'package_line_id': package_lines[rec_line.product_id.id].id,
                         'patient_id': rec.subscription_id.patient_id.id,
                         'qty': rec_line.new_package,
                         'remaining_qty': rec_line.new_package,
-                        'usage': 0,
                     })
                     continue
                 if rec_line.new_package == 0:
-                    subscription_line.unlink()
+                    lines_to_unlink |= subscription_line
                     continue
                 if rec_line.new_package == subscription_line.qty:
                     continue
                 if subscription_line.qty != rec_line.new_package:
-                    subscription_line.qty = rec_line.new_package
-                    subscription_line.remaining_qty = rec_line.new_package - rec_line.new_package_used
+                    subscription_line.write({
+                        'qty': rec_line.new_package,
+                        'remaining_qty': rec_line.new_package - rec_line.new_package_used,
+                    })
             rec.subscription_id.package_id = rec.to_package_id.id
+        lines_to_unlink.unlink()
+        subscription_line_model.create(new_line_vals)
         return True
 
 
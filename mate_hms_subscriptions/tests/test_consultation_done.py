@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+from odoo.tests.common import warmup
+
+
+@tagged('post_install', '-at_install')
+class TestConsultationDone(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.patient = cls.env['mate_hms.patient'].create({
+            'name': 'Package Patient',
+            'hospital_number': '812345678',
+        })
+        cls.consultation = cls.env['product.product'].create({'name': 'Consultation', 'type': 'service'})
+        cls.out_of_package = cls.env['product.product'].create({'name': 'Out of Package', 'type': 'consu'})
+
+    def _create_appointment(self, line_count):
+        """Lịch khám có line_count dịch vụ trong gói và một dịch vụ ngoài gói, vật tư đã được xuất kho"""
+        products = self.env['product.product'].create([
+            {'name': f'Package Service {line_count}-{index}', 'type': 'consu'} for index in range(line_count)
+        ])
+        package = self.env['mate_hms.package'].create({
+            'name': f'Query Count Package {line_count}',
+            'order_line': [(0, 0, {'name': product.name, 'product_id': product.id, 'product_uom_qty': 5})
+                           for product in products],
+        })
+        today = fields.Date.today()
+        subscription = self.env['mate_hms.subscriptions'].create({
+            'patient_id': self.patient.id,
+            'package_id': package.id,
+            'start_date': today,
+            'end_date': today + timedelta(days=30),
+        })
+        appointment = self.env['mate_hms.appointment'].create({
+            'patient_id': self.patient.id,
+            'product_id': self.consultation.id,
+            'invoice_exempt': True,
+            'consumable_line_ids': [(0, 0, {
+                'product_id': product.id,
+                'qty': 1,
+                'patient_id': self.patient.id,
+                'subscription_id': subscription.id,
+            }) for product in products] + [(0, 0, {
+                'product_id': self.out_of_package.id,
+                'qty': 1,
+                'patient_id': self.patient.id,
+            })],
+        })
+        # Xuất kho trước để phần dùng chung của mate_hms không tạo dịch chuyển kho theo từng dòng
+        appointment.consume_appointment_material()
+        self.env.flush_all()
+        self.env.invalidate_all()
+        return appointment, subscription
+
+    @warmup
+    def test_consultation_done_query_count_is_flat(self):
+        """Số truy vấn khi hoàn tất lịch khám không tăng theo số dịch vụ trong gói"""
+        small_appointment, _subscription = self._create_appointment(2)
+        queries = self.cr.sql_log_count
+        small_appointment.consultation_done()
+        self.env.flush_all()
+        small_count = self.cr.sql_log_count - queries
+
+        appointment, subscription = self._create_appointment(10)
+        with self.assertQueryCount(small_count):
+            appointment.consultation_done()
+
+        self.assertEqual(set(subscription.package_ids.mapped('remaining_qty')), {4})
+        self.assertEqual(len(appointment.package_usage_ids), 10)
+        self.assertEqual(appointment.consumable_line_ids.filtered(
+            lambda line: line.product_id == self.out_of_package).package_group_type, 'out_package')
@@ -1,4 +1,5 @@
 from odoo import models, fields, api
+from datetime import timedelta
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -42,22 +43,14 @@ class MateHandleConsumedServices(models.TransientModel):
         return appointment
 
     def save_services_appointments(self):
+        if self.background_import:
+            return super(MateHandleConsumedServices, self).save_services_appointments()
         appointment = super(MateHandleConsumedServices, self).save_services_appointments()
-        appointment.visit_number = self.visit_number
-        appointment.attachment_id = self.env['ir.attachment'].create({
+        self._link_uploaded_services(appointment, self.package_id, self.patient_id, self.visit_number, {
             'name': self.excel_file_name,
             'datas': self.excel_file,
-            'res_model': MATE_HMS_APPOINTMENT,
         })
         if self.package_id:
-            subscription = self.env['mate_hms.subscriptions'].search([
-                ('patient_id', '=', self.patient_id.id),
-                ('package_id', '=', self.package_id.id),
-            ], limit=1)
-            for consumable in appointment.consumable_line_ids:
-                if consumable.product_id.id in self.package_id.order_line.product_id.ids:
-                    consumable.subscription_id = subscription.id
-            appointment.consultation_done()
             return {
                 'type': 'ir.actions.act_window',
                 'res_model': MATE_HMS_APPOINTMENT,
@@ -66,3 +59,44 @@ class MateHandleConsumedServices(models.TransientModel):
                 'target': 'current',
             }
         return appointment
+
+    def _link_uploaded_services(self, appointment, package, patient, visit_number, attachment_vals):
+        """
+        Gắn số lượt khám, file tải lên và gói đăng ký của bệnh nhân vào appointment
+        :param attachment_vals: giá trị tạo ir.attachment của file tải lên
+        """
+        appointment.visit_number = visit_number
+        appointment.attachment_id = self.env['ir.attachment'].create(dict(attachment_vals, res_model=MATE_HMS_APPOINTMENT))
+        if package:
+            subscription = self.env['mate_hms.subscriptions'].search([
+                ('patient_id', '=', patient.id),
+                ('package_id', '=', package.id),
+            ], limit=1)
+            for consumable in appointment.consumable_line_ids:
+                if consumable.product_id.id in package.order_line.product_id.ids:
+                    consumable.subscription_id = subscription.id
+            appointment.consultation_done()
+
+    def _prepare_import_job_options(self):
+        options = super(MateHandleConsumedServices, self)._prepare_import_job_options()
+        options.update({
+            'patient_id': self.patient_id.id,
+            'package_id': self.package_id.id,
+            'visit_number': self.visit_number,
+        })
+        return options
+
+    def _finalize_import_job(self, job):
+        res = super(MateHandleConsumedServices, self)._finalize_import_job(job)
+        options = job.import_options
+        appointment = self.env[MATE_HMS_APPOINTMENT].browse(options['appointment_id'])
+        package = self.env['mate_hms.package'].browse(options.get('package_id'))
+        earliest_time = (job.import_data or {}).get('earliest_time')
+        if package and earliest_time:
+            # Ngày của appointment mới lấy theo thời gian yêu cầu sớm nhất trong file
+            date = fields.Datetime.to_datetime(earliest_time)
+            appointment.write({'date': date, 'date_to': date + timedelta(minutes=15)})
+        self._link_uploaded_services(
+            appointment, package, self.env['mate_hms.patient'].browse(options.get('patient_id')),
+            options.get('visit_number'), {'name': job.name, 'raw': job.attachment_id.raw})
+        return res
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from odoo import models, api, fields, _
+from datetime import datetime
 import logging
 import re
 from odoo.exceptions import ValidationError
@@ -12,6 +13,19 @@ MATE_HMS_HANDLE_PACKAGE_LINE = 'mate_hms.handle.package.line'
 MATE_HMS_SUBSCRIPTION_CATEGORY = 'mate_hms.subscription.category'
 MATE_HSM_PACKAGE_LINE = 'mate_hms.package.line'
 
+# Cột trong file excel gói dịch vụ (tiêu đề đã chuẩn hóa): {khóa: tiêu đề cột}
+PACKAGE_COLUMNS = {
+    'code': 'Mã dịch vụ',
+    'name': 'Tên dịch vụ',
+    'quantity': 'Số lượng',
+    'package_name': 'Tên gói',
+    'start_date': 'Ngày bắt đầu có hiệu lực',
+    'end_date': 'Ngày hết hiệu lực',
+    'category': 'Loại gói',
+    'package_code': 'Mã gói',
+}
+PACKAGE_REQUIRED_COLUMNS = ('code', 'package_code')
+
 _logger = logging.getLogger(__name__)
 
 try:
@@ -48,138 +62,125 @@ class MateHandleUploadPackage(models.TransientModel):
     def onchange_excel_file(self):
         if self.excel_file and load_workbook:
             self._validate_file_name(self.excel_file_name)
-            header, data_rows = self._get_header_and_data(self.excel_file)
-            if not data_rows:
-                raise ValidationError(_("No data found in the uploaded file."))
-            header = tuple(re.sub(r"\(\*\)\s*\n", "", h).strip().replace('\n(yyyy-mm-dd)', '') for h in header)
-            try:
-                data_rows = sorted(data_rows, key=lambda x: x[0])
-                # Gọi hàm kiểm tra tồn tại
-                self._check_existing_package_codes(header, data_rows)
-                list_package_line = self._process_excel_rows(header, data_rows)
-                self.package_line_ids = [(0, 0, line) for line in list_package_line]
-            except Exception:
-                raise ValidationError(_("An error occurred while processing the Excel file. Please check the file format and data."))
-
-    def _check_existing_package_codes(self, header, data_rows):
+            if self.background_import:
+                # File được xử lý bởi job nền khi lưu
+                return
+            list_package_line = self._process_excel_rows(self.excel_file)
+            # Gọi hàm kiểm tra tồn tại
+            self._check_existing_package_codes(list_package_line)
+            self.package_line_ids = [(0, 0, line) for line in list_package_line]
+
+    def _normalize_header(self, header):
+        """Bỏ ký hiệu bắt buộc và gợi ý định dạng ngày khỏi tiêu đề cột"""
+        return re.sub(r"\(\*\)\s*\n", "", header).strip().replace('\n(yyyy-mm-dd)', '')
+
+    def _check_existing_package_codes(self, list_package_line):
         """Raise UserError if any package_code already exists in DB"""
-        code_line_map = {}
-        for index, row in enumerate(data_rows, start=2):  # dòng 2 trở đi là data
-            try:
-                code = row[header.index('Mã gói')].strip()
-                if code:
-                    code_line_map.setdefault(code, []).append(index)
-            except Exception:
-                continue
-
-        if not code_line_map:
+        package_codes = {line['package_code'] for line in list_package_line if line['package_code']}
+        if not package_codes:
             return
 
         existing_packages = self.env[MATE_HSM_PACKAGE].search([
-            ('code', 'in', list(code_line_map.keys()))
+            ('code', 'in', list(package_codes))
         ])
 
         if existing_packages:
             raise ValidationError(_("The following packages already exist in the system:"))
 
-    def _process_excel_rows(self, header, data_rows):
+    def _process_excel_rows(self, excel_file):
+        """
+        Đọc các dòng gói theo lô, gom lỗi của mọi dòng rồi báo một lần
+        :return: danh sách giá trị dòng gói, sắp xếp theo cột đầu tiên của file
+        """
+        rows = self._iter_excel_rows(excel_file, normalize_header=self._normalize_header)
+        column_map = self._get_column_map(next(rows), PACKAGE_COLUMNS, required=PACKAGE_REQUIRED_COLUMNS)
+        records = (
+            (row_index, dict(
+                {key: row[index] if index is not None and index < len(row) else None
+                 for key, index in column_map.items()},
+                sort_key=row[0]))
+            for row_index, row in rows
+        )
+
         list_package_line = []
-        for row_index, row in enumerate(data_rows, start=2):
-            data = dict(zip(header, row))
-            list_package_line.append({
-                'code': data.get('Mã dịch vụ'),
-                'name': data.get('Tên dịch vụ'),
-                'quantity': data.get('Số lượng'),
-                'package_name': data.get('Tên gói'),
-                'start_date': self._parse_request_time(data.get('Ngày bắt đầu có hiệu lực')),
-                'end_date': self._parse_request_time(data.get('Ngày hết hiệu lực')),
-                'category': data.get('Loại gói'),
-                'package_code': data.get('Mã gói'),
-            })
-        return list_package_line
 
-    def _prepare_caches(self):
-        """Prepare category, product and package caches from package lines"""
-        category_model = self.env[MATE_HMS_SUBSCRIPTION_CATEGORY]
-        product_model = self.env['product.product']
-        package_model = self.env[MATE_HSM_PACKAGE]
+        def process(valid_rows):
+            for _row_index, data in valid_rows:
+                list_package_line.append(self._prepare_package_line(data))
 
-        # Collect unique values
-        category_names = {line.category or '' for line in self.package_line_ids}
-        product_codes = {line.code or '' for line in self.package_line_ids}
-        package_codes = {line.package_code or '' for line in self.package_line_ids}
+        report = self._run_import(records, self._validate_package_row, process)
+        if report['errors']:
+            raise ValidationError(self._format_import_errors(report['errors']))
+        if not list_package_line:
+            raise ValidationError(_("No data found in the uploaded file."))
 
-        # Create caches
-        category_cache = {
-            rec.name: rec for rec in category_model.search([('name', 'in', list(category_names))])
-        }
-        product_cache = {
-            rec.default_code: rec for rec in product_model.search([('default_code', 'in', list(product_codes))])
-        }
-        package_cache = {
-            rec.code: rec for rec in package_model.search([('code', 'in', list(package_codes))])
+        list_package_line.sort(key=lambda line: line.pop('sort_key'))
+        return list_package_line
+
+    def _validate_package_row(self, row_index, data):
+        """Kiểm tra một dòng gói, trả về thông báo lỗi hoặc False"""
+        if not data['package_code'] or not isinstance(data['package_code'], str):
+            return self._get_field_error(_('Package Code'))
+        if data['quantity'] is not None and not isinstance(data['quantity'], (int, float)):
+            return self._get_field_error(_('Quantity'))
+        for key, label in (('start_date', _('Start Date')), ('end_date', _('End Date'))):
+            if data[key] and not isinstance(data[key], datetime):
+                return self._get_field_error(label)
+        return False
+
+    def _prepare_package_line(self, data):
+        return {
+            'code': data['code'],
+            'name': data['name'],
+            'quantity': data['quantity'],
+            'package_name': data['package_name'],
+            'start_date': self._parse_request_time(data['start_date']),
+            'end_date': self._parse_request_time(data['end_date']),
+            'category': data['category'],
+            'package_code': data['package_code'].strip(),
+            'sort_key': data.get('sort_key'),
         }
 
-        return category_cache, product_cache, package_cache, category_model, product_model
-
-    def _process_package_lines(self, category_cache, product_cache, package_cache, category_model, product_model):
-        """Process package lines and return package line data"""
-        package_model = self.env[MATE_HSM_PACKAGE]
-        package_line_data = []
-
-        for line in self.package_line_ids:
-            # Get or create category
-            category_name = line.category or ''
-            if category_name not in category_cache:
-                category = category_model.create({'name': category_name})
-                category_cache[category_name] = category
-            else:
-                category = category_cache[category_name]
-
-            # Get or create product
-            product_code = line.code or ''
-            if product_code not in product_cache:
-                product = product_model.create({
-                    'name': line.name,
-                    'default_code': product_code,
-                    'type': 'service',
-                })
-                product_cache[product_code] = product
-            else:
-                product = product_cache[product_code]
-
-            # Get or create package
-            package_code = line.package_code or ''
-            if package_code not in package_cache:
-                package = package_model.create({
-                    'name': line.package_name,
-                    'code': package_code,
-                    'start_date': line.start_date or fields.Date.today(),
-                    'end_date': line.end_date,
-                    'category_id': category.id,
-                })
-                package_cache[package_code] = package
-            else:
-                package = package_cache[package_code]
-
-            # Prepare package line data
-            package_line_data.append({
-                'name': line.name,
-                'product_uom_qty': line.quantity,
-                'order_id': package.id,
-                'product_id': product.id,
+    def _process_package_lines(self, lines=None):
+        """
+        Get or create categories, products and packages of the lines in bulk
+        (one search and one multi-create per model) and return package line data
+        """
+        lines = self.package_line_ids if lines is None else lines
+
+        # Values of the first line are used for records which do not exist yet
+        category_values, product_values = {}, {}
+        for line in lines:
+            category_values.setdefault(line.category or '', {})
+            product_values.setdefault(line.code or '', {'name': line.name, 'type': 'service'})
+        category_cache = self._get_or_create_records(MATE_HMS_SUBSCRIPTION_CATEGORY, 'name', category_values)
+        product_cache = self._get_or_create_records('product.product', 'default_code', product_values)
+
+        package_values = {}
+        for line in lines:
+            package_values.setdefault(line.package_code or '', {
+                'name': line.package_name,
+                'start_date': line.start_date or fields.Date.today(),
+                'end_date': line.end_date,
+                'category_id': category_cache[line.category or ''].id,
             })
+        package_cache = self._get_or_create_records(MATE_HSM_PACKAGE, 'code', package_values)
 
-        return package_line_data
+        return [{
+            'name': line.name,
+            'product_uom_qty': line.quantity,
+            'order_id': package_cache[line.package_code or ''].id,
+            'product_id': product_cache[line.code or ''].id,
+        } for line in lines]
 
     def save_package(self):
-        # Get caches and models
-        category_cache, product_cache, package_cache, category_model, product_model = self._prepare_caches()
+        if self.background_import:
+            if not self.excel_file:
+                raise ValidationError(_("Please upload excel file!"))
+            return self._create_import_job(self.excel_file, self.excel_file_name)
 
-        # Process package lines
-        package_line_data = self._process_package_lines(
-            category_cache, product_cache, package_cache, category_model, product_model
-        )
+        # Get or create categories, products and packages, then prepare package lines
+        package_line_data = self._process_package_lines()
 
         # Create all package lines at once
         self.env[MATE_HSM_PACKAGE_LINE].create(package_line_data)
@@ -187,6 +188,50 @@ class MateHandleUploadPackage(models.TransientModel):
         action = self.env.ref('mate_hms_subscriptions.mate_hms_package_action').read()[0]
         return action
 
+    # ------------------------------------------------------------------
+    # Import nền
+    # ------------------------------------------------------------------
+
+    def _get_import_columns(self):
+        return PACKAGE_COLUMNS, PACKAGE_REQUIRED_COLUMNS, self._normalize_header
+
+    def _validate_import_row(self, row_index, values):
+        return self._validate_package_row(row_index, values)
+
+    def _import_job_rows(self, job, rows):
+        """
+        Ghi một lô dòng gói
+
+        Gói đã có trong hệ thống trước khi import bị từ chối theo từng dòng,
+        gói do chính job tạo ở các lô trước (import_data['package_codes']) được dùng tiếp.
+        """
+        import_data = dict(job.import_data or {})
+        created_codes = set(import_data.get('package_codes', []))
+        line_values = [(row_index, self._prepare_package_line(values)) for row_index, values in rows]
+        for _row_index, values in line_values:
+            values.pop('sort_key')
+
+        package_codes = {values['package_code'] for _row_index, values in line_values}
+        existing_codes = set(self.env[MATE_HSM_PACKAGE].search([
+            ('code', 'in', list(package_codes - created_codes))
+        ]).mapped('code'))
+        errors = [
+            (row_index, _("Package %s already exists in the system.") % values['package_code'])
+            for row_index, values in line_values if values['package_code'] in existing_codes
+        ]
+
+        line_model = self.env[MATE_HMS_HANDLE_PACKAGE_LINE]
+        lines = line_model.concat(*(
+            line_model.new(values) for _row_index, values in line_values
+            if values['package_code'] not in existing_codes
+        ))
+        if lines:
+            self.env[MATE_HSM_PACKAGE_LINE].create(self._process_package_lines(lines))
+
+        import_data['package_codes'] = sorted(created_codes | set(lines.mapped('package_code')))
+        job.import_data = import_data
+        return errors
+
     def download_template_file(self):
         """Download the template file"""
         return {
@@ -19,11 +19,13 @@
 
         # views
         'data/coordination_actions.xml',
+        'data/queue_cron.xml',
 
         # 2. Các views và biểu mẫu (để model được tạo ra)
         'views/patient_view.xml',
         'views/queue_views.xml',
         'views/queue_room_selection_wizard_views.xml',
+        'views/menu_item.xml',
 
         # data seeding
         'data/demo_data.xml',
@@ -0,0 +1 @@
+from . import queue_room_feed
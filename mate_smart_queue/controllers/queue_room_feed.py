@@ -0,0 +1,10 @@
+from odoo.http import request
+from odoo import http
+
+
+class QueueRoomFeed(http.Controller):
+
+    @http.route(['/mate_smart_queue/room_feed/<int:room_id>'], type='json', auth="user")
+    def room_feed(self, room_id, revision=0, **post):
+        """Thay đổi hàng đợi của phòng kể từ revision, dùng khi màn hình hiển thị kết nối lại"""
+        return request.env['mate.queue.room.feed'].get_changes_since(room_id, revision)
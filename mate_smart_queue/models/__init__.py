@@ -4,8 +4,14 @@ from . import queue_package
 from . import queue_token
 from . import queue_service
 from . import queue_room
+from . import queue_room_load
+from . import queue_room_feed
 from . import queue_service_group
 from . import queue_priority
 from . import queue_room_selection_wizard
 from . import queue_room_distance
 from . import queue_coordination_log
+from . import queue_notification
+from . import queue_duration_stat
+from . import queue_simulation
+from . import queue_profiling
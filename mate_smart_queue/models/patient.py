@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api, _
 from datetime import date
+import json
 import logging
 from odoo.exceptions import UserError
 
+from .queue_profiling import profiled
+
 HIS_PATIENT = 'his.patient'
 HR_DEPARTMENT = 'hr.department'
 PRODUCT_PRODUCT = 'product.product'
@@ -134,6 +137,10 @@ class MateQueuePatient(models.Model):
 
     @api.depends('queue_history_ids', 'queue_history_ids.state')
     def _compute_current_service_info(self):
+        # Ước tính thời gian chờ cho token đang chờ của tất cả bệnh nhân một lần
+        waiting_tokens = self.queue_history_ids.filtered(lambda t: t.state == 'waiting')
+        estimates = waiting_tokens._estimate_wait_times()
+
         for patient in self:
             # Đặt lại các giá trị
             patient.current_waiting_token_id = False
@@ -158,123 +165,53 @@ class MateQueuePatient(models.Model):
                 patient.next_service_token_name = token.name
 
                 # Tính số lượng hàng đợi
-                queue_count = self.env[MATE_QUEUE_TOKEN].search_count([
-                    ('room_id', '=', token.room_id.id),
-                    ('state', '=', 'waiting'),
-                    ('position', '<', token.position)
-                ])
-                patient.next_service_queue_count = queue_count
-                patient.next_service_wait_time = token.estimated_wait_time
+                patient.next_service_queue_count = estimates[token.id]['ahead']
+                patient.next_service_wait_time = estimates[token.id]['wait_time']
 
     @api.depends('available_coordination_service_ids')
     def _compute_coordination_service_info(self):
-        """Tính toán thông tin chi tiết dịch vụ điều phối"""
-        import json
-
+        """Tính toán thông tin chi tiết dịch vụ điều phối (dùng chung ảnh chụp khả dụng theo dịch vụ)"""
+        availability = self.available_coordination_service_ids._get_coordination_availability()
         for patient in self:
-            if not patient.available_coordination_service_ids:
-                patient.coordination_service_info = '{}'
-                continue
-
-            info_dict = {}
-            for service in patient.available_coordination_service_ids:
-                service_info = patient.get_service_coordination_info(service.id)
-                info_dict[str(service.id)] = service_info
-
+            info_dict = {
+                str(service_id): availability[service_id]
+                for service_id in patient.available_coordination_service_ids.ids
+            }
             patient.coordination_service_info = json.dumps(info_dict, ensure_ascii=False)
 
     @api.depends('queue_package_id', 'completed_service_ids', 'queue_history_ids.state')
     def _compute_available_coordination_services(self):
         """Tính toán danh sách dịch vụ có thể điều phối"""
+        remaining_by_patient = {}
         for patient in self:
             # Kiểm tra xem có token đang chờ không
             waiting_tokens = patient.queue_history_ids.filtered(lambda t: t.state == 'waiting')
             if not waiting_tokens:
-                patient.available_coordination_service_ids = [(6, 0, [])]
+                remaining_by_patient[patient] = self.env[PRODUCT_PRODUCT]
                 continue
 
-            # Lấy các dịch vụ chưa hoàn thành trong gói
-            package_services = patient.queue_package_id.service_ids
-            completed_services = patient.completed_service_ids
-            remaining_services = package_services - completed_services
-
-            # Loại bỏ dịch vụ đang chờ hiện tại
-            current_service = waiting_tokens[0].service_id
-            remaining_services = remaining_services - current_service
-
-            # Lọc các dịch vụ có phòng khả dụng
-            available_service_ids = []
+            # Lấy các dịch vụ chưa hoàn thành trong gói, loại bỏ dịch vụ đang chờ hiện tại
+            remaining_by_patient[patient] = (
+                patient.queue_package_id.service_ids - patient.completed_service_ids - waiting_tokens[0].service_id
+            )
 
-            for service in remaining_services:
-                service_info = patient.get_service_coordination_info(service.id)
-                # Chỉ thêm dịch vụ nếu có phòng khả dụng
-                if service_info.get('available', False):
-                    available_service_ids.append(service.id)
+        # Tình trạng phòng của mọi dịch vụ được tính một lần cho tất cả bệnh nhân
+        services = self.env[PRODUCT_PRODUCT].union(*remaining_by_patient.values())
+        availability = services._get_coordination_availability()
 
+        for patient in self:
+            # Chỉ thêm dịch vụ nếu có phòng khả dụng
+            available_service_ids = [
+                service.id for service in remaining_by_patient[patient] if availability[service.id]['available']
+            ]
             patient.available_coordination_service_ids = [(6, 0, available_service_ids)]
 
-    @api.depends('queue_history_ids', 'queue_history_ids.state', 'completed_service_ids',
-                 'queue_package_id', 'queue_package_id.service_ids')
     def get_service_coordination_info(self, service_id):
         """Lấy thông tin điều phối thời gian thực cho một dịch vụ"""
         service = self.env[PRODUCT_PRODUCT].browse(service_id)
         if not service.exists():
             return {'available': False, 'message': _('Service does not exist')}
-
-        # Lấy các phòng khả dụng
-        available_rooms = self.env[HR_DEPARTMENT].search([
-            ('service_id', '=', service.id),
-            ('state', '=', 'open')
-        ])
-
-        if not available_rooms:
-            return {
-                'available': False,
-                'message': _('No available rooms'),
-                'room_count': 0,
-                'queue_length': 0,
-                'estimated_wait': 0
-            }
-
-        # Lấy phòng ít tải nhất
-        least_loaded_room = self._find_least_loaded_room_for_service(service)
-
-        # Lấy thống kê hàng đợi chỉ cho phòng được đề xuất
-        if least_loaded_room:
-            waiting_tokens = self.env[MATE_QUEUE_TOKEN].search([
-                ('room_id', '=', least_loaded_room.id),
-                ('state', '=', 'waiting')
-            ])
-
-            room_waiting = len(waiting_tokens)
-
-            # Tính thời gian chờ ước tính
-            if room_waiting > 0:
-                total_wait_time = sum(token.estimated_wait_time for token in waiting_tokens)
-                avg_wait = total_wait_time / room_waiting
-            else:
-                avg_wait = 0
-        else:
-            room_waiting = 0
-            avg_wait = 0
-
-        # Xác định màu thời gian chờ
-        if avg_wait < 25:
-            wait_color = 'success'
-        elif avg_wait <= 45:
-            wait_color = 'warning'
-        else:
-            wait_color = 'danger'
-
-        return {
-            'available': True,
-            'service_name': service.name,
-            'room_count': len(available_rooms),
-            'recommended_room': least_loaded_room.name if least_loaded_room else '',
-            'queue_length': room_waiting,
-            'estimated_wait': int(avg_wait),
-            'wait_color': wait_color
-        }
+        return service._get_coordination_availability()[service.id]
 
     def _get_room_queue_info(self, room):
         """Lấy thông tin hàng đợi của phòng"""
@@ -337,6 +274,7 @@ class MateQueuePatient(models.Model):
             else:
                 patient.estimated_time = _("1 hour 12 minutes")
 
+    @profiled('coordinate_service')
     def action_swap_to_service(self):
         """
         Điều phối: Chuyển từ dịch vụ đang chờ sang dịch vụ mới được chọn
@@ -426,6 +364,7 @@ class MateQueuePatient(models.Model):
                 }
             }
 
+    @profiled('coordinate_room')
     def action_coordinate_room(self):
         """
         Thực hiện điều phối phòng cho cùng dịch vụ
@@ -433,8 +372,8 @@ class MateQueuePatient(models.Model):
         """
         _logger = logging.getLogger(__name__)
 
-        _logger.info("=== ĐIỀU PHỐI PHÒNG ===")
-        _logger.info("Context: %s", self.env.context)
+        _logger.debug("=== ĐIỀU PHỐI PHÒNG ===")
+        _logger.debug("Context: %s", self.env.context)
 
         target_room_id = self.env.context.get('target_room_id')
         if not target_room_id:
@@ -603,30 +542,8 @@ class MateQueuePatient(models.Model):
 
     def _find_least_loaded_room_for_service(self, service):
         """Tìm phòng ít tải nhất cho dịch vụ"""
-        available_rooms = self.env[HR_DEPARTMENT].search([
-            ('service_id', '=', service.id),
-            ('state', '=', 'open')
-        ])
-
-        if not available_rooms:
-            return False
-
-        least_loaded_room = None
-        min_load = float('inf')
-
-        for room in available_rooms:
-            waiting_count = self.env[MATE_QUEUE_TOKEN].search_count([
-                ('room_id', '=', room.id),
-                ('state', '=', 'waiting')
-            ])
-
-            load_ratio = waiting_count / room.capacity if room.capacity > 0 else float('inf')
-
-            if load_ratio < min_load:
-                min_load = load_ratio
-                least_loaded_room = room
-
-        return least_loaded_room
+        room_id = service._get_coordination_availability()[service.id].get('recommended_room_id')
+        return self.env[HR_DEPARTMENT].browse(room_id) if room_id else False
 
     def _create_coordination_token(self, current_token, target_service, target_room):
         """Tạo token mới cho điều phối - xếp vào cuối hàng đợi"""
@@ -682,6 +599,7 @@ class MateQueuePatient(models.Model):
 
         self.env[MATE_QUEUE_COORDINATION_LOG].create(log_vals)
 
+    @profiled('coordinate_service_room')
     def action_coordinate_service_room(self):
         """
         Điều phối cho dịch vụ với phòng được chọn
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+import math
+
+from odoo import models, fields, api, _
+
+HR_DEPARTMENT = 'hr.department'
+PRODUCT_PRODUCT = 'product.product'
+MATE_QUEUE_DURATION_SAMPLE = 'mate.queue.duration.sample'
+MATE_QUEUE_DURATION_STAT = 'mate.queue.duration.stat'
+
+# Bucket "mọi giờ / mọi ngày trong tuần"
+ANY_BUCKET = -1
+
+# Sketch phân vị dạng histogram logarit: mỗi ô có độ rộng tương đối 2%,
+# khi tổng số mẫu vượt ngưỡng thì chia đôi để sketch thích nghi với dữ liệu mới
+SKETCH_RELATIVE_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_MAX_COUNT = 2000
+
+# Số mẫu tối thiểu để dùng thống kê của một bucket
+DURATION_MIN_SAMPLES = 5
+
+# Thống kê có thể dùng cho ước tính thời gian chờ: {giá trị tham số: trường}
+DURATION_STATISTICS = {
+    'average': None,  # Trung bình cộng tích lũy trên dịch vụ (average_duration)
+    'ewma': 'ewma',
+    'p50': 'p50',
+    'p90': 'p90',
+}
+
+
+def _sketch_add(sketch, value):
+    """Thêm một giá trị (> 0) vào sketch {chỉ số ô: số mẫu}"""
+    index = str(math.ceil(math.log(value) / math.log(SKETCH_GAMMA)))
+    sketch[index] = sketch.get(index, 0) + 1
+
+
+def _sketch_compact(sketch):
+    """Chia đôi số mẫu khi sketch vượt ngưỡng, bỏ các ô rỗng"""
+    if sum(sketch.values()) <= SKETCH_MAX_COUNT:
+        return sketch
+    return {index: count / 2 for index, count in sketch.items() if count / 2 >= 0.5}
+
+
+def _sketch_quantile(sketch, quantile):
+    """Ước lượng phân vị từ sketch, sai số tương đối theo SKETCH_RELATIVE_ACCURACY"""
+    total = sum(sketch.values())
+    if not total:
+        return 0.0
+    rank = quantile * total
+    seen = 0.0
+    for index in sorted(sketch, key=int):
+        seen += sketch[index]
+        if seen >= rank:
+            return 2 * SKETCH_GAMMA ** int(index) / (SKETCH_GAMMA + 1)
+    return 2 * SKETCH_GAMMA ** int(max(sketch, key=int)) / (SKETCH_GAMMA + 1)
+
+
+class QueueDurationSample(models.Model):
+    """
+    Thời gian phục vụ thực tế chờ được tổng hợp
+
+    Hoàn thành dịch vụ chỉ chèn một dòng vào bảng này (không ghi vào product.product),
+    cron tổng hợp theo lô vào mate.queue.duration.stat rồi xóa mẫu.
+    """
+    _name = MATE_QUEUE_DURATION_SAMPLE
+    _description = _('Service Duration Sample')
+    _log_access = False
+
+    service_id = fields.Many2one(PRODUCT_PRODUCT, string=_('Service'), required=True, ondelete='cascade')
+    room_id = fields.Many2one(HR_DEPARTMENT, string=_('Room'), ondelete='cascade')
+    duration = fields.Float(string=_('Duration (minutes)'), required=True)
+    completed_at = fields.Datetime(string=_('Completed At'), required=True, default=fields.Datetime.now)
+
+    @api.model
+    def _cron_flush_samples(self, batch_size=5000):
+        """Tổng hợp các mẫu thời gian phục vụ vào thống kê theo lô"""
+        self.flush_model()
+        self.env.cr.execute(f"""
+            SELECT id FROM {self._table} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+        """, [batch_size])
+        samples = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if not samples:
+            return
+
+        self.env[MATE_QUEUE_DURATION_STAT]._add_samples(samples)
+
+        # Trung bình cộng tích lũy trên dịch vụ được cập nhật một lần cho mỗi dịch vụ
+        durations = defaultdict(list)
+        for sample in samples:
+            durations[sample.service_id].append(sample.duration)
+        for service, service_durations in durations.items():
+            service._update_average_duration(service_durations)
+
+        samples.unlink()
+        self.env['ir.cron']._notify_progress(done=len(samples), remaining=self.search_count([]))
+
+
+class QueueDurationStat(models.Model):
+    """
+    Thống kê thời gian phục vụ theo dịch vụ / phòng, theo giờ trong ngày và ngày trong tuần
+
+    Mỗi dòng giữ trung bình trượt hàm mũ (EWMA) và sketch phân vị để lấy P50 / P90.
+    room_id rỗng là thống kê chung của dịch vụ, weekday / hour = -1 là mọi ngày / mọi giờ.
+    """
+    _name = MATE_QUEUE_DURATION_STAT
+    _description = _('Service Duration Statistics')
+    _rec_name = 'service_id'
+
+    service_id = fields.Many2one(PRODUCT_PRODUCT, string=_('Service'), required=True, index=True,
+                                 ondelete='cascade')
+    room_id = fields.Many2one(HR_DEPARTMENT, string=_('Room'), ondelete='cascade')
+    weekday = fields.Integer(string=_('Weekday'), default=ANY_BUCKET, help=_("0 = Monday, -1 = any day"))
+    hour = fields.Integer(string=_('Hour'), default=ANY_BUCKET, help=_("Hour of day, -1 = any hour"))
+    sample_count = fields.Integer(string=_('Samples'), default=0)
+    ewma = fields.Float(string=_('EWMA (minutes)'))
+    p50 = fields.Float(string=_('P50 (minutes)'))
+    p90 = fields.Float(string=_('P90 (minutes)'))
+    sketch = fields.Json(string=_('Quantile Sketch'))
+
+    def _get_buckets(self, sample):
+        """Các bucket mà một mẫu được cộng vào: (service_id, room_id, weekday, hour)"""
+        local_time = fields.Datetime.context_timestamp(self, sample.completed_at)
+        weekday, hour = local_time.weekday(), local_time.hour
+        service_id, room_id = sample.service_id.id, sample.room_id.id or False
+        buckets = [(service_id, False, weekday, hour), (service_id, False, ANY_BUCKET, ANY_BUCKET)]
+        if room_id:
+            buckets += [(service_id, room_id, weekday, hour), (service_id, room_id, ANY_BUCKET, ANY_BUCKET)]
+        return buckets
+
+    @api.model
+    def _add_samples(self, samples):
+        """Cộng dồn các mẫu vào thống kê, mỗi dòng thống kê được ghi một lần"""
+        alpha = float(self.env['ir.config_parameter'].sudo().get_param(
+            'mate_smart_queue.duration_ewma_alpha', '0.1'))
+
+        durations = defaultdict(list)
+        for sample in samples.sorted('completed_at'):
+            if sample.duration > 0:
+                for bucket in self._get_buckets(sample):
+                    durations[bucket].append(sample.duration)
+        if not durations:
+            return
+
+        stats = self.search([('service_id', 'in', list({bucket[0] for bucket in durations}))])
+        stats_by_bucket = {
+            (stat.service_id.id, stat.room_id.id or False, stat.weekday, stat.hour): stat for stat in stats
+        }
+
+        new_vals = []
+        for bucket, values in durations.items():
+            stat = stats_by_bucket.get(bucket)
+            count = stat.sample_count if stat else 0
+            ewma = stat.ewma if stat else values[0]
+            sketch = dict(stat.sketch or {}) if stat else {}
+            for value in values:
+                ewma = value if not count else alpha * value + (1 - alpha) * ewma
+                count += 1
+                _sketch_add(sketch, value)
+            sketch = _sketch_compact(sketch)
+            vals = {
+                'sample_count': count,
+                'ewma': ewma,
+                'p50': _sketch_quantile(sketch, 0.5),
+                'p90': _sketch_quantile(sketch, 0.9),
+                'sketch': sketch,
+            }
+            if stat:
+                stat.write(vals)
+            else:
+                service_id, room_id, weekday, hour = bucket
+                new_vals.append(dict(vals, service_id=service_id, room_id=room_id, weekday=weekday, hour=hour))
+        self.create(new_vals)
+
+    @api.model
+    def _get_duration_estimates(self, pairs, statistic=None, at=None):
+        """
+        Thời gian phục vụ ước tính cho nhiều cặp (dịch vụ, phòng) với một truy vấn
+
+        Thứ tự dự phòng: phòng + khung giờ -> phòng -> dịch vụ + khung giờ -> dịch vụ
+        -> average_duration của dịch vụ. Bucket có ít hơn DURATION_MIN_SAMPLES mẫu bị bỏ qua.
+
+        Args:
+            pairs: iterable (service, room) record, room có thể rỗng
+            statistic: 'average', 'ewma', 'p50' hoặc 'p90'
+                (mặc định theo tham số mate_smart_queue.wait_time_statistic)
+            at: thời điểm ước tính (mặc định hiện tại)
+
+        Returns:
+            dict: {(service_id, room_id): phút}
+        """
+        pairs = {(service, room) for service, room in pairs if service}
+        if statistic is None:
+            statistic = self.env['ir.config_parameter'].sudo().get_param(
+                'mate_smart_queue.wait_time_statistic', 'average')
+        fname = DURATION_STATISTICS.get(statistic)
+
+        estimates = {(service.id, room.id or False): service.average_duration for service, room in pairs}
+        if not fname or not pairs:
+            return estimates
+
+        local_time = fields.Datetime.context_timestamp(self, at or fields.Datetime.now())
+        weekday, hour = local_time.weekday(), local_time.hour
+        stats = self.sudo().search_fetch([
+            ('service_id', 'in', list({service.id for service, _room in pairs})),
+            ('weekday', 'in', [weekday, ANY_BUCKET]),
+            ('hour', 'in', [hour, ANY_BUCKET]),
+            ('sample_count', '>=', DURATION_MIN_SAMPLES),
+        ], ['service_id', 'room_id', 'weekday', 'hour', fname])
+        values = {
+            (stat.service_id.id, stat.room_id.id or False, stat.weekday, stat.hour): stat[fname] for stat in stats
+        }
+
+        for service_id, room_id in estimates:
+            for bucket in ((service_id, room_id, weekday, hour), (service_id, room_id, ANY_BUCKET, ANY_BUCKET),
+                           (service_id, False, weekday, hour), (service_id, False, ANY_BUCKET, ANY_BUCKET)):
+                if values.get(bucket):
+                    estimates[(service_id, room_id)] = values[bucket]
+                    break
+        return estimates
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import logging
+
+from odoo import models, fields, api, _
+
+_logger = logging.getLogger(__name__)
+
+MATE_QUEUE_TOKEN = "mate.queue.token"
+MATE_QUEUE_NOTIFICATION = 'mate.queue.notification'
+HIS_PATIENT = 'his.patient'
+
+# Số lần gửi tối đa và thời gian chờ (phút) trước lần thử lại thứ n: 1, 2, 4, 8...
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_BASE_DELAY = 1
+NOTIFICATION_BATCH_SIZE = 100
+
+
+class QueueNotification(models.Model):
+    """
+    Hàng đợi thông báo SMS / email cho bệnh nhân
+
+    Các luồng nghiệp vụ (đăng ký, chuyển phòng...) chỉ ghi dòng thông báo, cron gửi
+    theo lô ngoài giao dịch đăng ký, thử lại khi lỗi và ghi lại độ trễ gửi.
+    """
+    _name = MATE_QUEUE_NOTIFICATION
+    _description = _('Queue Notification')
+    _order = 'id desc'
+    _rec_name = 'token_id'
+
+    token_id = fields.Many2one(MATE_QUEUE_TOKEN, string=_('Token'), required=True, ondelete='cascade')
+    patient_id = fields.Many2one(HIS_PATIENT, string=_('Patient'), required=True, index=True, ondelete='cascade')
+    notification_type = fields.Selection([
+        ('new_token', _('New Token')),
+        ('token_called', _('Token Called')),
+        ('room_change', _('Room Change')),
+    ], string=_('Notification Type'), required=True)
+    channel = fields.Selection([
+        ('sms', _('SMS')),
+        ('email', _('Email')),
+    ], string=_('Channel'), required=True)
+    state = fields.Selection([
+        ('pending', _('Pending')),
+        ('sent', _('Sent')),
+        ('failed', _('Failed')),
+        ('cancelled', _('Cancelled')),
+    ], string=_('Status'), default='pending', required=True, index=True)
+    attempts = fields.Integer(string=_('Attempts'), default=0)
+    next_attempt_at = fields.Datetime(string=_('Next Attempt'), default=fields.Datetime.now, index=True)
+    sent_at = fields.Datetime(string=_('Sent At'))
+    latency = fields.Float(string=_('Delivery Latency (seconds)'),
+                           help=_("Time between queuing the notification and its delivery"))
+    last_error = fields.Text(string=_('Last Error'))
+
+    @api.model
+    def _enqueue(self, tokens, notification_type):
+        """
+        Ghi thông báo cho nhiều token trong một lần
+
+        Thông báo đang chờ gửi trùng (token, loại, kênh) được bỏ qua. Với thông báo
+        chuyển phòng chỉ giữ thông báo mới nhất của mỗi bệnh nhân, các thông báo chuyển
+        phòng cũ hơn chưa gửi được hủy.
+        """
+        ir_config = self.env['ir.config_parameter'].sudo()
+        channels = [
+            channel for channel, param in (('sms', 'enable_sms'), ('email', 'enable_email'))
+            if ir_config.get_param(f'mate_smart_queue.{param}', 'False').lower() == 'true'
+        ]
+        if not tokens or not channels:
+            return self.browse()
+
+        # Mỗi (bệnh nhân / token, kênh) chỉ giữ một dòng, token sau ghi đè token trước
+        rows = {}
+        for token in tokens:
+            patient = token.patient_id
+            for channel in channels:
+                if (channel == 'sms' and not patient.mobile) or (channel == 'email' and not patient.email):
+                    continue
+                key = (patient.id if notification_type == 'room_change' else token.id, channel)
+                rows[key] = {
+                    'token_id': token.id,
+                    'patient_id': patient.id,
+                    'notification_type': notification_type,
+                    'channel': channel,
+                }
+        if not rows:
+            return self.browse()
+
+        pending = self.sudo().search([
+            ('state', '=', 'pending'),
+            ('notification_type', '=', notification_type),
+            ('patient_id', 'in', tokens.patient_id.ids),
+        ])
+        if notification_type == 'room_change':
+            pending.write({'state': 'cancelled'})
+        else:
+            for notification in pending:
+                rows.pop((notification.token_id.id, notification.channel), None)
+
+        return self.sudo().create(list(rows.values()))
+
+    @api.model
+    def _cron_send_notifications(self, batch_size=NOTIFICATION_BATCH_SIZE):
+        """Gửi một lô thông báo đến hạn, báo cho cron chạy tiếp nếu còn"""
+        self.flush_model()
+        self.env.cr.execute(f"""
+            SELECT id FROM {self._table}
+             WHERE state = 'pending' AND next_attempt_at <= NOW() AT TIME ZONE 'UTC'
+             ORDER BY next_attempt_at, id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, [batch_size])
+        notifications = self.sudo().browse([row[0] for row in self.env.cr.fetchall()])
+        if notifications:
+            notifications._deliver()
+            sent = notifications.filtered(lambda n: n.state == 'sent')
+            _logger.info("Gửi thông báo hàng đợi: %d thành công, %d lỗi, độ trễ trung bình %.1f giây",
+                         len(sent), len(notifications) - len(sent),
+                         sum(sent.mapped('latency')) / len(sent) if sent else 0.0)
+
+        remaining = self.search_count([
+            ('state', '=', 'pending'),
+            ('next_attempt_at', '<=', fields.Datetime.now()),
+        ])
+        self.env['ir.cron']._notify_progress(done=len(notifications), remaining=remaining)
+
+    def _deliver(self):
+        """Gửi các thông báo: email được gửi chung một phiên SMTP, SMS gửi lần lượt"""
+        token_model = self.env[MATE_QUEUE_TOKEN]
+        ir_config = self.env['ir.config_parameter'].sudo()
+        errors = {}
+
+        # Email: tạo mail.mail cho cả lô rồi gửi một lần (một kết nối cho mỗi máy chủ mail)
+        mail_ids = {}
+        for notification in self.filtered(lambda n: n.channel == 'email'):
+            try:
+                template_id = token_model._get_email_template_id(notification.notification_type, ir_config)
+                mail_ids[notification] = self.env['mail.template'].browse(template_id).send_mail(
+                    notification.token_id.id, force_send=False)
+            except Exception as e:
+                errors[notification] = str(e)
+        mails = self.env['mail.mail'].sudo().browse(list(mail_ids.values()))
+        if mails:
+            mails.send(raise_exception=False)
+        for notification, mail_id in mail_ids.items():
+            mail = mails.browse(mail_id).exists()
+            if mail and mail.state == 'exception':
+                errors[notification] = mail.failure_reason or _('Email delivery failed')
+                # Việc gửi lại do hàng đợi thông báo đảm nhận, không để mail queue gửi trùng
+                mail.unlink()
+
+        # SMS
+        for notification in self.filtered(lambda n: n.channel == 'sms'):
+            try:
+                template_id = token_model._get_sms_template_id(notification.notification_type, ir_config)
+                self.env['sms.template'].browse(template_id).send_sms(notification.token_id.id)
+            except Exception as e:
+                errors[notification] = str(e)
+
+        now = fields.Datetime.now()
+        for notification in self:
+            attempts = notification.attempts + 1
+            error = errors.get(notification)
+            if not error:
+                notification.write({
+                    'state': 'sent',
+                    'attempts': attempts,
+                    'sent_at': now,
+                    'latency': (now - notification.create_date).total_seconds(),
+                    'last_error': False,
+                })
+            elif attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                _logger.error("Không gửi được thông báo %s sau %d lần: %s", notification.id, attempts, error)
+                notification.write({'state': 'failed', 'attempts': attempts, 'last_error': error})
+            else:
+                notification.write({
+                    'attempts': attempts,
+                    'next_attempt_at': now + timedelta(minutes=NOTIFICATION_RETRY_BASE_DELAY * 2 ** (attempts - 1)),
+                    'last_error': error,
+                })
+
+    @api.model
+    def _get_delivery_metrics(self, since=None):
+        """
+        Thống kê gửi thông báo
+
+        Returns:
+            dict: {'sent', 'failed', 'pending', 'cancelled', 'avg_latency', 'max_latency', 'retries'}
+        """
+        domain = [('create_date', '>=', since)] if since else []
+        metrics = dict.fromkeys(['sent', 'failed', 'pending', 'cancelled'], 0)
+        for state, count in self.sudo()._read_group(domain, ['state'], ['__count']):
+            metrics[state] = count
+        [(avg_latency, max_latency)] = self.sudo()._read_group(
+            domain + [('state', '=', 'sent')], [], ['latency:avg', 'latency:max'])
+        [(retries,)] = self.sudo()._read_group(domain + [('attempts', '>', 1)], [], ['__count'])
+        metrics.update(avg_latency=avg_latency or 0.0, max_latency=max_latency or 0.0, retries=retries)
+        return metrics
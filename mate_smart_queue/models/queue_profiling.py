@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from datetime import timedelta
+import functools
+import random
+import time
+
+from odoo import models, fields, api, _
+
+from .queue_duration_stat import _sketch_add, _sketch_compact, _sketch_quantile
+from .queue_room_feed import ROOM_NOTIFY_KEY
+
+MATE_QUEUE_OPERATION_SAMPLE = 'mate.queue.operation.sample'
+MATE_QUEUE_OPERATION_STAT = 'mate.queue.operation.stat'
+
+# Khóa trong cache của cursor: đang đo một điểm vào (lời gọi lồng nhau không đo lại)
+PROFILING_ACTIVE_KEY = 'mate_smart_queue.profiling_active'
+# Khóa trong cr.precommit.data: các mẫu chờ ghi khi commit
+PROFILING_SAMPLES_KEY = 'mate_smart_queue.profiling_samples'
+PROFILING_RETENTION_DAYS = 30
+
+# Số dòng đọc / ghi trong giao dịch hiện tại và số dòng được chèn vào các bảng tác dụng phụ
+PROFILING_PROBE_SQL = """
+    SELECT COALESCE(SUM(seq_tup_read + COALESCE(idx_tup_fetch, 0)), 0),
+           COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0),
+           COALESCE(SUM(n_tup_ins) FILTER (WHERE relname IN ('mail_mail', 'mail_message')), 0),
+           COALESCE(SUM(n_tup_ins) FILTER (WHERE relname = 'mate_queue_notification'), 0),
+           COALESCE(SUM(n_tup_ins) FILTER (WHERE relname = 'bus_bus'), 0)
+      FROM pg_stat_xact_user_tables
+"""
+
+PROFILING_SAMPLE_FIELDS = ('operation', 'duration', 'query_count', 'rows_read', 'rows_written',
+                           'mail_count', 'notification_count', 'bus_count', 'sample_rate')
+
+
+def profiled(operation):
+    """
+    Đo một điểm vào của hàng đợi: số truy vấn SQL, số dòng đọc / ghi, thời gian
+    và tác dụng phụ (mail, thông báo bệnh nhân, thông báo màn hình)
+
+    Chỉ một phần lời gọi được đo theo tham số mate_smart_queue.profiling_sample_rate
+    (0 là tắt), lời gọi không được chọn chỉ tốn một lần đọc tham số đã cache.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cr = self.env.cr
+            if cr.cache.get(PROFILING_ACTIVE_KEY):
+                return method(self, *args, **kwargs)
+            sample_rate = self.env[MATE_QUEUE_OPERATION_SAMPLE]._get_sample_rate()
+            if sample_rate <= 0 or random.random() >= sample_rate:
+                return method(self, *args, **kwargs)
+
+            cr.cache[PROFILING_ACTIVE_KEY] = True
+            try:
+                self.env.flush_all()
+                cr.execute(PROFILING_PROBE_SQL)
+                before = cr.fetchone()
+                rooms_before = len(cr.precommit.data.get(ROOM_NOTIFY_KEY, ()))
+                queries, started = cr.sql_log_count, time.perf_counter()
+
+                result = method(self, *args, **kwargs)
+                self.env.flush_all()
+
+                duration = (time.perf_counter() - started) * 1000
+                query_count = cr.sql_log_count - queries
+                cr.execute(PROFILING_PROBE_SQL)
+                after = cr.fetchone()
+            finally:
+                cr.cache.pop(PROFILING_ACTIVE_KEY, None)
+
+            rows_read, rows_written, mail_count, notification_count, bus_count = (
+                end - start for start, end in zip(before, after))
+            self.env[MATE_QUEUE_OPERATION_SAMPLE]._record({
+                'operation': operation,
+                'duration': duration,
+                'query_count': query_count,
+                'rows_read': rows_read,
+                'rows_written': rows_written,
+                'mail_count': mail_count,
+                'notification_count': notification_count,
+                'bus_count': bus_count + len(cr.precommit.data.get(ROOM_NOTIFY_KEY, ())) - rooms_before,
+                'sample_rate': sample_rate,
+            })
+            return result
+        return wrapper
+    return decorator
+
+
+class QueueOperationSample(models.Model):
+    """
+    Số đo của từng lời gọi được lấy mẫu
+
+    Mẫu được gom trong giao dịch và chèn một lần khi commit, cron tổng hợp vào
+    mate.queue.operation.stat rồi xóa (bảng chỉ giữ các mẫu chưa tổng hợp).
+    """
+    _name = MATE_QUEUE_OPERATION_SAMPLE
+    _description = _('Queue Operation Sample')
+    _log_access = False
+
+    operation = fields.Char(string=_('Operation'), required=True)
+    recorded_at = fields.Datetime(string=_('Recorded At'), required=True, default=fields.Datetime.now)
+    duration = fields.Float(string=_('Duration (ms)'))
+    query_count = fields.Integer(string=_('Queries'))
+    rows_read = fields.Integer(string=_('Rows Read'))
+    rows_written = fields.Integer(string=_('Rows Written'))
+    mail_count = fields.Integer(string=_('Mails'))
+    notification_count = fields.Integer(string=_('Patient Notifications'))
+    bus_count = fields.Integer(string=_('Bus Messages'))
+    sample_rate = fields.Float(string=_('Sample Rate'))
+
+    @api.model
+    def _get_sample_rate(self):
+        """Tỷ lệ lời gọi được đo (0 - 1)"""
+        try:
+            return float(self.env['ir.config_parameter'].sudo().get_param(
+                'mate_smart_queue.profiling_sample_rate', '0.05'))
+        except ValueError:
+            return 0.0
+
+    @api.model
+    def _record(self, values):
+        """Gom mẫu vào giao dịch hiện tại, ghi một lần trước khi commit"""
+        precommit = self.env.cr.precommit
+        samples = precommit.data.get(PROFILING_SAMPLES_KEY)
+        if samples is None:
+            samples = precommit.data[PROFILING_SAMPLES_KEY] = []
+            precommit.add(self._flush_samples)
+        samples.append(values)
+
+    def _flush_samples(self):
+        samples = self.env.cr.precommit.data.pop(PROFILING_SAMPLES_KEY, [])
+        if not samples:
+            return
+        row = f"(NOW() AT TIME ZONE 'UTC', {', '.join(['%s'] * len(PROFILING_SAMPLE_FIELDS))})"
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} (recorded_at, {", ".join(PROFILING_SAMPLE_FIELDS)})
+            VALUES {", ".join([row] * len(samples))}
+        """, [sample[fname] for sample in samples for fname in PROFILING_SAMPLE_FIELDS])
+
+    @api.model
+    def _cron_aggregate_samples(self, batch_size=10000):
+        """Tổng hợp mẫu theo lô vào thống kê theo ngày, dọn thống kê cũ"""
+        self.env.cr.execute(f"""
+            SELECT id FROM {self._table} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+        """, [batch_size])
+        samples = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if samples:
+            self.env[MATE_QUEUE_OPERATION_STAT]._add_samples(samples)
+            samples.unlink()
+
+        stat_model = self.env[MATE_QUEUE_OPERATION_STAT]
+        stat_model.search([
+            ('date', '<', fields.Date.today() - timedelta(days=PROFILING_RETENTION_DAYS)),
+        ]).unlink()
+        self.env['ir.cron']._notify_progress(done=len(samples), remaining=self.search_count([]))
+
+
+class QueueOperationStat(models.Model):
+    """
+    Thống kê theo ngày của các điểm vào hàng đợi
+
+    Tổng được ước tính lại theo tỷ lệ lấy mẫu, độ trễ P50 / P95 lấy từ sketch phân vị
+    (cùng loại sketch với mate.queue.duration.stat).
+    """
+    _name = MATE_QUEUE_OPERATION_STAT
+    _description = _('Queue Operation Statistics')
+    _order = 'date desc, operation'
+    _rec_name = 'operation'
+
+    operation = fields.Char(string=_('Operation'), required=True, index=True)
+    date = fields.Date(string=_('Date'), required=True, index=True)
+    sample_count = fields.Integer(string=_('Samples'), default=0)
+    estimated_calls = fields.Float(string=_('Estimated Calls'), default=0.0)
+    avg_duration = fields.Float(string=_('Avg (ms)'))
+    p50_duration = fields.Float(string=_('P50 (ms)'))
+    p95_duration = fields.Float(string=_('P95 (ms)'))
+    max_duration = fields.Float(string=_('Max (ms)'))
+    avg_queries = fields.Float(string=_('Avg Queries'))
+    max_queries = fields.Integer(string=_('Max Queries'))
+    avg_rows_read = fields.Float(string=_('Avg Rows Read'))
+    avg_rows_written = fields.Float(string=_('Avg Rows Written'))
+    avg_mails = fields.Float(string=_('Avg Mails'))
+    avg_notifications = fields.Float(string=_('Avg Patient Notifications'))
+    avg_bus_messages = fields.Float(string=_('Avg Bus Messages'))
+    sketch = fields.Json(string=_('Latency Sketch'))
+
+    _sql_constraints = [
+        ('operation_date_uniq', 'unique(operation, date)', _('Operation statistics must be unique per day!'))
+    ]
+
+    @api.model
+    def _add_samples(self, samples):
+        """Cộng dồn các mẫu vào thống kê, mỗi dòng thống kê được ghi một lần"""
+        samples_by_key = defaultdict(list)
+        for sample in samples:
+            samples_by_key[(sample.operation, sample.recorded_at.date())].append(sample)
+
+        stats = self.search([
+            ('operation', 'in', list({operation for operation, _date in samples_by_key})),
+            ('date', 'in', list({day for _operation, day in samples_by_key})),
+        ])
+        stats_by_key = {(stat.operation, stat.date): stat for stat in stats}
+
+        averages = {
+            'avg_duration': 'duration',
+            'avg_queries': 'query_count',
+            'avg_rows_read': 'rows_read',
+            'avg_rows_written': 'rows_written',
+            'avg_mails': 'mail_count',
+            'avg_notifications': 'notification_count',
+            'avg_bus_messages': 'bus_count',
+        }
+        new_vals = []
+        for (operation, day), key_samples in samples_by_key.items():
+            stat = stats_by_key.get((operation, day))
+            count = stat.sample_count if stat else 0
+            total = count + len(key_samples)
+            sketch = dict(stat.sketch or {}) if stat else {}
+            for sample in key_samples:
+                _sketch_add(sketch, max(sample.duration, 0.001))
+            sketch = _sketch_compact(sketch)
+
+            vals = {
+                'sample_count': total,
+                'estimated_calls': (stat.estimated_calls if stat else 0.0) + sum(
+                    1 / sample.sample_rate for sample in key_samples if sample.sample_rate > 0),
+                'p50_duration': _sketch_quantile(sketch, 0.5),
+                'p95_duration': _sketch_quantile(sketch, 0.95),
+                'max_duration': max([stat.max_duration if stat else 0.0] + [s.duration for s in key_samples]),
+                'max_queries': max([stat.max_queries if stat else 0] + [s.query_count for s in key_samples]),
+                'sketch': sketch,
+            }
+            for fname, sample_fname in averages.items():
+                previous = stat[fname] * count if stat else 0.0
+                vals[fname] = (previous + sum(sample[sample_fname] for sample in key_samples)) / total
+            if stat:
+                stat.write(vals)
+            else:
+                new_vals.append(dict(vals, operation=operation, date=day))
+        self.create(new_vals)
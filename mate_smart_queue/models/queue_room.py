@@ -4,6 +4,7 @@ from odoo import models, fields, api, _
 HR_DEPARTMENT = 'hr.department'
 MATE_QUEUE_TOKEN = "mate.queue.token"
 PRODUCT_PRODUCT = 'product.product'
+MATE_QUEUE_ROOM_LOAD = 'mate.queue.room.load'
 
 
 class QueueRoom(models.Model):
@@ -18,6 +19,8 @@ class QueueRoom(models.Model):
                                     domain=[('state', '=', 'waiting')])
     queue_length = fields.Integer(string=_('Queue Length'), compute='_compute_queue_length')
     estimated_wait_time = fields.Float(string=_('Estimated Wait Time (minutes)'), compute='_compute_wait_time')
+    in_progress_count = fields.Integer(string=_('In Progress'), compute='_compute_queue_length')
+    load_ratio = fields.Float(string=_('Load Ratio'), compute='_compute_queue_length')
     active = fields.Boolean(string=_('Active'), default=True)
     state = fields.Selection([
         ('open', _('Open')),
@@ -32,17 +35,37 @@ class QueueRoom(models.Model):
 
     @api.depends('current_queue')
     def _compute_queue_length(self):
-        """Tính toán độ dài hàng đợi hiện tại"""
+        """Tính toán độ dài hàng đợi hiện tại (đọc từ snapshot tải phòng)"""
+        loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(self._origin.ids)
         for room in self:
-            room.queue_length = len(room.current_queue)
+            load = loads.get(room._origin.id, {})
+            room.queue_length = load.get('waiting_count', 0)
+            room.in_progress_count = load.get('in_progress_count', 0)
+            room.load_ratio = load.get('load_ratio', 0.0)
 
-    @api.depends('queue_length', 'service_id.average_duration')
+    @api.depends('queue_length', 'capacity', 'service_id.average_duration')
     def _compute_wait_time(self):
         """Tính toán thời gian chờ ước tính cho bệnh nhân mới"""
+        # Công thức: Số người đợi * Thời gian trung bình / Công suất phòng (tính sẵn trong snapshot)
+        loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(self._origin.ids)
         for room in self:
-            avg_duration = room.service_id.average_duration
-            # Công thức: Số người đợi * Thời gian trung bình / Công suất phòng
-            room.estimated_wait_time = room.queue_length * avg_duration / room.capacity
+            room.estimated_wait_time = loads.get(room._origin.id, {}).get('estimated_wait_time', 0.0)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rooms = super(QueueRoom, self).create(vals_list)
+        # Snapshot tải được tạo cùng phòng, việc đọc không bao giờ phải ghi
+        if rooms:
+            self.env[MATE_QUEUE_ROOM_LOAD]._rebuild_room_loads(rooms.ids)
+        return rooms
+
+    def write(self, vals):
+        res = super(QueueRoom, self).write(vals)
+        if 'capacity' in vals or 'service_id' in vals:
+            self.env[MATE_QUEUE_ROOM_LOAD]._refresh_room_metrics(self.ids)
+        elif {'state', 'name', 'active'}.intersection(vals):
+            self.env[MATE_QUEUE_ROOM_LOAD]._invalidate_service_availability()
+        return res
 
     def action_open_room(self):
         """Mở phòng cho phục vụ"""
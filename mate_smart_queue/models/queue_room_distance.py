@@ -1,8 +1,14 @@
-from odoo import models, fields, api, _
+import heapq
+from collections import defaultdict
+
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 
 HR_DEPARTMENT = 'hr.department'
 
+# Khoảng cách mặc định giữa hai phòng chưa được khai báo
+DEFAULT_ROOM_DISTANCE = 5.0
+
 
 class QueueRoomDistance(models.Model):
     _name = 'queue.room.distance'
@@ -17,6 +23,23 @@ class QueueRoomDistance(models.Model):
                                help=_("Estimated travel time between two rooms"))
     display_name = fields.Char(string=_('Display Name'), compute='_compute_display_name', store=True)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'room_from_id', 'room_to_id', 'distance', 'travel_time'}.intersection(vals):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
     @api.depends('room_from_id', 'room_to_id', 'distance')
     def _compute_display_name(self):
         for record in self:
@@ -43,19 +66,77 @@ class QueueRoomDistance(models.Model):
 
     @api.model
     def get_distance(self, from_room_id, to_room_id):
-        """Lấy khoảng cách giữa hai phòng, bao gồm cả chiều ngược lại"""
+        """Lấy khoảng cách ngắn nhất giữa hai phòng (có thể đi qua phòng trung gian)"""
+        return self._get_route(from_room_id, to_room_id)[0]
+
+    @api.model
+    def get_travel_time(self, from_room_id, to_room_id):
+        """Lấy thời gian di chuyển theo đường đi ngắn nhất giữa hai phòng"""
+        return self._get_route(from_room_id, to_room_id)[1]
+
+    @api.model
+    def _get_route(self, from_room_id, to_room_id):
+        """
+        Tra cứu (khoảng cách, thời gian di chuyển) giữa hai phòng trong ma trận
+
+        Cặp phòng không có đường nối dùng khoảng cách mặc định.
+        """
         if from_room_id == to_room_id:
-            return 0.0
-
-        # Tìm bản ghi trực tiếp
-        distance_record = self.search([
-            '|',
-            '&', ('room_from_id', '=', from_room_id), ('room_to_id', '=', to_room_id),
-            '&', ('room_from_id', '=', to_room_id), ('room_to_id', '=', from_room_id)
-        ], limit=1)
-
-        if distance_record:
-            return distance_record.distance
-        else:
-            # Giá trị mặc định nếu không tìm thấy
-            return 5.0
+            return 0.0, 0.0
+        route = self._get_distance_matrix().get(from_room_id, {}).get(to_room_id)
+        return route or (DEFAULT_ROOM_DISTANCE, 0.0)
+
+    @api.model
+    def _get_distance_map(self, room_ids):
+        """
+        Lấy khoảng cách giữa các phòng từ ma trận khoảng cách
+
+        Returns:
+            dict: {(from_room_id, to_room_id): distance}, cặp không có trong dict dùng DEFAULT_ROOM_DISTANCE
+        """
+        matrix = self._get_distance_matrix()
+        room_ids = set(room_ids)
+        return {
+            (from_room_id, to_room_id): route[0]
+            for from_room_id in room_ids
+            for to_room_id, route in matrix.get(from_room_id, {}).items()
+            if to_room_id in room_ids
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _get_distance_matrix(self):
+        """
+        Tính ma trận khoảng cách ngắn nhất giữa mọi cặp phòng
+
+        Mỗi bản ghi khoảng cách là một cạnh hai chiều, đường đi ngắn nhất được tìm
+        bằng Dijkstra từ từng phòng. Kết quả được cache theo registry và xóa khi
+        bản ghi khoảng cách thay đổi.
+
+        Returns:
+            dict: {from_room_id: {to_room_id: (distance, travel_time)}}
+        """
+        edges = defaultdict(dict)
+        for record in self.sudo().search_fetch([], ['room_from_id', 'room_to_id', 'distance', 'travel_time']):
+            from_id, to_id = record.room_from_id.id, record.room_to_id.id
+            edge = (record.distance, record.travel_time or 0.0)
+            # Chiều khai báo trực tiếp được ưu tiên hơn chiều ngược lại
+            edges[from_id][to_id] = edge
+            edges[to_id].setdefault(from_id, edge)
+
+        matrix = {}
+        for source_id in edges:
+            routes = {source_id: (0.0, 0.0)}
+            heap = [(0.0, 0.0, source_id)]
+            while heap:
+                distance, travel_time, room_id = heapq.heappop(heap)
+                if routes[room_id] < (distance, travel_time):
+                    continue
+                for next_id, (edge_distance, edge_time) in edges[room_id].items():
+                    route = (distance + edge_distance, travel_time + edge_time)
+                    if next_id not in routes or route < routes[next_id]:
+                        routes[next_id] = route
+                        heapq.heappush(heap, (*route, next_id))
+            del routes[source_id]
+            matrix[source_id] = routes
+        return matrix
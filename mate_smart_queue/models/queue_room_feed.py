@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import json
+
+from odoo import models, fields, api, _
+
+HR_DEPARTMENT = 'hr.department'
+MATE_QUEUE_TOKEN = "mate.queue.token"
+MATE_QUEUE_ROOM_LOAD = 'mate.queue.room.load'
+MATE_QUEUE_ROOM_FEED = 'mate.queue.room.feed'
+
+# Thuộc tính của token được so sánh để tạo diff cho màn hình hiển thị
+# (thời gian chờ từng token được màn hình tự tính từ position * wait_per_position)
+FEED_TOKEN_FIELDS = ('id', 'name', 'position', 'emergency')
+FEED_RETENTION_HOURS = 24
+
+# Khóa lưu các phòng cần thông báo cho màn hình trong giao dịch hiện tại (cr.precommit.data)
+ROOM_NOTIFY_KEY = 'mate_smart_queue.rooms_to_notify'
+
+
+class QueueRoomFeed(models.Model):
+    """
+    Nhật ký thay đổi hàng đợi của phòng cho màn hình hiển thị
+
+    Mỗi lần hàng đợi của phòng thay đổi, revision của phòng (lưu trên snapshot tải phòng)
+    tăng lên một và danh sách thay đổi (insert / move / state / remove / update) được ghi lại.
+    Màn hình nhận diff qua bus, khi mất kết nối thì lấy các thay đổi kể từ revision đã có.
+    """
+    _name = MATE_QUEUE_ROOM_FEED
+    _description = _('Room Queue Feed')
+    _order = 'room_id, revision'
+    _log_access = False
+
+    room_id = fields.Many2one(HR_DEPARTMENT, string=_('Room'), required=True, ondelete='cascade')
+    revision = fields.Integer(string=_('Revision'), required=True)
+    changes = fields.Json(string=_('Changes'))
+    published_at = fields.Datetime(string=_('Published At'), default=fields.Datetime.now, index=True)
+
+    _sql_constraints = [
+        ('room_revision_uniq', 'unique(room_id, revision)', _('Room queue revision must be unique!'))
+    ]
+
+    @api.model
+    def _publish(self, snapshots):
+        """
+        Tăng revision, tính diff so với lần phát trước và ghi nhật ký cho các phòng
+
+        Args:
+            snapshots: {room_id: snapshot} từ mate.queue.token._get_room_queue_snapshots
+
+        Returns:
+            dict: {room_id: thông điệp bus gồm revision, base_revision, thông tin phòng và changes}
+        """
+        if not snapshots:
+            return {}
+
+        load_model = self.env[MATE_QUEUE_ROOM_LOAD]
+        load_model.flush_model(['revision', 'queue_state'])
+        # Khóa dòng snapshot của phòng để các giao dịch đồng thời phát revision tuần tự
+        self.env.cr.execute(f"""
+            UPDATE {load_model._table}
+               SET revision = COALESCE(revision, 0) + 1
+             WHERE room_id IN %s
+         RETURNING room_id, revision, queue_state
+        """, [tuple(snapshots)])
+        published = {room_id: (revision, queue_state or []) for room_id, revision, queue_state in self.env.cr.fetchall()}
+        load_model.invalidate_model(['revision', 'queue_state'])
+
+        # Token rời khỏi hàng chờ: còn trong phòng thì là đổi trạng thái, ngược lại là bị xóa khỏi hàng
+        left_ids = set()
+        for room_id, (_revision, previous) in published.items():
+            current_ids = {token['id'] for token in snapshots[room_id]['tokens']}
+            left_ids.update(token['id'] for token in previous if token['id'] not in current_ids)
+        left_tokens = self.env[MATE_QUEUE_TOKEN].browse(left_ids).exists()
+        left_states = {token.id: (token.room_id.id, token.state) for token in left_tokens}
+
+        messages, feed_vals, states = {}, [], []
+        for room_id, (revision, previous) in published.items():
+            snapshot = snapshots[room_id]
+            current = [{key: token[key] for key in FEED_TOKEN_FIELDS} for token in snapshot['tokens']]
+            changes = self._diff_tokens(previous, current, room_id, left_states)
+            messages[room_id] = {
+                'room_id': room_id,
+                'revision': revision,
+                'base_revision': revision - 1,
+                'queue_length': snapshot['queue_length'],
+                'in_progress_count': snapshot['in_progress_count'],
+                'estimated_wait_time': snapshot['estimated_wait_time'],
+                'wait_per_position': snapshot['wait_per_position'],
+                'changes': changes,
+            }
+            feed_vals.append({'room_id': room_id, 'revision': revision, 'changes': changes})
+            states.extend([room_id, json.dumps(current)])
+
+        self.env.cr.execute(f"""
+            UPDATE {load_model._table} AS snapshot
+               SET queue_state = state.tokens::jsonb
+              FROM (VALUES {", ".join(["(%s, %s)"] * len(published))}) AS state(room_id, tokens)
+             WHERE snapshot.room_id = state.room_id
+        """, states)
+        load_model.invalidate_model(['queue_state'])
+        self.sudo().create(feed_vals)
+        return messages
+
+    @api.model
+    def _diff_tokens(self, previous, current, room_id, left_states):
+        """So sánh danh sách token trước / sau của phòng, trả về danh sách thay đổi"""
+        previous_by_id = {token['id']: token for token in previous}
+        current_ids = {token['id'] for token in current}
+        changes = []
+        for token in previous:
+            if token['id'] in current_ids:
+                continue
+            token_room_id, state = left_states.get(token['id'], (False, False))
+            if token_room_id == room_id and state:
+                changes.append({'op': 'state', 'id': token['id'], 'state': state})
+            else:
+                changes.append({'op': 'remove', 'id': token['id']})
+        for token in current:
+            old = previous_by_id.get(token['id'])
+            if not old:
+                changes.append({'op': 'insert', 'token': token})
+            elif old['position'] != token['position']:
+                changes.append({'op': 'move', 'id': token['id'], 'position': token['position']})
+            if old and {key: old.get(key) for key in FEED_TOKEN_FIELDS if key != 'position'} != \
+                    {key: token[key] for key in FEED_TOKEN_FIELDS if key != 'position'}:
+                changes.append({'op': 'update', 'token': token})
+        return changes
+
+    @api.model
+    def get_changes_since(self, room_id, revision=0):
+        """
+        Thay đổi hàng đợi của phòng kể từ revision cho màn hình kết nối lại
+
+        Trả về danh sách thay đổi nếu nhật ký còn đủ, ngược lại (revision 0, revision đã bị
+        dọn, hoặc revision lạ) trả về ảnh chụp đầy đủ của hàng đợi.
+
+        Returns:
+            dict: {'room_id', 'revision', 'changes': [...]} hoặc {'room_id', 'revision', 'snapshot': {...}}
+        """
+        room_id, revision = int(room_id), int(revision or 0)
+        load = self.env[MATE_QUEUE_ROOM_LOAD].sudo().search_fetch([('room_id', '=', room_id)], ['revision'], limit=1)
+        current_revision = load.revision
+
+        if revision and revision == current_revision:
+            return {'room_id': room_id, 'revision': current_revision, 'changes': []}
+
+        entries = self.sudo().search_fetch([
+            ('room_id', '=', room_id),
+            ('revision', '>', revision),
+            ('revision', '<=', current_revision),
+        ], ['revision', 'changes']) if 0 < revision < current_revision else self.browse()
+        if entries and len(entries) == current_revision - revision:
+            return {
+                'room_id': room_id,
+                'revision': current_revision,
+                'changes': [change for entry in entries for change in entry.changes],
+            }
+        snapshot = self.env[MATE_QUEUE_TOKEN]._get_room_queue_snapshots([room_id])[room_id]
+        return {'room_id': room_id, 'revision': current_revision, 'snapshot': snapshot}
+
+    @api.model
+    def _cron_prune_feed(self):
+        """Dọn nhật ký thay đổi cũ, màn hình kết nối lại sau thời gian này sẽ nhận ảnh chụp đầy đủ"""
+        self.env.cr.execute(f"""
+            DELETE FROM {self._table}
+             WHERE published_at < NOW() AT TIME ZONE 'UTC' - make_interval(hours => %s)
+        """, [FEED_RETENTION_HOURS])
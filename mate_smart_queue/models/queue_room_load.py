@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from odoo import models, fields, api, _
+
+HR_DEPARTMENT = 'hr.department'
+MATE_QUEUE_ROOM_LOAD = 'mate.queue.room.load'
+MATE_QUEUE_DURATION_STAT = 'mate.queue.duration.stat'
+
+# Khóa trong cache của cursor: ảnh chụp khả dụng điều phối theo dịch vụ
+# (product.product._get_coordination_availability), bị xóa khi tải hoặc trạng thái phòng thay đổi,
+# khi commit và khi rollback
+SERVICE_AVAILABILITY_CACHE_KEY = 'mate_smart_queue.service_availability'
+
+# Khóa trong cr.precommit.data: chênh lệch số token theo phòng chờ ghi vào snapshot khi commit
+ROOM_LOAD_DELTAS_KEY = 'mate_smart_queue.room_load_deltas'
+
+# Trạng thái token được đếm vào snapshot tải phòng: {state: cột}
+ROOM_LOAD_STATES = {
+    'waiting': 'waiting_count',
+    'in_progress': 'in_progress_count',
+}
+
+
+class QueueRoomLoad(models.Model):
+    """
+    Snapshot tải của từng phòng (một dòng / phòng)
+
+    Số token đang chờ / đang phục vụ được cộng trừ dần theo sự kiện của token
+    (tạo, đổi trạng thái, đổi phòng, xóa), tỷ lệ tải và thời gian chờ ước tính
+    được tính lại ngay trong cùng câu SQL. Dashboard và cân bằng tải chỉ cần
+    đọc bảng này bằng một truy vấn theo room_id thay vì đếm lại hàng đợi.
+
+    Dòng snapshot được tạo cùng phòng (và khi cài đặt / trong cron đối soát), không
+    bao giờ khi đọc. Chênh lệch của một giao dịch được gom lại và ghi một lần trước
+    commit, các dòng được khóa theo thứ tự room_id: khóa dòng chỉ được giữ trong lúc
+    commit và hai giao dịch cập nhật cùng nhóm phòng không thể khóa chéo nhau.
+    """
+    _name = MATE_QUEUE_ROOM_LOAD
+    _description = _('Room Load Snapshot')
+    _rec_name = 'room_id'
+
+    room_id = fields.Many2one(HR_DEPARTMENT, string=_('Room'), required=True, index=True, ondelete='cascade')
+    waiting_count = fields.Integer(string=_('Waiting'), default=0)
+    in_progress_count = fields.Integer(string=_('In Progress'), default=0)
+    load_ratio = fields.Float(string=_('Load Ratio'), default=0.0,
+                              help=_("Waiting tokens divided by room capacity"))
+    estimated_wait_time = fields.Float(string=_('Estimated Wait Time (minutes)'), default=0.0)
+    # Revision của hàng đợi phòng và danh sách token đã phát cho màn hình (xem mate.queue.room.feed)
+    revision = fields.Integer(string=_('Queue Revision'), default=0)
+    queue_state = fields.Json(string=_('Published Queue'))
+
+    _sql_constraints = [
+        ('room_uniq', 'unique(room_id)', _('Each room can only have one load snapshot!'))
+    ]
+
+    @api.model
+    def _get_room_loads(self, room_ids):
+        """
+        Đọc snapshot tải của các phòng
+
+        Chênh lệch đang chờ của giao dịch hiện tại được ghi trước để kết quả phản ánh
+        các token vừa thay đổi. Phòng chưa có snapshot (chưa qua cron đối soát) được bỏ qua.
+
+        Returns:
+            dict: {room_id: {'waiting_count', 'in_progress_count', 'load_ratio', 'estimated_wait_time'}}
+        """
+        room_ids = [room_id for room_id in set(room_ids) if room_id]
+        if not room_ids:
+            return {}
+
+        if self.env.cr.precommit.data.get(ROOM_LOAD_DELTAS_KEY):
+            self._flush_token_deltas()
+        fnames = ['room_id', 'waiting_count', 'in_progress_count', 'load_ratio', 'estimated_wait_time']
+        snapshots = self.sudo().search_fetch([('room_id', 'in', room_ids)], fnames)
+
+        return {
+            snapshot.room_id.id: {
+                'waiting_count': snapshot.waiting_count,
+                'in_progress_count': snapshot.in_progress_count,
+                'load_ratio': snapshot.load_ratio,
+                'estimated_wait_time': snapshot.estimated_wait_time,
+            }
+            for snapshot in snapshots
+        }
+
+    @api.model
+    def _queue_token_deltas(self, deltas):
+        """
+        Cộng dồn thay đổi số token vào giao dịch hiện tại, ghi vào snapshot trước commit
+
+        Args:
+            deltas: {room_id: {'waiting_count': +/-n, 'in_progress_count': +/-n}}
+        """
+        precommit = self.env.cr.precommit
+        pending = precommit.data.get(ROOM_LOAD_DELTAS_KEY)
+        if pending is None:
+            pending = precommit.data[ROOM_LOAD_DELTAS_KEY] = defaultdict(lambda: defaultdict(int))
+            precommit.add(self._flush_token_deltas)
+        for room_id, values in deltas.items():
+            for fname, delta in values.items():
+                pending[room_id][fname] += delta
+        self._invalidate_service_availability()
+
+    @api.model
+    def _flush_token_deltas(self):
+        """Ghi các chênh lệch đang chờ của giao dịch vào snapshot"""
+        deltas = self.env.cr.precommit.data.pop(ROOM_LOAD_DELTAS_KEY, None)
+        if deltas:
+            self._apply_token_deltas(deltas)
+
+    @api.model
+    def _lock_room_loads(self, room_ids):
+        """Khóa các dòng snapshot theo thứ tự room_id trước khi cập nhật nhiều phòng"""
+        self.env.cr.execute(f"""
+            SELECT id FROM {self._table}
+             WHERE room_id IN %s
+             ORDER BY room_id
+               FOR NO KEY UPDATE
+        """, [tuple(room_ids)])
+
+    @api.model
+    def _apply_token_deltas(self, deltas):
+        """
+        Cộng dồn thay đổi số token vào snapshot
+
+        Args:
+            deltas: {room_id: {'waiting_count': +/-n, 'in_progress_count': +/-n}}
+
+        Phòng chưa có snapshot được bỏ qua, cron đối soát sẽ dựng lại từ bảng token.
+        """
+        rows = sorted(
+            (room_id, values.get('waiting_count', 0), values.get('in_progress_count', 0))
+            for room_id, values in deltas.items()
+            if room_id and any(values.values())
+        )
+        if not rows:
+            return
+
+        self._lock_room_loads([row[0] for row in rows])
+        self.env.cr.execute(f"""
+            UPDATE {self._table} AS snapshot
+               SET waiting_count = GREATEST(snapshot.waiting_count + delta.waiting, 0),
+                   in_progress_count = GREATEST(snapshot.in_progress_count + delta.in_progress, 0)
+              FROM (VALUES {", ".join(["(%s, %s, %s)"] * len(rows))})
+                   AS delta(room_id, waiting, in_progress)
+             WHERE snapshot.room_id = delta.room_id
+        """, [value for row in rows for value in row])
+        self._refresh_room_metrics([row[0] for row in rows])
+
+    @api.model
+    def _rebuild_room_loads(self, room_ids=None):
+        """
+        Dựng lại snapshot từ bảng token (room_ids=None: tất cả phòng)
+
+        Dùng khi tạo phòng, khi cài đặt và trong cron đối soát định kỳ. Token đã được
+        flush nên chênh lệch đang chờ của các phòng này đã nằm trong số đếm và bị bỏ đi.
+        """
+        self.env['mate.queue.token'].flush_model(['room_id', 'state'])
+        pending = self.env.cr.precommit.data.get(ROOM_LOAD_DELTAS_KEY)
+        if pending:
+            for room_id in (room_ids or list(pending)):
+                pending.pop(room_id, None)
+        room_filter = "WHERE room.id IN %s" if room_ids else ""
+        params = [tuple(room_ids)] if room_ids else []
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} (room_id, waiting_count, in_progress_count,
+                                       create_uid, create_date, write_uid, write_date)
+            SELECT room.id,
+                   COUNT(token.id) FILTER (WHERE token.state = 'waiting'),
+                   COUNT(token.id) FILTER (WHERE token.state = 'in_progress'),
+                   %s, NOW() AT TIME ZONE 'UTC', %s, NOW() AT TIME ZONE 'UTC'
+              FROM hr_department room
+              LEFT JOIN mate_queue_token token ON token.room_id = room.id
+              {room_filter}
+             GROUP BY room.id
+             ORDER BY room.id
+            ON CONFLICT (room_id) DO UPDATE
+               SET waiting_count = EXCLUDED.waiting_count,
+                   in_progress_count = EXCLUDED.in_progress_count
+            RETURNING room_id
+        """, [self.env.uid, self.env.uid, *params])
+        self._refresh_room_metrics([row[0] for row in self.env.cr.fetchall()])
+
+    @api.model
+    def _refresh_room_metrics(self, room_ids):
+        """
+        Tính lại tỷ lệ tải và thời gian chờ ước tính của snapshot
+
+        Công thức giống mate.queue.token._estimate_wait_times:
+        số người đợi * thời gian phục vụ ước tính / công suất phòng (tối thiểu 1),
+        thời gian phục vụ lấy theo mate.queue.duration.stat (trung bình, EWMA, P50 hoặc P90)
+        """
+        if not room_ids:
+            return
+        rooms = self.env[HR_DEPARTMENT].browse(sorted(set(room_ids)))
+        durations = self.env[MATE_QUEUE_DURATION_STAT]._get_duration_estimates(
+            (room.service_id, room) for room in rooms)
+        rows = [(room.id, durations.get((room.service_id.id, room.id), 0.0), room.capacity or 1) for room in rooms]
+        self._lock_room_loads(rooms.ids)
+        self.env.cr.execute(f"""
+            UPDATE {self._table} AS snapshot
+               SET load_ratio = snapshot.waiting_count::float / GREATEST(room.capacity, 1),
+                   estimated_wait_time = snapshot.waiting_count * room.duration / GREATEST(room.capacity, 1),
+                   write_uid = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM (VALUES {", ".join(["(%s, %s::float, %s)"] * len(rows))}) AS room(id, duration, capacity)
+             WHERE room.id = snapshot.room_id
+        """, [self.env.uid, *[value for row in rows for value in row]])
+        self.invalidate_model()
+        self._invalidate_service_availability()
+
+    @api.model
+    def _get_service_availability_cache(self):
+        """
+        Cache khả dụng điều phối của cursor hiện tại
+
+        cr.cache không bị xóa khi rollback (retrying() chạy lại request trên cùng cursor),
+        nên cache được đăng ký xóa sau commit và sau rollback ngay khi được tạo.
+        """
+        cr = self.env.cr
+        cache = cr.cache.get(SERVICE_AVAILABILITY_CACHE_KEY)
+        if cache is None:
+            cache = cr.cache[SERVICE_AVAILABILITY_CACHE_KEY] = {}
+            cr.postcommit.add(self._invalidate_service_availability)
+            cr.postrollback.add(self._invalidate_service_availability)
+        return cache
+
+    @api.model
+    def _invalidate_service_availability(self):
+        """Xóa cache khả dụng điều phối, lần đọc sau sẽ tính lại"""
+        self.env.cr.cache.pop(SERVICE_AVAILABILITY_CACHE_KEY, None)
+
+    @api.model
+    def _cron_rebuild_room_loads(self):
+        """Đối soát toàn bộ snapshot với bảng token"""
+        self._rebuild_room_loads()
@@ -2,10 +2,14 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
 
+from .queue_profiling import profiled
+
 HIS_PATIENT = 'his.patient'
 MATE_QUEUE_TOKEN = "mate.queue.token"
 HR_DEPARTMENT = 'hr.department'
 PRODUCT_PRODUCT = 'product.product'
+QUEUE_ROOM_DISTANCE = 'queue.room.distance'
+MATE_QUEUE_DURATION_STAT = 'mate.queue.duration.stat'
 
 MATE_QUEUE_ROOM_SELECTION_WIRARD = 'mate.queue.room.selection.wizard'
 MATE_QUEUE_ROOM_SELECTION_LINE = 'mate.queue.room.selection.line'
@@ -75,66 +79,76 @@ class QueueRoomSelectionWizard(models.TransientModel):
         if not available_rooms:
             return
 
-        # Find least loaded room
-        least_loaded_room = self._find_least_loaded_room(available_rooms)
+        # Số người chờ, số ưu tiên và thời gian chờ của tất cả phòng bằng một truy vấn gộp
+        queue_info = self._get_rooms_queue_info(available_rooms)
+        current_room_id = self.current_room_id._origin.id
+        distance_model = self.env[QUEUE_ROOM_DISTANCE]
+        routes = {
+            room.id: distance_model._get_route(current_room_id, room.id) if current_room_id else (0.0, 0.0)
+            for room in available_rooms
+        }
+
+        # Find least loaded room (gần phòng hiện tại hơn khi tải bằng nhau)
+        least_loaded_room = min(available_rooms, key=lambda room: (
+            queue_info[room.id]['waiting_count'] / room.capacity if room.capacity > 0 else float('inf'),
+            routes[room.id][1],
+            routes[room.id][0],
+        ))
 
         # Create lines for each room
         lines = []
         for room in available_rooms:
-            queue_info = self._get_room_queue_info(room)
-
             line_vals = {
                 'room_id': room.id,
-                'waiting_count': queue_info['waiting_count'],
-                'estimated_wait_time': queue_info['estimated_wait_time'],
-                'is_current': room.id == self.current_room_id.id if self.current_room_id else False,
-                'is_recommended': room.id == least_loaded_room.id if least_loaded_room else False,
+                'waiting_count': queue_info[room.id]['waiting_count'],
+                'priority_count': queue_info[room.id]['priority_count'],
+                'estimated_wait_time': queue_info[room.id]['estimated_wait_time'],
+                'distance': routes[room.id][0],
+                'travel_time': routes[room.id][1],
+                'is_current': room.id == current_room_id,
+                'is_recommended': room == least_loaded_room,
             }
             lines.append((0, 0, line_vals))
 
         self.room_line_ids = lines
 
-    def _find_least_loaded_room(self, rooms):
-        """Find room with least load"""
-        least_loaded_room = None
-        min_load = float('inf')
-
+    def _get_rooms_queue_info(self, rooms):
+        """
+        Get real-time queue info for rooms
+
+        Một truy vấn gộp theo phòng cho số token đang chờ và số token ưu tiên
+        (khẩn cấp hoặc mức ưu tiên > 5); thời gian chờ = số người chờ * thời gian phục vụ
+        ước tính / công suất phòng, cùng công thức với snapshot tải phòng.
+
+        Returns:
+            dict: {room_id: {'waiting_count', 'priority_count', 'estimated_wait_time'}}
+        """
+        token_model = self.env[MATE_QUEUE_TOKEN]
+        token_model.flush_model(['room_id', 'state', 'emergency', 'priority'])
+        self.env.cr.execute(f"""
+            SELECT room_id,
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE COALESCE(emergency, FALSE) OR COALESCE(priority, 0) > 5)
+              FROM {token_model._table}
+             WHERE room_id IN %s AND state = 'waiting'
+             GROUP BY room_id
+        """, [tuple(rooms.ids)])
+        counts = {room_id: (waiting, priority) for room_id, waiting, priority in self.env.cr.fetchall()}
+        durations = self.env[MATE_QUEUE_DURATION_STAT]._get_duration_estimates(
+            (room.service_id, room) for room in rooms)
+
+        result = {}
         for room in rooms:
-            waiting_count = self.env[MATE_QUEUE_TOKEN].search_count([
-                ('room_id', '=', room.id),
-                ('state', '=', 'waiting')
-            ])
-
-            load_ratio = waiting_count / room.capacity if room.capacity > 0 else float('inf')
-
-            if load_ratio < min_load:
-                min_load = load_ratio
-                least_loaded_room = room
-
-        return least_loaded_room
-
-    def _get_room_queue_info(self, room):
-        """Get real-time queue info for room"""
-        waiting_tokens = self.env[MATE_QUEUE_TOKEN].search([
-            ('room_id', '=', room.id),
-            ('state', '=', 'waiting')
-        ])
-
-        waiting_count = len(waiting_tokens)
-
-        # Calculate estimated wait time
-        if waiting_count == 0:
-            estimated_wait_time = 0
-        else:
-            # Simple estimation: count * average service duration
-            avg_duration = room.service_id.average_duration or 15  # default 15 minutes
-            estimated_wait_time = waiting_count * avg_duration
-
-        return {
-            'waiting_count': waiting_count,
-            'estimated_wait_time': estimated_wait_time
-        }
+            waiting_count, priority_count = counts.get(room.id, (0, 0))
+            duration = durations.get((room.service_id.id, room.id), 0.0)
+            result[room.id] = {
+                'waiting_count': waiting_count,
+                'priority_count': priority_count,
+                'estimated_wait_time': waiting_count * duration / (room.capacity or 1),
+            }
+        return result
 
+    @profiled('coordinate_room')
     def action_coordinate(self):
         """Thực hiện điều phối chuyển phòng"""
         if not self.selected_room_id:
@@ -167,6 +181,9 @@ class QueueRoomSelectionLine(models.TransientModel):
     wizard_id = fields.Many2one(MATE_QUEUE_ROOM_SELECTION_WIRARD, string=_('Wizard'), ondelete='cascade')
     room_id = fields.Many2one(HR_DEPARTMENT, string=_('Room'), required=True)
     waiting_count = fields.Integer(string=_('Waiting Count'))
+    priority_count = fields.Integer(string=_('Priority Count'))
+    distance = fields.Float(string=_('Distance'), help=_("Distance from the patient's current room"))
+    travel_time = fields.Float(string=_('Travel Time (minutes)'))
     estimated_wait_time = fields.Float(string=_('Estimated Wait Time (minutes)'))
     is_current = fields.Boolean(string=_('Current Room'))
     is_recommended = fields.Boolean(string=_('Recommended'))
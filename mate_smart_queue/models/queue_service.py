@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from collections import defaultdict, namedtuple
+import logging
+
+from odoo import models, fields, api, tools, _
+from odoo.tools.safe_eval import safe_eval, test_python_expr
+
+_logger = logging.getLogger(__name__)
 
 PRODUCT_PRODUCT = 'product.product'
 HR_DEPARTMENT = 'hr.department'
-HIS_PATIENT = 'his.patient'
 
 MATE_HEALTH_CHECK_GROUP = "mate.health.check.group"
 MATE_HEALTH_CHECK_PACKAGE = 'mate.health.check.package'
@@ -11,8 +16,104 @@ MATE_HEALTH_CHECK_PACKAGE = 'mate.health.check.package'
 MATE_QUEUE_SERVICE_GROUP_ROUTE = "mate.queue.service.group.route"
 MATE_QUEUE_SERVICE_ROUTE = "mate.queue.service.route"
 
+MATE_QUEUE_ROOM_LOAD = 'mate.queue.room.load'
+
 IR_ACTIONS_CLIENT = "ir.actions.client"
 
+# Một dòng trong bảng định tuyến: condition là biểu thức đã kiểm tra cú pháp (hoặc None)
+CompiledRoute = namedtuple('CompiledRoute', ['id', 'to_id', 'package_id', 'condition'])
+
+
+def _compile_route_condition(route):
+    """
+    Kiểm tra trước điều kiện của tuyến đường khi dựng bảng định tuyến
+
+    Điều kiện sai cú pháp hoặc dùng opcode không an toàn được ghi log một lần
+    và thay bằng 'False' thay vì báo lỗi ở mỗi lần đánh giá.
+    """
+    condition = (route.condition or '').strip()
+    if not condition:
+        return None
+    error = test_python_expr(condition, mode='eval')
+    if error:
+        _logger.error("Điều kiện tuyến đường %s không hợp lệ: %s", route.id, error)
+        return 'False'
+    return condition
+
+
+def _build_routing_table(routes, from_field, to_field):
+    """Dựng bảng định tuyến {from_id: (CompiledRoute, ...)} theo thứ tự sequence"""
+    table = defaultdict(list)
+    for route in routes:
+        table[route[from_field].id].append(CompiledRoute(
+            route.id, route[to_field].id, route.package_id.id, _compile_route_condition(route)))
+    return {from_id: tuple(entries) for from_id, entries in table.items()}
+
+
+def _check_compiled_condition(route, eval_context):
+    """Đánh giá điều kiện bằng safe_eval, lỗi được coi như điều kiện không thỏa"""
+    try:
+        return safe_eval(route.condition, dict(eval_context))
+    except Exception as e:
+        # Ghi log lỗi nhưng không làm gián đoạn luồng
+        _logger.error("Lỗi khi đánh giá điều kiện tuyến: %s", e)
+        return False
+
+
+def _select_route(routes, package_id=False, eval_context=None):
+    """
+    Chọn tuyến đường từ danh sách tuyến (đã sắp theo sequence)
+
+    1. Tuyến dành riêng cho gói dịch vụ
+    2. Không có eval_context: tuyến chung (không gắn gói);
+       có eval_context: tuyến đầu tiên không có điều kiện hoặc thỏa điều kiện
+    3. Tuyến đầu tiên
+    """
+    if not routes:
+        return None
+    if package_id:
+        for route in routes:
+            if route.package_id == package_id:
+                return route
+    if eval_context is None:
+        for route in routes:
+            if not route.package_id:
+                return route
+    else:
+        for route in routes:
+            if route.condition is None or _check_compiled_condition(route, eval_context):
+                return route
+    return routes[0]
+
+
+class RouteTableMixin(models.AbstractModel):
+    """
+    Cache bảng định tuyến theo registry, xóa khi tuyến đường thay đổi
+
+    Chỉ các trường có trong bảng định tuyến (_route_table_fields) mới làm xóa cache khi ghi:
+    registry.clear_cache() buộc mọi worker dựng lại toàn bộ cache ormcache.
+    """
+    _name = 'mate.queue.route.table.mixin'
+    _description = _('Route Table Mixin')
+    _route_table_fields = {'package_id', 'condition', 'sequence', 'active'}
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if self._route_table_fields.intersection(vals):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
 
 class QueueService(models.Model):
     _description = _('Medical Service')
@@ -56,58 +157,119 @@ class QueueService(models.Model):
 
     @api.depends('rooms_ids.state')
     def _compute_coordination_display_info(self):
-        """Compute coordination display info for list view"""
+        """
+        Compute coordination display info for list view
+
+        Thông tin chỉ phụ thuộc dịch vụ (không phụ thuộc bệnh nhân đang mở), nên mọi dòng
+        được tính một lần từ ảnh chụp khả dụng dùng chung với his.patient.
+
+        Khóa 'patient_id' trong context được bỏ qua có chủ đích: nó chỉ do nút "Coordinate"
+        truyền cho server action, và his.patient.get_service_coordination_info trả về cùng
+        ảnh chụp theo dịch vụ cho mọi bệnh nhân nên kết quả không thay đổi theo bệnh nhân.
+        """
+        # Không đọc self.env.context.get('patient_id'), xem docstring
+        availability = self._origin._get_coordination_availability()
         for service in self:
-            # Tìm patient từ available_coordination_service_ids relationship
-            patient = self.env[HIS_PATIENT].search([
-                ('available_coordination_service_ids', 'in', service.id),
-            ], limit=1)
-
-            if patient:
-                service_info = patient.get_service_coordination_info(service.id)
-
-                if service_info.get('available', False):
-                    service.available_rooms_count = len(service.rooms_ids.filtered(lambda r: r.state == 'open'))
-                    service.suggested_room_name = service_info.get('recommended_room', '')
-                    service.waiting_queue_count = service_info.get('queue_length', 0)
-                    service.estimated_wait_time = service_info.get('estimated_wait', 0)
+            service_info = availability.get(service._origin.id, {})
+            service.available_rooms_count = service_info.get('room_count', 0)
+            service.suggested_room_name = service_info.get('recommended_room') or _('No available rooms')
+            service.waiting_queue_count = service_info.get('queue_length', 0)
+            service.estimated_wait_time = service_info.get('estimated_wait', 0)
+
+    def _get_coordination_availability(self):
+        """
+        Ảnh chụp khả dụng điều phối của các dịch vụ: phòng mở, phòng đề xuất (ít tải nhất),
+        số người đang chờ và thời gian chờ ước tính của phòng đề xuất
+
+        Tính một lần cho tất cả dịch vụ còn thiếu (một truy vấn phòng, một truy vấn snapshot tải)
+        và dùng chung trong request cho mọi bệnh nhân cho tới khi tải hoặc trạng thái phòng thay đổi.
+
+        Returns:
+            dict: {service_id: {'available', 'service_name', 'room_count', 'recommended_room_id',
+                                'recommended_room', 'queue_length', 'estimated_wait', 'wait_color'}}
+        """
+        cache = self.env[MATE_QUEUE_ROOM_LOAD]._get_service_availability_cache()
+        missing = self.browse([service_id for service_id in self.ids if service_id not in cache])
+        if missing:
+            rooms = self.env[HR_DEPARTMENT].search_fetch([
+                ('service_id', 'in', missing.ids),
+                ('state', '=', 'open')
+            ], ['service_id', 'name', 'capacity'], order='id')
+            loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(rooms.ids)
+            rooms_by_service = defaultdict(list)
+            for room in rooms:
+                rooms_by_service[room.service_id.id].append(room)
+
+            for service in missing:
+                service_rooms = rooms_by_service[service.id]
+                if not service_rooms:
+                    cache[service.id] = {
+                        'available': False,
+                        'message': _('No available rooms'),
+                        'room_count': 0,
+                        'queue_length': 0,
+                        'estimated_wait': 0
+                    }
+                    continue
+
+                room = min(service_rooms, key=lambda r: (loads.get(r.id, {}).get('load_ratio', 0.0), r.id))
+                load = loads.get(room.id, {})
+                wait = load.get('estimated_wait_time', 0.0)
+
+                # Xác định màu thời gian chờ
+                if wait < 25:
+                    wait_color = 'success'
+                elif wait <= 45:
+                    wait_color = 'warning'
                 else:
-                    service.available_rooms_count = 0
-                    service.suggested_room_name = _('No available rooms')
-                    service.waiting_queue_count = 666666
-                    service.estimated_wait_time = 0.0
-            else:
-                # Default values when no patient found
-                open_rooms = service.rooms_ids.filtered(lambda r: r.state == 'open')
-                service.available_rooms_count = len(open_rooms)
-                service.suggested_room_name = open_rooms[0].name if open_rooms else _('None')
-                service.waiting_queue_count = 999999
-                service.estimated_wait_time = 0.0
+                    wait_color = 'danger'
+
+                cache[service.id] = {
+                    'available': True,
+                    'service_name': service.name,
+                    'room_count': len(service_rooms),
+                    'recommended_room_id': room.id,
+                    'recommended_room': room.name,
+                    'queue_length': load.get('waiting_count', 0),
+                    'estimated_wait': int(wait),
+                    'wait_color': wait_color,
+                }
+        return {service_id: cache[service_id] for service_id in self.ids}
 
     def _update_average_duration(self, duration):
         """
         Cập nhật thời gian trung bình của dịch vụ
 
         Tham số:
-            duration (float): Thời gian thực tế của lần phục vụ mới (phút)
+            duration (float | list): Thời gian thực tế của lần phục vụ mới (phút),
+                hoặc danh sách thời gian khi hoàn thành nhiều lượt cùng lúc
         """
+        durations = duration if isinstance(duration, (list, tuple)) else [duration]
+        if not durations:
+            return
+
         for service in self:
             current_avg = service.average_duration
             current_count = service.duration_count
 
-            # Tính trung bình cộng theo công thức: ((avg_cũ * số_lượt_cũ) + giá_trị_mới) / (số_lượt_cũ + 1)
-            new_count = current_count + 1
-            new_avg = ((current_avg * current_count) + duration) / new_count
+            # Tính trung bình cộng theo công thức: ((avg_cũ * số_lượt_cũ) + tổng_giá_trị_mới) / (số_lượt_cũ + n)
+            new_count = current_count + len(durations)
+            new_avg = ((current_avg * current_count) + sum(durations)) / new_count
 
             service.write({
                 'average_duration': new_avg,
                 'duration_count': new_count
             })
 
+        # Thời gian chờ ước tính trong snapshot tải phòng phụ thuộc thời gian trung bình
+        self.env['mate.queue.room.load']._refresh_room_metrics(self.rooms_ids.ids)
+
 
 class QueueServiceGroupRoute(models.Model):
     _name = MATE_QUEUE_SERVICE_GROUP_ROUTE
+    _inherit = ['mate.queue.route.table.mixin']
     _description = _('Service Group Route')
+    _route_table_fields = {'group_from_id', 'group_to_id', 'package_id', 'condition', 'sequence', 'active'}
 
     name = fields.Char(string=_('Route Name'), compute='_compute_name', store=True)
     group_from_id = fields.Many2one(MATE_HEALTH_CHECK_GROUP, string=_('From Service Group'), required=True)
@@ -187,6 +349,18 @@ class QueueServiceGroupRoute(models.Model):
                 }
             }
 
+    @api.model
+    @tools.ormcache()
+    def _get_routing_table(self):
+        """Bảng định tuyến {group_from_id: (CompiledRoute, ...)}, cache theo registry"""
+        routes = self.sudo().search([], order='sequence, id')
+        return _build_routing_table(routes, 'group_from_id', 'group_to_id')
+
+    @api.model
+    def _resolve_route(self, from_group_id, package_id=False):
+        """Chọn tuyến đường từ nhóm dịch vụ, không truy vấn khi bảng định tuyến đã được cache"""
+        return _select_route(self._get_routing_table().get(from_group_id, ()), package_id)
+
     def _check_route_loop(self, from_group_id, to_group_id):
         """
         Kiểm tra xem việc tạo tuyến đường này có tạo vòng lặp không
@@ -211,7 +385,9 @@ class QueueServiceRoute(models.Model):
     Ví dụ: Sau khi Đăng Ký -> đi tới Đo Dấu Hiệu Sinh Tồn -> đi tới Xét Nghiệm...
     """
     _name = MATE_QUEUE_SERVICE_ROUTE
+    _inherit = ['mate.queue.route.table.mixin']
     _description = _('Service Route')
+    _route_table_fields = {'service_from_id', 'service_to_id', 'package_id', 'condition', 'sequence', 'active'}
 
     name = fields.Char(string=_('Route Name'), compute='_compute_name', store=True)
     service_from_id = fields.Many2one(PRODUCT_PRODUCT, string=_('From Service'), required=True)
@@ -231,3 +407,25 @@ class QueueServiceRoute(models.Model):
                 route.name = f"{route.service_from_id.name} → {route.service_to_id.name}"
             else:
                 route.name = _("New Route")
+
+    @api.model
+    @tools.ormcache()
+    def _get_routing_table(self):
+        """Bảng định tuyến {service_from_id: (CompiledRoute, ...)}, cache theo registry"""
+        routes = self.sudo().search([], order='sequence, id')
+        return _build_routing_table(routes, 'service_from_id', 'service_to_id')
+
+    @api.model
+    def _resolve_route(self, from_service_id, package_id=False, eval_context=None):
+        """
+        Chọn tuyến đường từ dịch vụ, không truy vấn khi bảng định tuyến đã được cache
+
+        Args:
+            from_service_id: ID dịch vụ hiện tại
+            package_id: ID gói dịch vụ (ưu tiên tuyến của gói)
+            eval_context: dict biến cho điều kiện tuyến, None để bỏ qua điều kiện
+
+        Returns:
+            CompiledRoute hoặc None nếu không có tuyến đường
+        """
+        return _select_route(self._get_routing_table().get(from_service_id, ()), package_id, eval_context)
@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from datetime import date
+import heapq
+import logging
+import math
+import random
+import time
+
+from dateutil.relativedelta import relativedelta
+from markupsafe import Markup
+
+from odoo import models, fields, api, Command, SUPERUSER_ID, _
+from odoo.exceptions import UserError
+from odoo.modules.registry import Registry
+from odoo.tools import html_escape
+
+from .queue_duration_stat import ANY_BUCKET, DURATION_MIN_SAMPLES
+
+_logger = logging.getLogger(__name__)
+
+HR_DEPARTMENT = 'hr.department'
+PRODUCT_PRODUCT = 'product.product'
+HIS_PATIENT = 'his.patient'
+MATE_HEALTH_CHECK_PACKAGE = 'mate.health.check.package'
+MATE_QUEUE_TOKEN = "mate.queue.token"
+MATE_QUEUE_PRIORITY = "mate.queue.priority"
+MATE_QUEUE_DURATION_STAT = 'mate.queue.duration.stat'
+MATE_QUEUE_SIMULATION = 'mate.queue.simulation'
+
+# Thuộc tính bệnh nhân mô phỏng theo mã loại ưu tiên (mate.queue.priority.code),
+# _calculate_priority của token sẽ tính lại đúng mức ưu tiên từ các thuộc tính này
+PRIORITY_PATIENT_VALUES = {
+    'elderly': {'age_years': 70},
+    'special': {'is_pregnant': True},
+    'urgent': {'has_urgent_condition': True},
+    'vip': {'is_vip': True},
+    'doctor': {'doctor_assigned_priority': True},
+    'emergency': {'emergency': True},
+}
+SIMULATION_ADULT_AGE = 35
+
+# Thuộc tính bệnh nhân được chép lại khi phát lại luồng đến đã ghi nhận
+RECORDED_PATIENT_FIELDS = ('date_of_birth', 'is_pregnant', 'is_disabled', 'has_urgent_condition', 'is_vip',
+                           'doctor_assigned_priority')
+
+# Phân vị 90% của phân phối chuẩn, dùng để suy ra độ lệch của phân phối log-normal từ P50 / P90
+NORMAL_Z90 = 1.2816
+
+# Tham số hệ thống: tên cơ sở dữ liệu (bản sao của dữ liệu thật) dùng để chạy mô phỏng
+SIMULATION_DATABASE_PARAM = 'mate_smart_queue.simulation_database'
+
+# Cấu hình được chép sang bản ghi mô phỏng trong cơ sở dữ liệu mô phỏng
+SIMULATION_SETTING_FIELDS = ('name', 'arrival_source', 'seed', 'patient_count', 'arrival_rate', 'priority_ratio',
+                             'date_from', 'date_to', 'service_time_cv', 'balancing_interval', 'max_duration')
+
+
+def _percentile(values, quantile):
+    """Phân vị theo thứ hạng gần nhất của danh sách giá trị"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(quantile * len(values)) - 1))]
+
+
+class QueueSimulation(models.Model):
+    """
+    Mô phỏng sự kiện rời rạc và benchmark hàng đợi
+
+    Luồng bệnh nhân đến (sinh ngẫu nhiên theo gói khám / loại ưu tiên, hoặc phát lại
+    các lượt đến đã ghi nhận) được chạy qua vòng đời token thật: tạo token (chỉ định phòng),
+    bắt đầu, hoàn thành (định tuyến dịch vụ tiếp theo) và cân bằng tải định kỳ. Đồng hồ
+    mô phỏng tính bằng phút, thời gian phục vụ lấy mẫu theo phân phối của từng dịch vụ.
+
+    Mô phỏng không bao giờ chạy trên cơ sở dữ liệu đang dùng: vòng đời token khóa và sửa
+    token / phòng thật, tiêu số thứ tự. Nó chạy trên một bản sao riêng (tham số hệ thống
+    mate_smart_queue.simulation_database) qua một cursor riêng luôn được rollback,
+    chỉ báo cáo được lưu lại ở cơ sở dữ liệu hiện tại để so sánh giữa các phiên bản.
+    """
+    _name = MATE_QUEUE_SIMULATION
+    _description = _('Queue Simulation')
+    _order = 'id desc'
+
+    name = fields.Char(string=_('Name'), required=True, default=lambda self: _('Simulation'))
+    state = fields.Selection([
+        ('draft', _('Draft')),
+        ('done', _('Done')),
+    ], string=_('Status'), default='draft', required=True)
+    arrival_source = fields.Selection([
+        ('synthetic', _('Synthetic')),
+        ('recorded', _('Recorded')),
+    ], string=_('Arrival Stream'), default='synthetic', required=True)
+    seed = fields.Integer(string=_('Random Seed'), default=42,
+                          help=_("Same seed and settings give the same arrival stream and service times"))
+
+    # Luồng đến sinh ngẫu nhiên
+    patient_count = fields.Integer(string=_('Patients'), default=100)
+    arrival_rate = fields.Float(string=_('Arrivals per Hour'), default=60.0)
+    package_ids = fields.Many2many(MATE_HEALTH_CHECK_PACKAGE, string=_('Packages'),
+                                   help=_("Packages assigned to synthetic patients, all packages when empty"))
+    priority_ratio = fields.Float(string=_('Priority Patient Ratio'), default=0.1,
+                                  help=_("Share of synthetic patients drawn from non-normal priority types"))
+
+    # Phát lại luồng đến đã ghi nhận
+    date_from = fields.Datetime(string=_('Recorded From'))
+    date_to = fields.Datetime(string=_('Recorded To'))
+
+    service_time_cv = fields.Float(string=_('Service Time Variation'), default=0.5,
+                                   help=_("Coefficient of variation of service times when a service has no "
+                                          "duration statistics"))
+    balancing_interval = fields.Integer(string=_('Load Balancing Interval (minutes)'), default=5,
+                                        help=_("0 disables load balancing during the simulation"))
+    max_duration = fields.Float(string=_('Max Simulated Hours'), default=24.0)
+
+    # Kết quả
+    version = fields.Char(string=_('Module Version'), readonly=True)
+    wall_time = fields.Float(string=_('Wall Time (seconds)'), readonly=True)
+    query_count = fields.Integer(string=_('Queries'), readonly=True)
+    throughput = fields.Float(string=_('Throughput (patients/hour)'), readonly=True)
+    mean_wait = fields.Float(string=_('Mean Wait (minutes)'), readonly=True)
+    p95_wait = fields.Float(string=_('P95 Wait (minutes)'), readonly=True)
+    report = fields.Json(string=_('Report'), readonly=True)
+    report_html = fields.Html(string=_('Report'), compute='_compute_report_html', sanitize=False)
+
+    @api.depends('report')
+    def _compute_report_html(self):
+        for simulation in self:
+            simulation.report_html = simulation._render_report(simulation.report) if simulation.report else False
+
+    def action_run(self):
+        """Chạy mô phỏng và lưu báo cáo"""
+        for simulation in self:
+            report = simulation._run_simulation()
+            simulation.write({
+                'state': 'done',
+                'version': report['version'],
+                'wall_time': report['wall_time'],
+                'query_count': report['query_count'],
+                'throughput': report['throughput'],
+                'mean_wait': report['mean_wait'],
+                'p95_wait': report['p95_wait'],
+                'report': report,
+            })
+
+    def _run_simulation(self):
+        """
+        Chạy mô phỏng trên cơ sở dữ liệu mô phỏng rồi rollback
+
+        Returns:
+            dict: báo cáo (xem _build_report)
+        """
+        self.ensure_one()
+        registry = self._get_simulation_registry()
+        cr = registry.cursor()
+        try:
+            env = api.Environment(cr, SUPERUSER_ID, {'lang': self.env.lang})
+            simulation = env[MATE_QUEUE_SIMULATION].new(self._get_simulation_values())
+            report = simulation._simulate()
+        finally:
+            # Không commit: mọi token, bệnh nhân và callback sau commit của lần chạy bị hủy
+            cr.rollback()
+            cr.close()
+
+        _logger.info("Mô phỏng hàng đợi %s: %.1f bệnh nhân/giờ, chờ TB %.1f phút, P95 %.1f phút, %d truy vấn, %.2f giây",
+                     self.name, report['throughput'], report['mean_wait'], report['p95_wait'],
+                     report['query_count'], report['wall_time'])
+        return report
+
+    def _get_simulation_registry(self):
+        """Registry của cơ sở dữ liệu mô phỏng, phải khác cơ sở dữ liệu hiện tại và đã cài module"""
+        dbname = self.env['ir.config_parameter'].sudo().get_param(SIMULATION_DATABASE_PARAM)
+        if not dbname:
+            raise UserError(_("Please set the system parameter %s to a copy of this database to run simulations.",
+                              SIMULATION_DATABASE_PARAM))
+        if dbname == self.env.cr.dbname:
+            raise UserError(_("Simulations cannot run on the live database, %s must name a copy of it.",
+                              SIMULATION_DATABASE_PARAM))
+        try:
+            registry = Registry(dbname)
+        except Exception as e:
+            raise UserError(_("Cannot open the simulation database %(db)s: %(error)s", db=dbname, error=e)) from e
+        if MATE_QUEUE_SIMULATION not in registry:
+            raise UserError(_("The Smart Queue module is not installed in the simulation database %s.", dbname))
+        return registry
+
+    def _get_simulation_values(self):
+        """Cấu hình của lần chạy để tạo bản ghi mô phỏng trong cơ sở dữ liệu mô phỏng"""
+        values = {fname: self[fname] for fname in SIMULATION_SETTING_FIELDS}
+        values['package_ids'] = [Command.set(self.package_ids.ids)]
+        return values
+
+    def _simulate(self):
+        """Vòng lặp sự kiện rời rạc trên vòng đời token thật"""
+        rng = random.Random(self.seed)
+        token_model = self.env[MATE_QUEUE_TOKEN]
+        cr = self.env.cr
+        started, start_queries = time.perf_counter(), cr.sql_log_count
+        timings = defaultdict(list)
+
+        def measure(operation, func, *args):
+            queries, clock = cr.sql_log_count, time.perf_counter()
+            result = func(*args)
+            self.env.flush_all()
+            timings[operation].append(((time.perf_counter() - clock) * 1000, cr.sql_log_count - queries))
+            return result
+
+        arrivals = self._get_arrivals(rng)
+        if not arrivals:
+            raise UserError(_("The simulation has no arrivals, check the packages or the recorded period."))
+        patients = measure('setup', self._create_simulation_patients, arrivals)
+        rooms = self.env[HR_DEPARTMENT].search([('service_id', '!=', False), ('state', '=', 'open')], order='id')
+        distributions = self._get_service_time_distributions(rooms.service_id)
+
+        events, sequence = [], 0
+
+        def schedule(at, kind, payload=None):
+            nonlocal sequence
+            sequence += 1
+            heapq.heappush(events, (at, sequence, kind, payload))
+
+        for index, arrival in enumerate(arrivals):
+            schedule(arrival['time'], 'arrival', index)
+        if self.balancing_interval > 0:
+            schedule(self.balancing_interval, 'balance')
+
+        busy = {room.id: set() for room in rooms}
+        busy_time = defaultdict(float)
+        enqueued, waits = {}, defaultdict(list)
+        completed_tokens, patient_finish = 0, {}
+        now, horizon = 0.0, self.max_duration * 60
+
+        while events:
+            at, _sequence, kind, payload = heapq.heappop(events)
+            if at > horizon:
+                now = horizon
+                break
+            now = at
+
+            if kind == 'arrival':
+                arrival = arrivals[payload]
+                measure('arrival', token_model.create, {
+                    'patient_id': patients[payload].id,
+                    'service_id': arrival['service'].id,
+                    'service_group_id': arrival['service'].service_group_id.id,
+                    'package_id': arrival['package'].id,
+                    'emergency': arrival['emergency'],
+                    'state': 'waiting',
+                })
+            elif kind == 'complete':
+                token, room_id, duration = payload
+                busy[room_id].discard(token.id)
+                busy_time[room_id] += duration
+                measure('complete', token.action_complete_service)
+                completed_tokens += 1
+                patient_finish[token.patient_id.id] = now
+            elif kind == 'balance':
+                measure('load_balancing', token_model._run_load_balancing)
+                if any(event[2] != 'balance' for event in events):
+                    schedule(now + self.balancing_interval, 'balance')
+
+            # Gọi bệnh nhân vào các phòng còn chỗ theo đúng thứ tự hàng đợi thật
+            waiting_ids_by_room = token_model._get_waiting_ids_by_room(rooms.ids)
+            for room in rooms:
+                waiting_ids = waiting_ids_by_room[room.id]
+                for token_id in waiting_ids:
+                    enqueued.setdefault(token_id, now)
+                free = (room.capacity or 1) - len(busy[room.id])
+                if free <= 0 or not waiting_ids:
+                    continue
+                to_start = token_model.browse(waiting_ids[:free])
+                measure('start', to_start.action_start_service)
+                for token in to_start:
+                    waits[room.id].append(now - enqueued[token.id])
+                    busy[room.id].add(token.id)
+                    duration = self._sample_service_time(rng, distributions, token.service_id)
+                    schedule(now + duration, 'complete', (token, room.id, duration))
+
+        # Bệnh nhân hoàn tất khi không còn token nháp / đang chờ / đang phục vụ
+        unfinished = token_model._read_group([
+            ('patient_id', 'in', patients.ids),
+            ('state', 'in', ['draft', 'waiting', 'in_progress']),
+        ], ['patient_id'], ['__count'])
+        unfinished_ids = {patient.id for patient, _count in unfinished}
+        finished = {patient_id: at for patient_id, at in patient_finish.items() if patient_id not in unfinished_ids}
+
+        return self._build_report({
+            'arrivals': arrivals,
+            'rooms': rooms,
+            'makespan': now,
+            'finished': finished,
+            'unfinished_tokens': sum(count for _patient, count in unfinished),
+            'completed_tokens': completed_tokens,
+            'waits': waits,
+            'busy_time': busy_time,
+            'timings': timings,
+            'wall_time': time.perf_counter() - started,
+            'query_count': cr.sql_log_count - start_queries,
+        })
+
+    def _get_arrivals(self, rng):
+        """
+        Luồng bệnh nhân đến, đã sắp xếp theo thời gian (phút kể từ lúc bắt đầu)
+
+        Returns:
+            list: [{'time', 'service', 'package', 'emergency', 'patient_vals'}]
+        """
+        if self.arrival_source == 'recorded':
+            return self._get_recorded_arrivals()
+
+        packages = self.package_ids.exists() or self.env[MATE_HEALTH_CHECK_PACKAGE].search([('service_ids', '!=', False)])
+        packages = packages.filtered('service_ids').sorted('id')
+        if not packages:
+            return []
+        priorities = self.env[MATE_QUEUE_PRIORITY].search([('code', 'in', list(PRIORITY_PATIENT_VALUES))],
+                                                          order='priority_level, id')
+
+        arrivals, at = [], 0.0
+        for _index in range(self.patient_count):
+            at += rng.expovariate(self.arrival_rate / 60) if self.arrival_rate > 0 else 0.0
+            package = rng.choice(packages)
+            values = {}
+            if priorities and rng.random() < self.priority_ratio:
+                values = dict(PRIORITY_PATIENT_VALUES[rng.choice(priorities).code])
+            age = values.pop('age_years', SIMULATION_ADULT_AGE)
+            emergency = values.pop('emergency', False)
+            arrivals.append({
+                'time': at,
+                'service': self._get_entry_service(package),
+                'package': package,
+                'emergency': emergency,
+                'patient_vals': dict(values, date_of_birth=date.today() - relativedelta(years=age)),
+            })
+        return arrivals
+
+    def _get_recorded_arrivals(self):
+        """Các lượt đến đã ghi nhận (token đầu tiên của mỗi bệnh nhân) trong khoảng thời gian"""
+        if not self.date_from or not self.date_to:
+            raise UserError(_("Please set the recorded period to replay."))
+        tokens = self.env[MATE_QUEUE_TOKEN].search([
+            ('origin_token_id', '=', False),
+            ('create_date', '>=', self.date_from),
+            ('create_date', '<=', self.date_to),
+        ], order='create_date, id')
+        if not tokens:
+            return []
+        first = tokens[0].create_date
+        return [{
+            'time': (token.create_date - first).total_seconds() / 60,
+            'service': token.service_id,
+            'package': token.package_id or token.patient_id.queue_package_id,
+            'emergency': token.emergency,
+            'patient_vals': {fname: token.patient_id[fname] for fname in RECORDED_PATIENT_FIELDS},
+        } for token in tokens]
+
+    @api.model
+    def _get_entry_service(self, package):
+        """Dịch vụ đầu tiên của gói: dịch vụ thuộc nhóm có thứ tự nhỏ nhất"""
+        return package.service_ids.sorted(lambda s: (s.service_group_id.sequence, s.id))[:1]
+
+    def _create_simulation_patients(self, arrivals):
+        """Tạo bệnh nhân mô phỏng (một bệnh nhân cho mỗi lượt đến) bằng một lần create"""
+        return self.env[HIS_PATIENT].create([
+            dict(arrival['patient_vals'],
+                 name=_('Simulated Patient %s') % (index + 1),
+                 patient_id_number=f'SIM-{self.seed}-{index + 1:05d}',
+                 queue_package_id=arrival['package'].id,
+                 current_service_group_id=arrival['service'].service_group_id.id)
+            for index, arrival in enumerate(arrivals)
+        ])
+
+    def _get_service_time_distributions(self, services):
+        """
+        Phân phối log-normal của thời gian phục vụ theo dịch vụ
+
+        Dịch vụ có thống kê thời gian phục vụ (mate.queue.duration.stat) dùng P50 / P90 đã ghi nhận,
+        ngược lại dùng average_duration với hệ số biến thiên service_time_cv.
+
+        Returns:
+            dict: {service_id: (mu, sigma)}
+        """
+        stats = self.env[MATE_QUEUE_DURATION_STAT].sudo().search_fetch([
+            ('service_id', 'in', services.ids),
+            ('room_id', '=', False),
+            ('weekday', '=', ANY_BUCKET),
+            ('hour', '=', ANY_BUCKET),
+            ('sample_count', '>=', DURATION_MIN_SAMPLES),
+        ], ['service_id', 'p50', 'p90'])
+        quantiles = {stat.service_id.id: (stat.p50, stat.p90) for stat in stats if stat.p50 > 0}
+
+        default_sigma = math.sqrt(math.log(1 + max(self.service_time_cv, 0.0) ** 2))
+        distributions = {}
+        for service in services:
+            if service.id in quantiles:
+                p50, p90 = quantiles[service.id]
+                sigma = math.log(p90 / p50) / NORMAL_Z90 if p90 > p50 else default_sigma
+                distributions[service.id] = (math.log(p50), sigma)
+            else:
+                mean = service.average_duration or 10.0
+                distributions[service.id] = (math.log(mean) - default_sigma ** 2 / 2, default_sigma)
+        return distributions
+
+    @api.model
+    def _sample_service_time(self, rng, distributions, service):
+        """Lấy mẫu thời gian phục vụ (phút) của dịch vụ"""
+        mu, sigma = distributions.get(service.id, (math.log(service.average_duration or 10.0), 0.0))
+        return rng.lognormvariate(mu, sigma)
+
+    def _build_report(self, result):
+        """Tổng hợp kết quả mô phỏng thành báo cáo có thể so sánh giữa các phiên bản"""
+        makespan = result['makespan']
+        all_waits = [wait for waits in result['waits'].values() for wait in waits]
+        module = self.env['ir.module.module'].sudo().search_fetch(
+            [('name', '=', 'mate_smart_queue')], ['latest_version'], limit=1)
+
+        rooms = []
+        for room in result['rooms']:
+            waits = result['waits'].get(room.id, [])
+            rooms.append({
+                'room': room.name,
+                'service': room.service_id.name,
+                'served': len(waits),
+                'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait': _percentile(waits, 0.95),
+                'utilization': result['busy_time'][room.id] / ((room.capacity or 1) * makespan) if makespan else 0.0,
+            })
+
+        operations = []
+        for operation, samples in sorted(result['timings'].items()):
+            durations = [duration for duration, _queries in samples]
+            queries = [query_count for _duration, query_count in samples]
+            operations.append({
+                'operation': operation,
+                'count': len(samples),
+                'mean_ms': sum(durations) / len(samples),
+                'p95_ms': _percentile(durations, 0.95),
+                'max_ms': max(durations),
+                'mean_queries': sum(queries) / len(samples),
+                'total_queries': sum(queries),
+            })
+
+        return {
+            'version': module.latest_version or '',
+            'seed': self.seed,
+            'arrival_source': self.arrival_source,
+            'patients': len(result['arrivals']),
+            'finished_patients': len(result['finished']),
+            'completed_tokens': result['completed_tokens'],
+            'unfinished_tokens': result['unfinished_tokens'],
+            'makespan': makespan,
+            'throughput': len(result['finished']) / (makespan / 60) if makespan else 0.0,
+            'mean_wait': sum(all_waits) / len(all_waits) if all_waits else 0.0,
+            'p95_wait': _percentile(all_waits, 0.95),
+            'wall_time': result['wall_time'],
+            'query_count': result['query_count'],
+            'rooms': rooms,
+            'operations': operations,
+        }
+
+    @api.model
+    def _render_report(self, report):
+        """Hiển thị báo cáo dạng bảng"""
+        def table(headers, rows):
+            head = ''.join(f'<th>{html_escape(header)}</th>' for header in headers)
+            body = ''.join('<tr>%s</tr>' % ''.join(f'<td>{html_escape(cell)}</td>' for cell in row) for row in rows)
+            return f'<table class="table table-sm table-striped"><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>'
+
+        summary = table([_('Patients'), _('Finished'), _('Completed Tokens'), _('Unfinished Tokens'),
+                         _('Simulated Time (minutes)'), _('Throughput (patients/hour)')], [[
+            report['patients'], report['finished_patients'], report['completed_tokens'],
+            report['unfinished_tokens'], f"{report['makespan']:.1f}", f"{report['throughput']:.2f}",
+        ]])
+        rooms = table([_('Room'), _('Service'), _('Served'), _('Mean Wait'), _('P95 Wait'), _('Utilization')], [[
+            room['room'], room['service'], room['served'], f"{room['mean_wait']:.1f}", f"{room['p95_wait']:.1f}",
+            f"{room['utilization']:.0%}",
+        ] for room in report['rooms']])
+        operations = table([_('Operation'), _('Count'), _('Mean (ms)'), _('P95 (ms)'), _('Max (ms)'),
+                            _('Queries / Call'), _('Queries')], [[
+            operation['operation'], operation['count'], f"{operation['mean_ms']:.1f}",
+            f"{operation['p95_ms']:.1f}", f"{operation['max_ms']:.1f}", f"{operation['mean_queries']:.1f}",
+            operation['total_queries'],
+        ] for operation in report['operations']])
+        return Markup(summary + rooms + operations)
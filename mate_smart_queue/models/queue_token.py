@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
-from odoo.tools.safe_eval import safe_eval
+from collections import defaultdict
 import hashlib
 import logging
+import time
+
+from .queue_profiling import profiled
+from .queue_room_distance import DEFAULT_ROOM_DISTANCE
+from .queue_room_feed import ROOM_NOTIFY_KEY
+from .queue_room_load import ROOM_LOAD_STATES
 
 _logger = logging.getLogger(__name__)
 
@@ -21,10 +27,52 @@ MATE_QUEUE_TOKEN = "mate.queue.token"
 MATE_HEALTH_CHECK_GROUP = "mate.health.check.group"
 MATE_QUEUE_PRIORITY = "mate.queue.priority"
 MATE_QUEUE_SERVICE_ROUTE = "mate.queue.service.route"
+MATE_QUEUE_ROOM_LOAD = "mate.queue.room.load"
+QUEUE_ROOM_DISTANCE = "queue.room.distance"
+MATE_QUEUE_NOTIFICATION = "mate.queue.notification"
+MATE_QUEUE_ROOM_FEED = "mate.queue.room.feed"
+MATE_QUEUE_DURATION_SAMPLE = "mate.queue.duration.sample"
+MATE_QUEUE_DURATION_STAT = "mate.queue.duration.stat"
 
 IR_ACTIONS_CLIENT = "ir.actions.client"
 MATE_QUEUE_SERVICE_GROUP_ROUTE = "mate.queue.service.group.route"
 
+# Trường làm thay đổi snapshot tải phòng (mate.queue.room.load)
+ROOM_LOAD_FIELDS = {'room_id', 'state'}
+
+# Thứ tự phục vụ chuẩn dùng chung cho mọi nơi sắp xếp hàng đợi:
+# khẩn cấp trước, ưu tiên cao trước, đến trước phục vụ trước
+QUEUE_ORDER_SQL = "COALESCE(emergency, FALSE) DESC, COALESCE(priority, 0) DESC, create_date ASC, id ASC"
+
+# Khóa sắp xếp thưa cho kéo thả: mỗi lần di chuyển chỉ ghi khóa của token được kéo
+# (trung điểm giữa hai token kề nhau), phòng được nén lại khi hết khoảng trống
+QUEUE_SEQUENCE_ORDER_SQL = "queue_sequence ASC, position ASC, id ASC"
+QUEUE_SEQUENCE_GAP = 1024.0
+QUEUE_SEQUENCE_MIN_GAP = 1e-6
+
+# Chi phí (phút) cho mỗi token còn nằm trong phòng đóng: đủ lớn để bộ cân bằng tải
+# luôn chuyển hết token ra khỏi phòng đóng khi còn phòng mở cùng dịch vụ
+CLOSED_ROOM_PENALTY = 1e6
+
+# Trọng số mặc định khi chọn dịch vụ tiếp theo trong nhóm song song,
+# ghi đè bằng tham số hệ thống mate_smart_queue.recommend_weight_<tiêu chí>
+RECOMMENDATION_WEIGHTS = {
+    'movement': 0.4,  # Thời gian di chuyển
+    'waiting': 0.35,  # Thời gian chờ đợi tại phòng
+    'duration': 0.15,  # Thời gian thực hiện dịch vụ
+    'medical': 0.1,  # Ưu tiên y tế
+}
+
+# Ưu tiên y tế theo mã dịch vụ (càng thấp càng ưu tiên)
+SERVICE_MEDICAL_PRIORITY = {
+    'BLOOD': 1,  # Xét nghiệm máu ưu tiên cao nhất
+    'XRAY': 3,
+    'ULTRA': 4,
+    'DOC': 2,
+    'VITAL': 5,
+    'REG': 10
+}
+
 
 class QueueToken(models.Model):
     _name = MATE_QUEUE_TOKEN
@@ -37,6 +85,10 @@ class QueueToken(models.Model):
     service_id = fields.Many2one(PRODUCT_PRODUCT, string='Service', required=True, ondelete='cascade')
     room_id = fields.Many2one(HR_DEPARTMENT, string='Assigned Room', tracking=True, ondelete='cascade')
     position = fields.Integer(string='Queue Position', tracking=True, default=0, index=True)
+    queue_sequence = fields.Float(string='Queue Sequence', default=0.0, index=True, copy=False,
+                                  help="Sparse ordering key inside the room queue, used for drag and drop")
+    queue_rank = fields.Integer(string='Queue Rank', compute='_compute_queue_rank',
+                                help="Live position in the room queue according to the queue sequence")
     priority = fields.Integer(string='Priority Level', default=0, tracking=True)
     priority_id = fields.Many2one(MATE_QUEUE_PRIORITY, string='Priority Type', tracking=True, ondelete='cascade')
     estimated_wait_time = fields.Float(string='Estimated Wait Time (minutes)', compute='_compute_wait_time')
@@ -81,15 +133,31 @@ class QueueToken(models.Model):
             else:
                 token.is_parallel = False
 
+    def _compute_queue_rank(self):
+        """Tính vị trí thực tế trong phòng theo queue_sequence bằng một truy vấn"""
+        ranks = {}
+        room_ids = self.filtered(lambda t: t.state == 'waiting').room_id.ids
+        if room_ids:
+            self.flush_model(['room_id', 'state', 'queue_sequence', 'position'])
+            self.env.cr.execute(f"""
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY {QUEUE_SEQUENCE_ORDER_SQL})
+                  FROM {self._table}
+                 WHERE state = 'waiting'
+                   AND room_id IN %s
+            """, [tuple(room_ids)])
+            ranks = dict(self.env.cr.fetchall())
+        for token in self:
+            token.queue_rank = ranks.get(token.id, 0) if token.state == 'waiting' else 0
+
     @api.model
+    @profiled('reorder')
     def reorder_position(self, token_id, new_position, old_position):
         """
         Xử lý khi token được kéo thả đến vị trí mới
-        """
-        _logger.info("=== REORDER POSITION START ===")
-        _logger.info("Token ID: %s, Old Position: %s, New Position: %s", token_id, old_position, new_position)
 
-        # Ensure new_position and old_position are integers
+        Giữ lại để tương thích: vị trí đích được đổi thành token đứng ngay trước
+        rồi chuyển cho move_token.
+        """
         try:
             new_position = int(new_position)
             old_position = int(old_position)
@@ -99,63 +167,126 @@ class QueueToken(models.Model):
             return False
 
         token = self.browse(token_id)
-
         if not token.exists():
             _logger.error("Token không tồn tại: %s", token_id)
             return False
 
+        if new_position == old_position:
+            return True
+
+        other_tokens = self.search([
+            ('room_id', '=', token.room_id.id),
+            ('state', '=', 'waiting'),
+            ('id', '!=', token.id)
+        ], order='queue_sequence, position, id')
+        previous_index = min(new_position - 1, len(other_tokens)) - 1
+        previous_token = other_tokens[previous_index] if previous_index >= 0 else False
+
+        self.move_token(token.id, previous_token.id if previous_token else False)
+        return True
+
+    @api.model
+    @profiled('reorder')
+    def move_token(self, token_id, previous_token_id=False):
+        """
+        Di chuyển token ra ngay sau previous_token_id (hoặc lên đầu hàng nếu không có)
+
+        Chỉ khóa queue_sequence của token được kéo bị ghi; số thứ tự hiển thị
+        (position) của cả phòng được đồng bộ lại khi nén định kỳ.
+
+        Trả về:
+            list: Danh sách token đang chờ của phòng sau khi di chuyển
+        """
+        token = self.browse(int(token_id)).exists()
+        if not token:
+            raise UserError(_("Token does not exist"))
+
         if token.state != 'waiting':
-            _logger.error("Token không ở trạng thái waiting: %s", token.state)
             raise UserError(_('can_only_change_waiting_token_position'))
 
-        if new_position == old_position:
-            _logger.info("Vị trí không thay đổi, bỏ qua")
-            return True
+        previous_token = self.browse(int(previous_token_id)).exists() if previous_token_id else self.browse()
+        if previous_token == token:
+            return self._get_room_queue_slice(token.room_id.id)
+        if previous_token and (previous_token.room_id != token.room_id or previous_token.state != 'waiting'):
+            raise UserError(_('error_changing_token_position') % previous_token.name)
 
-        room_id = token.room_id.id
-        _logger.info("Room ID: %s", room_id)
+        old_rank = token.queue_rank
 
-        # Use a transaction to ensure data consistency
-        with self.env.cr.savepoint():
-            try:
-                # Get all waiting tokens in the room ordered by position
-                tokens_in_room = self.search([
-                    ('room_id', '=', room_id),
-                    ('state', '=', 'waiting'),
-                    ('id', '!=', token_id)  # Exclude the moved token
-                ], order='position')
+        new_sequence = self._get_sequence_after(token, previous_token)
+        if new_sequence is None:
+            # Hết khoảng trống giữa hai token kề nhau -> nén lại khóa của phòng rồi tính lại
+            self._compact_queue_sequences(token.room_id.ids)
+            new_sequence = self._get_sequence_after(token, previous_token)
 
-                _logger.info("Found %s other tokens in room", len(tokens_in_room))
+        token.write({'queue_sequence': new_sequence})
+        token.invalidate_recordset(['queue_rank'])
+        new_rank = token.queue_rank
 
-                # Update position of the moved token
-                token.write({'position': new_position})
+        # Log the movement
+        if old_rank != new_rank:
+            self._create_position_change_log(token, old_rank, new_rank)
 
-                # Reorder other tokens
-                current_pos = 1
-                for t in tokens_in_room:
-                    if current_pos == new_position:
-                        current_pos += 1  # Skip the position we just assigned
-                    t.write({'position': current_pos})
-                    current_pos += 1
+        # Notify queue change
+        self._notify_queue_change(token.room_id)
 
-                # Flush to database
-                self.env.cr.flush()
+        return self._get_room_queue_slice(token.room_id.id)
 
-                # Invalidate cache
-                self.invalidate_recordset(['position'])
+    def _get_sequence_after(self, token, previous_token):
+        """
+        Tính khóa queue_sequence để đặt token ngay sau previous_token
 
-                # Log the movement
-                self._create_position_change_log(token, old_position, new_position)
+        Trả về None nếu không còn khoảng trống giữa hai token kề nhau.
+        """
+        self.flush_model(['room_id', 'state', 'queue_sequence', 'position'])
+        if not previous_token:
+            self.env.cr.execute(f"""
+                SELECT MIN(queue_sequence)
+                  FROM {self._table}
+                 WHERE room_id = %s AND state = 'waiting' AND id != %s
+            """, [token.room_id.id, token.id])
+            first_sequence = self.env.cr.fetchone()[0]
+            return QUEUE_SEQUENCE_GAP if first_sequence is None else first_sequence - QUEUE_SEQUENCE_GAP
+
+        lower = previous_token.queue_sequence
+        self.env.cr.execute(f"""
+            SELECT MIN(queue_sequence)
+              FROM {self._table}
+             WHERE room_id = %s AND state = 'waiting' AND id != %s
+               AND (queue_sequence, position, id) > (%s, %s, %s)
+        """, [token.room_id.id, token.id, lower, previous_token.position, previous_token.id])
+        upper = self.env.cr.fetchone()[0]
+        if upper is None:
+            return lower + QUEUE_SEQUENCE_GAP
+        if upper - lower < QUEUE_SEQUENCE_MIN_GAP:
+            return None
+        return (lower + upper) / 2
 
-                # Notify queue change
-                self._notify_queue_change(token.room_id)
+    @api.model
+    def _get_room_queue_slice(self, room_id):
+        """Danh sách token đang chờ của phòng theo thứ tự hàng đợi, dùng cho giao diện điều phối"""
+        tokens = self.search([
+            ('room_id', '=', room_id),
+            ('state', '=', 'waiting')
+        ], order='queue_sequence, position, id')
+        return [{
+            'id': token.id,
+            'name': token.name,
+            'patient': token.patient_id.display_name,
+            'service': token.service_id.display_name,
+            'priority': token.priority,
+            'emergency': token.emergency,
+            'position': rank,
+        } for rank, token in enumerate(tokens, 1)]
 
-                _logger.info("=== REORDER POSITION SUCCESS ===")
-                return True
+    @api.model
+    def _compact_queue_sequences(self, room_ids=None):
+        """Nén lại queue_sequence và đồng bộ position theo thứ tự kéo thả hiện tại"""
+        return self._renumber_room_queues(room_ids, order_sql=QUEUE_SEQUENCE_ORDER_SQL, log_changes=False)
 
-            except Exception as e:
-                _logger.error("Error during reorder: %s", str(e))
-                raise UserError(_('error_changing_token_position') % str(e))
+    @api.model
+    def _cron_compact_queue_sequences(self):
+        """Công việc định kỳ nén khóa sắp xếp của tất cả phòng"""
+        self._compact_queue_sequences()
 
     def _create_position_change_log(self, token, old_pos, new_pos):
         """Tạo log khi thay đổi vị trí"""
@@ -176,11 +307,12 @@ class QueueToken(models.Model):
             }
 
             self.env['mate.queue.coordination.log'].create(log_vals)
-            _logger.info("Đã tạo log điều phối cho token %s", token.name)
+            _logger.debug("Đã tạo log điều phối cho token %s", token.name)
         except Exception as e:
             _logger.error("Lỗi khi tạo log điều phối: %s", str(e))
 
     @api.model_create_multi
+    @profiled('create')
     def create(self, vals_list):
         """
         Ghi đè phương thức create để tạo mã token tự động và thực hiện quy trình phân phối
@@ -195,25 +327,60 @@ class QueueToken(models.Model):
         for vals in vals_list:
             if vals.get('name', _('New')) == _('New'):
                 vals['name'] = self.env['ir.sequence'].next_by_code(MATE_QUEUE_TOKEN) or _('New')
+            if vals.get('position') and 'queue_sequence' not in vals:
+                vals['queue_sequence'] = vals['position'] * QUEUE_SEQUENCE_GAP
 
         # Tạo tokens như bình thường
         tokens = super(QueueToken, self).create(vals_list)
+        self._update_room_loads([], tokens._get_room_load_keys())
 
-        # Post-processing for each token
-        for token in tokens:
-            # 🔑 KEY: Kiểm tra context flag
-            if self.env.context.get('skip_auto_assignment'):
-                # Token từ coordination → Skip auto flow
-                continue
+        # 🔑 KEY: Kiểm tra context flag
+        if self.env.context.get('skip_auto_assignment'):
+            # Token từ coordination → Skip auto flow
+            return tokens
 
-            # Token bình thường → Chạy full auto flow
-            token._calculate_priority()
-            token._assign_room_by_hash()
-            token._add_to_queue_and_sort()
-            token._send_notifications('new_token')
+        # Token bình thường → Chạy full auto flow trên cả lô token một lần
+        # (đăng ký theo đoàn khám sức khỏe có thể tạo hàng trăm token cùng lúc)
+        tokens._calculate_priority()
+        tokens._assign_room_by_hash()
+        tokens._add_to_queue_and_sort()
+        tokens._send_notifications('new_token')
 
         return tokens
 
+    def write(self, vals):
+        track_load = bool(ROOM_LOAD_FIELDS.intersection(vals))
+        old_load_keys = self._get_room_load_keys() if track_load else []
+        res = super(QueueToken, self).write(vals)
+        if track_load:
+            self._update_room_loads(old_load_keys, self._get_room_load_keys())
+        return res
+
+    def unlink(self):
+        self._update_room_loads(self._get_room_load_keys(), [])
+        return super(QueueToken, self).unlink()
+
+    def _get_room_load_keys(self):
+        """Danh sách (room_id, state) của các token, dùng để tính chênh lệch snapshot tải phòng"""
+        return [(token.room_id.id, token.state) for token in self]
+
+    @api.model
+    def _update_room_loads(self, old_keys, new_keys):
+        """
+        Cập nhật snapshot tải phòng theo chênh lệch trước / sau của các token
+
+        Args:
+            old_keys: [(room_id, state)] trước khi thay đổi
+            new_keys: [(room_id, state)] sau khi thay đổi
+        """
+        deltas = defaultdict(lambda: defaultdict(int))
+        for keys, sign in ((old_keys, -1), (new_keys, 1)):
+            for room_id, state in keys:
+                if room_id and state in ROOM_LOAD_STATES:
+                    deltas[room_id][ROOM_LOAD_STATES[state]] += sign
+        if deltas:
+            self.env[MATE_QUEUE_ROOM_LOAD]._queue_token_deltas(deltas)
+
     def _calculate_priority(self):
         """
         Tính toán mức ưu tiên dựa trên thuộc tính bệnh nhân
@@ -227,23 +394,25 @@ class QueueToken(models.Model):
         - Người cao tuổi (>65): 1
         - Thông thường: 0
         """
+        # Gom các token cùng mức ưu tiên để ghi một lần cho mỗi nhóm
+        token_ids_by_priority = defaultdict(list)
         for token in self:
             # Kiểm tra và xử lý trường hợp khẩn cấp trước
             if token.emergency:
-                self._set_emergency_priority(token)
-                continue
-
-            # Tính toán mức ưu tiên cho các trường hợp không khẩn cấp
-            priority = self._compute_patient_priority(token.patient_id)
-
-            # Đặt mức ưu tiên và loại ưu tiên tương ứng
-            token.priority = priority
-            self._set_priority_type(token, priority)
-
-    def _set_emergency_priority(self, token):
-        """Đặt mức ưu tiên cao nhất cho trường hợp khẩn cấp"""
-        token.priority = 10
-        token.priority_id = self.env.ref('mate_smart_queue.priority_emergency', False)
+                priority = 10
+                priority_type = self.env.ref('mate_smart_queue.priority_emergency', False)
+            else:
+                # Tính toán mức ưu tiên cho các trường hợp không khẩn cấp
+                priority = self._compute_patient_priority(token.patient_id)
+                priority_type = self._get_priority_type(priority)
+            token_ids_by_priority[(priority, priority_type.id if priority_type else False)].append(token.id)
+
+        # Đặt mức ưu tiên và loại ưu tiên tương ứng
+        for (priority, priority_type_id), token_ids in token_ids_by_priority.items():
+            self.browse(token_ids).write({
+                'priority': priority,
+                'priority_id': priority_type_id,
+            })
 
     def _compute_patient_priority(self, patient):
         """Tính toán mức ưu tiên dựa trên thông tin bệnh nhân"""
@@ -271,7 +440,8 @@ class QueueToken(models.Model):
 
         return priority
 
-    def _set_priority_type(self, token, priority):
+    def _get_priority_type(self, priority):
+        """Lấy loại ưu tiên tương ứng với mức ưu tiên"""
         ref_map = {
             0: 'priority_normal',
             1: 'priority_elderly',
@@ -280,7 +450,7 @@ class QueueToken(models.Model):
             4: 'priority_vip',
         }
         ref_key = ref_map.get(priority, 'priority_doctor_assigned')
-        token.priority_id = self.env.ref(f'mate_smart_queue.{ref_key}', False)
+        return self.env.ref(f'mate_smart_queue.{ref_key}', False)
 
     def _assign_room_by_hash(self):
         """
@@ -290,21 +460,29 @@ class QueueToken(models.Model):
         1. Nếu bệnh nhân ưu tiên cao -> chỉ định vào phòng ít tải nhất
         2. Bệnh nhân thông thường -> sử dụng hàm hash để phân bổ đều
         3. Nếu phòng đã quá tải (>150% so với phòng ít nhất) -> chuyển sang phòng ít tải
+
+        Cả lô token được xử lý cùng lúc: phòng mở và số người đợi mỗi phòng chỉ
+        được truy vấn một lần, sau đó tải được cộng dồn trong bộ nhớ sau mỗi lần chỉ định.
         """
-        for token in self:
-            # Tìm các phòng có thể thực hiện dịch vụ này
-            available_rooms = self.env[HR_DEPARTMENT].search([
-                ('service_id', '=', token.service_id.id),
-                ('state', '=', 'open')
-            ])
+        if not self:
+            return
+
+        # Tìm các phòng có thể thực hiện các dịch vụ của lô token
+        rooms_by_service = self._get_open_rooms_by_service(self.service_id)
+        all_rooms = self.env[HR_DEPARTMENT].concat(*rooms_by_service.values())
+        waiting_counts = self._get_waiting_count_by_room(all_rooms, exclude_tokens=self)
 
+        token_ids_by_room = defaultdict(list)
+        for token in self:
+            available_rooms = rooms_by_service.get(token.service_id.id)
             if not available_rooms:
                 raise UserError(_("no_available_room_for_service"))
 
+            least_loaded_room = self._get_least_loaded_room(available_rooms, waiting_counts)
+
             # Với bệnh nhân ưu tiên cao, chỉ định phòng ít tải nhất
             if token.priority > 0:
-                least_loaded_room = self._get_least_loaded_room(available_rooms)
-                token.room_id = least_loaded_room.id
+                target_room = least_loaded_room
             else:
                 # Với bệnh nhân thông thường, sử dụng hash để phân bổ đều
                 hash_input = f"{token.patient_id.id}-{token.service_id.id}"
@@ -313,19 +491,53 @@ class QueueToken(models.Model):
                 selected_room = available_rooms[room_index]
 
                 # Kiểm tra nếu phòng được chọn đã quá tải
-                least_loaded_room = self._get_least_loaded_room(available_rooms)
-                if self._get_room_load(selected_room) > self._get_room_load(least_loaded_room) * 1.5:
+                if self._get_room_load(selected_room, waiting_counts) > \
+                        self._get_room_load(least_loaded_room, waiting_counts) * 1.5:
                     # Nếu quá tải >150% so với phòng ít nhất, chuyển sang phòng ít tải
-                    token.room_id = least_loaded_room.id
+                    target_room = least_loaded_room
                 else:
-                    token.room_id = selected_room.id
+                    target_room = selected_room
+
+            token_ids_by_room[target_room.id].append(token.id)
+
+            # Token sẽ vào hàng đợi ngay -> cộng vào tải của phòng cho các token sau
+            if token.state == 'waiting' or (token.state == 'draft' and not token.is_parallel):
+                waiting_counts[target_room.id] += 1
 
-    def _get_least_loaded_room(self, rooms):
+        for room_id, token_ids in token_ids_by_room.items():
+            self.browse(token_ids).write({'room_id': room_id})
+
+    @api.model
+    def _get_open_rooms_by_service(self, services):
+        """Lấy các phòng đang mở theo dịch vụ bằng một truy vấn: {service_id: rooms}"""
+        rooms = self.env[HR_DEPARTMENT].search([
+            ('service_id', 'in', services.ids),
+            ('state', '=', 'open')
+        ])
+        rooms_by_service = {}
+        for room in rooms:
+            rooms_by_service[room.service_id.id] = rooms_by_service.get(
+                room.service_id.id, self.env[HR_DEPARTMENT]) | room
+        return rooms_by_service
+
+    @api.model
+    def _get_waiting_count_by_room(self, rooms, exclude_tokens=None):
+        """Đếm số token đang chờ của từng phòng bằng một truy vấn gom nhóm"""
+        domain = [('room_id', 'in', rooms.ids), ('state', '=', 'waiting')]
+        if exclude_tokens:
+            domain.append(('id', 'not in', exclude_tokens.ids))
+        waiting_counts = defaultdict(int)
+        for room, count in self._read_group(domain, ['room_id'], ['__count']):
+            waiting_counts[room.id] = count
+        return waiting_counts
+
+    def _get_least_loaded_room(self, rooms, waiting_counts=None):
         """
         Tìm phòng có tải thấp nhất trong danh sách phòng
 
         Tham số:
             rooms: Recordset các phòng cần kiểm tra
+            waiting_counts: Số người đợi theo phòng đã tính sẵn (tùy chọn)
 
         Trả về:
             room: Phòng có tải thấp nhất
@@ -333,60 +545,73 @@ class QueueToken(models.Model):
         if not rooms:
             return False
 
+        if waiting_counts is None:
+            waiting_counts = self._get_waiting_count_by_room(rooms)
         min_load = float('inf')
         least_loaded_room = rooms[0]
 
         for room in rooms:
-            room_load = self._get_room_load(room)
+            room_load = self._get_room_load(room, waiting_counts)
             if room_load < min_load:
                 min_load = room_load
                 least_loaded_room = room
 
         return least_loaded_room
 
-    def _get_room_load(self, room):
+    def _get_room_load(self, room, waiting_counts=None):
         """
         Tính toán tải của phòng (số người đợi / công suất)
 
         Tham số:
             room: Phòng cần tính tải
+            waiting_counts: Số người đợi theo phòng đã tính sẵn (tùy chọn)
 
         Trả về:
             float: Tỷ lệ tải (số người đợi / công suất)
         """
-        waiting_count = self.search_count([
-            ('room_id', '=', room.id),
-            ('state', '=', 'waiting')
-        ])
+        if waiting_counts is None:
+            waiting_counts = self._get_waiting_count_by_room(room)
+        waiting_count = waiting_counts[room.id]
         return waiting_count / room.capacity if room.capacity > 0 else float('inf')
 
+    @api.model
+    def _get_waiting_ids_by_room(self, room_ids):
+        """
+        ID token đang chờ của các phòng theo thứ tự hàng đợi, bằng một truy vấn
+
+        Trả về:
+            dict: {room_id: [token_id]}
+        """
+        waiting_ids = {room_id: [] for room_id in room_ids if room_id}
+        if not waiting_ids:
+            return waiting_ids
+        waiting_tokens = self.search_fetch([
+            ('room_id', 'in', list(waiting_ids)),
+            ('state', '=', 'waiting')
+        ], ['room_id'], order=QUEUE_SEQUENCE_ORDER_SQL)
+        for token in waiting_tokens:
+            waiting_ids[token.room_id.id].append(token.id)
+        return waiting_ids
+
     def _add_to_queue_and_sort(self):
         """
         Thêm token vào hàng đợi và sắp xếp dựa trên ưu tiên và thời gian
         Quy tắc sắp xếp:
         1. Ưu tiên cao được xếp trước
         2. Với cùng mức ưu tiên, ai đến trước được phục vụ trước (FIFO)
-        """
-        for token in self:
-            if token.state == 'draft' and not token.is_parallel:
-                # Chỉ chuyển sang waiting nếu không phải token song song
-                token.state = 'waiting'
-
-            # Lấy tất cả token đang đợi trong cùng phòng
-            waiting_tokens = self.search([
-                ('room_id', '=', token.room_id.id),
-                ('state', '=', 'waiting')
-            ])
 
-            # Sắp xếp theo mức ưu tiên (giảm dần) và thời gian tạo (tăng dần)
-            sorted_tokens = waiting_tokens.sorted(key=lambda r: (-r.priority, r.create_date))
+        Mỗi phòng bị ảnh hưởng chỉ được sắp xếp lại và thông báo một lần.
+        """
+        # Chỉ chuyển sang waiting nếu không phải token song song
+        draft_tokens = self.filtered(lambda t: t.state == 'draft' and not t.is_parallel)
+        if draft_tokens:
+            draft_tokens.write({'state': 'waiting'})
 
-            # Cập nhật vị trí cho mỗi token
-            for index, t in enumerate(sorted_tokens):
-                t.position = index + 1
+        # Đánh số lại tất cả phòng bị ảnh hưởng bằng một câu lệnh
+        self._renumber_room_queues(self.room_id.ids)
 
-            # Thông báo thay đổi hàng đợi đến màn hình hiển thị phòng
-            self._notify_queue_change(token.room_id)
+        # Thông báo thay đổi hàng đợi đến màn hình hiển thị phòng
+        self._notify_queue_change(self.room_id)
 
     @api.depends('start_time', 'end_time')
     def _compute_duration(self):
@@ -409,49 +634,13 @@ class QueueToken(models.Model):
     def _get_next_service(self, current_service, package):
         """Lấy dịch vụ tiếp theo dựa trên dịch vụ hiện tại và gói dịch vụ"""
         if not current_service or not package:
-            _logger.info("Thiếu thông tin: current_service=%s, package=%s",
-                         current_service and current_service.name,
-                         package and package.name)
-            return False
-            # Lấy tất cả tuyến đường có thể từ dịch vụ hiện tại
-        routes = self.env[MATE_QUEUE_SERVICE_ROUTE].search([
-            ('service_from_id', '=', current_service.id)
-        ], order='sequence')
-
-        _logger.info("Tìm thấy %d tuyến đường cho dịch vụ %s", len(routes), current_service.name)
-        if not routes:
-            _logger.info("Không tìm thấy tuyến đường nào cho dịch vụ %s", current_service.name)
             return False
 
-        # Ghi log tất cả các tuyến đường tìm thấy
-        for route in routes:
-            _logger.info("Tuyến đường: %s -> %s, Gói: %s",
-                         route.service_from_id.name,
-                         route.service_to_id.name,
-                         route.package_id and route.package_id.name or "Không có")
-
-        # Tìm tuyến đường cụ thể cho gói
-        package_routes = routes.filtered(lambda r: r.package_id and r.package_id.id == package.id)
-        if package_routes:
-            _logger.info("Tìm thấy tuyến đường theo gói %s: %s -> %s",
-                         package.name,
-                         package_routes[0].service_from_id.name,
-                         package_routes[0].service_to_id.name)
-            return package_routes[0].service_to_id
-
-        # Tìm tuyến đường không có gói cụ thể (chung cho tất cả)
-        general_routes = routes.filtered(lambda r: not r.package_id)
-        if general_routes:
-            _logger.info("Tìm thấy tuyến đường chung: %s -> %s",
-                         general_routes[0].service_from_id.name,
-                         general_routes[0].service_to_id.name)
-            return general_routes[0].service_to_id
-
-        # Nếu không có tuyến đường nào phù hợp, trả về tuyến đầu tiên
-        _logger.info("Không tìm thấy tuyến đường phù hợp, sử dụng tuyến đầu tiên: %s -> %s",
-                     routes[0].service_from_id.name,
-                     routes[0].service_to_id.name)
-        return routes[0].service_to_id
+        # Bảng định tuyến được cache theo registry: không truy vấn lại cho từng token
+        route = self.env[MATE_QUEUE_SERVICE_ROUTE]._resolve_route(current_service.id, package.id)
+        if not route:
+            return False
+        return self.env[PRODUCT_PRODUCT].browse(route.to_id)
 
     def _compute_color(self):
         """Tính toán màu sắc cho giao diện kanban dựa trên trạng thái và mức độ ưu tiên"""
@@ -471,42 +660,97 @@ class QueueToken(models.Model):
             else:
                 token.color = 0  # Màu xám cho trạng thái hủy hoặc nháp
 
-    def _notify_queue_change(self, room):
-        """Thông báo cho màn hình phòng về sự thay đổi hàng đợi"""
-        self.env['bus.bus']._sendone(
-            f'room_display_{room.id}',
-            'queue_updated',
-            {'room_id': room.id}
-        )
+    def _notify_queue_change(self, rooms):
+        """
+        Thông báo cho màn hình phòng về sự thay đổi hàng đợi
 
-    def action_start_service(self):
-        """Bắt đầu phục vụ token này"""
-        for token in self:
-            if token.state != 'waiting':
-                raise UserError(_("can_only_start_waiting_tokens"))
+        Các phòng được gom lại trong giao dịch và chỉ gửi một thông báo cho mỗi phòng
+        ngay trước khi commit. Thông báo mang revision mới của hàng đợi và các thay đổi
+        so với revision trước (xem mate.queue.room.feed) để màn hình không phải tải lại.
+        """
+        if not rooms:
+            return
+        precommit = self.env.cr.precommit
+        room_ids = precommit.data.get(ROOM_NOTIFY_KEY)
+        if room_ids is None:
+            room_ids = precommit.data[ROOM_NOTIFY_KEY] = set()
+            precommit.add(self._flush_queue_notifications)
+        room_ids.update(rooms.ids)
+
+    def _flush_queue_notifications(self):
+        """Gửi thông báo bus cho các phòng đã thay đổi trong giao dịch (mỗi phòng một lần)"""
+        room_ids = self.env.cr.precommit.data.pop(ROOM_NOTIFY_KEY, set())
+        snapshots = self._get_room_queue_snapshots(room_ids)
+        messages = self.env[MATE_QUEUE_ROOM_FEED]._publish(snapshots)
+        for room_id in sorted(messages):
+            self.env['bus.bus']._sendone(f'room_display_{room_id}', 'queue_updated', messages[room_id])
 
-            token.write({
-                'state': 'in_progress',
-                'start_time': fields.Datetime.now(),
-                'position': 0
+    @api.model
+    def _get_room_queue_snapshots(self, room_ids):
+        """
+        Ảnh chụp hàng đợi của các phòng cho màn hình hiển thị
+
+        Returns:
+            dict: {room_id: {'room_id', 'queue_length', 'in_progress_count', 'estimated_wait_time',
+                             'wait_per_position', 'tokens': [{'id', 'name', 'position', 'emergency', 'wait_time'}]}}
+        """
+        room_ids = list(room_ids)
+        rooms = self.env[HR_DEPARTMENT].browse(room_ids)
+        loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(room_ids)
+        durations = self.env[MATE_QUEUE_DURATION_STAT]._get_duration_estimates(
+            (room.service_id, room) for room in rooms)
+        tokens = self.search_fetch([
+            ('room_id', 'in', room_ids),
+            ('state', '=', 'waiting'),
+        ], ['name', 'room_id', 'state', 'position', 'queue_sequence', 'emergency', 'service_id'],
+            order='room_id, queue_sequence, position, id')
+        estimates = tokens._estimate_wait_times()
+
+        snapshots = {}
+        for room in rooms:
+            load = loads.get(room.id, {})
+            snapshots[room.id] = {
+                'room_id': room.id,
+                'queue_length': load.get('waiting_count', 0),
+                'in_progress_count': load.get('in_progress_count', 0),
+                'estimated_wait_time': load.get('estimated_wait_time', 0.0),
+                # Thời gian chờ thêm cho mỗi vị trí trong hàng
+                'wait_per_position': durations.get((room.service_id.id, room.id), 0.0) / (room.capacity or 1),
+                'tokens': [],
+            }
+        for token in tokens:
+            room_tokens = snapshots[token.room_id.id]['tokens']
+            room_tokens.append({
+                'id': token.id,
+                'name': token.name,
+                'position': len(room_tokens) + 1,
+                'emergency': token.emergency,
+                'wait_time': estimates[token.id]['wait_time'],
             })
+        return snapshots
 
-            # Sắp xếp lại hàng đợi vì token này đang được phục vụ
-            waiting_tokens = self.search([
-                ('room_id', '=', token.room_id.id),
-                ('state', '=', 'waiting')
-            ])
+    @profiled('start')
+    def action_start_service(self):
+        """Bắt đầu phục vụ các token (trạm có công suất > 1 có thể bắt đầu nhiều token cùng lúc)"""
+        if any(token.state != 'waiting' for token in self):
+            raise UserError(_("can_only_start_waiting_tokens"))
+        if not self:
+            return
 
-            # Sắp xếp theo ưu tiên (giảm dần) và ngày tạo (tăng dần)
-            sorted_tokens = waiting_tokens.sorted(key=lambda r: (-r.priority, r.create_date))
+        self.write({
+            'state': 'in_progress',
+            'start_time': fields.Datetime.now(),
+            'position': 0
+        })
 
-            # Cập nhật vị trí trong hàng đợi
-            for index, t in enumerate(sorted_tokens, 1):
-                t.position = index
+        # Sắp xếp lại hàng đợi của mỗi phòng một lần vì các token này đang được phục vụ
+        rooms = self.room_id
+        self._renumber_room_queues(rooms.ids)
 
-            # Thông báo cho màn hình phòng về sự thay đổi hàng đợi
-            self._notify_queue_change(token.room_id)
+        # Thông báo cho màn hình phòng về sự thay đổi hàng đợi
+        self._notify_queue_change(rooms)
 
+    @profiled('cancel')
     def action_cancel(self):
         """Hủy token này"""
         for token in self:
@@ -518,8 +762,9 @@ class QueueToken(models.Model):
             })
 
             # Sắp xếp lại hàng đợi
-            self._add_to_queue_and_sort()
+            token._add_to_queue_and_sort()
 
+    @profiled('emergency_override')
     def action_emergency_override(self):
         """Đánh dấu token là khẩn cấp và đưa lên đầu hàng đợi"""
         for token in self:
@@ -565,95 +810,32 @@ class QueueToken(models.Model):
 
     def _find_appropriate_route(self, current_service, package, patient):
         """Tìm tuyến đường phù hợp từ dịch vụ hiện tại"""
-        # Tìm tất cả các tuyến đường có thể từ dịch vụ hiện tại
-        all_routes = self.env[MATE_QUEUE_SERVICE_ROUTE].search([
-            ('service_from_id', '=', current_service.id)
-        ], order='sequence')
+        # Ưu tiên tuyến đường cụ thể cho gói dịch vụ, sau đó là tuyến không có điều kiện
+        # hoặc có điều kiện phù hợp (điều kiện đã được biên dịch sẵn trong bảng định tuyến)
+        route = self.env[MATE_QUEUE_SERVICE_ROUTE]._resolve_route(
+            current_service.id, package.id if package else False,
+            eval_context={
+                'patient': patient,
+                'current_service': current_service,
+                'package': package,
+            })
 
         # Nếu không có tuyến đường, trả về False
-        if not all_routes:
-            return False
-
-        # Ưu tiên tuyến đường cụ thể cho gói dịch vụ nếu có
-        if package:
-            package_routes = all_routes.filtered(lambda r: r.package_id.id == package.id)
-            if package_routes:
-                return package_routes[0].service_to_id
-
-        # Tìm tuyến đường không có điều kiện hoặc có điều kiện phù hợp
-        return self._evaluate_route_conditions(all_routes, patient, current_service, package)
-
-    def _evaluate_route_conditions(self, routes, patient, current_service, package):
-        """Đánh giá các điều kiện của tuyến đường"""
-        for route in routes:
-            if not route.condition or not route.condition.strip():
-                # Nếu không có điều kiện, sử dụng tuyến đường mặc định
-                return route.service_to_id
-            else:
-                # Đánh giá điều kiện
-                if self._check_route_condition(route, patient, current_service, package):
-                    return route.service_to_id
-
-        # Mặc định, trả về tuyến đường đầu tiên
-        return routes[0].service_to_id
-
-    def _check_route_condition(self, route, patient, current_service, package):
-        """Kiểm tra điều kiện của tuyến đường"""
-        # Chuẩn bị môi trường an toàn để đánh giá
-        local_dict = {
-            'patient': patient,
-            'current_service': current_service,
-            'package': package,
-        }
-        try:
-            return safe_eval(route.condition, local_dict=local_dict)
-        except Exception as e:
-            # Ghi log lỗi nhưng không làm gián đoạn luồng
-            _logger.error(f"Lỗi khi đánh giá điều kiện tuyến: {str(e)}")
+        if not route:
             return False
+        return self.env[PRODUCT_PRODUCT].browse(route.to_id)
 
     # Thêm các phương thức này vào class QueueToken
     def _send_notifications(self, notification_type):
         """
-        Gửi thông báo dựa trên loại thông báo và cấu hình hệ thống
+        Đưa thông báo cho các token vào hàng đợi gửi (mate.queue.notification)
+
+        Thông báo được cron gửi theo lô, không gửi SMS / email trong giao dịch hiện tại.
 
         Tham số:
             notification_type (str): Loại thông báo (new_token, token_called, room_change)
         """
-        self.ensure_one()
-        patient = self.patient_id
-
-        # Kiểm tra cấu hình thông báo
-        ir_config = self.env['ir.config_parameter'].sudo()
-        enable_sms = ir_config.get_param('mate_smart_queue.enable_sms', 'False').lower() == 'true'
-        enable_email = ir_config.get_param('mate_smart_queue.enable_email', 'False').lower() == 'true'
-
-        # Gửi thông báo SMS nếu được kích hoạt và bệnh nhân có số điện thoại
-        if enable_sms and patient.mobile:
-            self._send_sms_notification(notification_type, ir_config)
-
-        # Gửi thông báo email nếu được kích hoạt và bệnh nhân có email
-        if enable_email and patient.email:
-            self._send_email_notification(notification_type, ir_config)
-
-    def _send_sms_notification(self, notification_type, ir_config):
-        """Gửi thông báo SMS dựa trên loại thông báo"""
-        try:
-            template_id = self._get_sms_template_id(notification_type, ir_config)
-            if template_id:
-                self.env['sms.template'].browse(template_id).send_sms(self.id)
-        except Exception as e:
-            _logger.error("Lỗi khi gửi SMS: %s", str(e))
-
-    def _send_email_notification(self, notification_type, ir_config):
-        """Gửi thông báo email dựa trên loại thông báo"""
-        try:
-            template_id = self._get_email_template_id(notification_type, ir_config)
-            if template_id:
-                template = self.env['mail.template'].browse(template_id)
-                template.send_mail(self.id, force_send=True)
-        except Exception as e:
-            _logger.error("Lỗi khi gửi email: %s", str(e))
+        return self.env[MATE_QUEUE_NOTIFICATION]._enqueue(self, notification_type)
 
     def _get_sms_template_id(self, notification_type, ir_config):
         """Lấy ID mẫu SMS dựa trên loại thông báo"""
@@ -678,146 +860,320 @@ class QueueToken(models.Model):
         return False
 
     @api.model
-    def _run_load_balancing(self):
-        """Công việc định kỳ cân bằng tải giữa các phòng"""
-        # Lấy cấu hình cân bằng tải
-        config = self._get_load_balancing_config()
+    def _cron_run_load_balancing(self):
+        """
+        Công việc định kỳ cân bằng tải, chỉ chạy khi bật tham số
+        mate_smart_queue.load_balancing_enabled (mặc định tắt) vì nó tự chuyển phòng bệnh nhân
+        """
+        ir_config = self.env['ir.config_parameter'].sudo()
+        if ir_config.get_param('mate_smart_queue.load_balancing_enabled', 'False').lower() != 'true':
+            return False
+        return self._run_load_balancing()
 
-        # Tìm phòng mở và đóng
-        open_rooms, closed_rooms = self._get_rooms_by_state()
+    @api.model
+    @profiled('load_balancing')
+    def _run_load_balancing(self, dry_run=False):
+        """
+        Công việc định kỳ cân bằng tải giữa các phòng
 
-        # Nếu không có phòng mở nào, không thực hiện cân bằng tải
-        if not open_rooms:
-            return
+        Mỗi dịch vụ được giải như một bài toán phân bổ: tìm số token chuyển giữa các phòng
+        cùng dịch vụ sao cho tổng thời gian chờ kỳ vọng cộng chi phí di chuyển
+        (queue.room.distance) là nhỏ nhất. Token trong phòng đóng luôn được chuyển đi.
+        Các lượt chuyển được ghi một lần, thông báo cho bệnh nhân được đưa vào hàng đợi.
 
-        # Xử lý các phòng đã đóng
-        self._process_closed_rooms(closed_rooms, open_rooms)
+        Tham số:
+            dry_run (bool): Chỉ tính phương án, không chuyển token
 
-        # Phân loại phòng thành quá tải và nhàn rỗi
-        overloaded_rooms, underloaded_rooms = self._classify_rooms_by_load(open_rooms, config['wait_threshold'])
+        Trả về:
+            dict: {
+                'moves': [{'token_id', 'token', 'from_room_id', 'to_room_id'}],
+                'wait_before': tổng thời gian chờ trước (phút),
+                'wait_after': tổng thời gian chờ sau (phút),
+                'wait_reduction': thời gian chờ giảm được (phút),
+                'complete': False nếu hết thời gian trước khi xét hết các dịch vụ,
+            }
+        """
+        config = self._get_load_balancing_config()
+        deadline = time.monotonic() + config['time_budget']
 
-        # Xử lý các phòng quá tải
-        self._process_overloaded_rooms(overloaded_rooms, underloaded_rooms, config['max_patients_to_move'])
+        rooms = self.env[HR_DEPARTMENT].search([('service_id', '!=', False)])
+        rooms_by_service = defaultdict(lambda: self.env[HR_DEPARTMENT])
+        for room in rooms:
+            rooms_by_service[room.service_id] |= room
+        loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(rooms.ids)
+        distances = self.env[QUEUE_ROOM_DISTANCE]._get_distance_map(rooms.ids)
+
+        report = {'moves': [], 'wait_before': 0.0, 'wait_after': 0.0, 'complete': True}
+        flows = {}
+        for service, service_rooms in rooms_by_service.items():
+            if time.monotonic() > deadline:
+                report['complete'] = False
+                break
+            plan = self._plan_service_balancing(service, service_rooms, loads, distances, config, deadline)
+            report['wait_before'] += plan['wait_before']
+            report['wait_after'] += plan['wait_after']
+            report['complete'] = report['complete'] and plan['complete']
+            flows.update(plan['flows'])
+
+        moves = self._select_tokens_to_move(flows)
+        report['wait_reduction'] = report['wait_before'] - report['wait_after']
+        report['moves'] = [{
+            'token_id': token.id,
+            'token': token.name,
+            'from_room_id': source_room.id,
+            'to_room_id': target_room.id,
+        } for token, source_room, target_room in moves]
+
+        if moves and not dry_run:
+            self._apply_load_balancing_moves(moves)
+
+        _logger.info("Cân bằng tải%s: %d token, giảm %.1f phút chờ%s",
+                     " (dry run)" if dry_run else "", len(moves), report['wait_reduction'],
+                     "" if report['complete'] else " (hết thời gian)")
+        return report
 
     def _get_load_balancing_config(self):
         """Lấy cấu hình cân bằng tải từ tham số hệ thống"""
         ir_config = self.env['ir.config_parameter'].sudo()
         return {
-            'wait_threshold': float(ir_config.get_param('mate_smart_queue.wait_threshold', '30.0')),
-            'max_patients_to_move': int(ir_config.get_param('mate_smart_queue.max_patients_to_move', '3'))
+            # Số token tối đa chuyển khỏi một phòng đang mở trong một lần chạy
+            'max_patients_to_move': int(ir_config.get_param('mate_smart_queue.max_patients_to_move', '3')),
+            # Số phút chờ tương đương với một đơn vị khoảng cách giữa hai phòng
+            'travel_weight': float(ir_config.get_param('mate_smart_queue.balancing_travel_weight', '1.0')),
+            # Số phút chờ tối thiểu phải giảm được để đáng chuyển một bệnh nhân
+            'move_penalty': float(ir_config.get_param('mate_smart_queue.balancing_move_penalty', '5.0')),
+            # Thời gian chạy tối đa (giây) của một lần cân bằng tải
+            'time_budget': float(ir_config.get_param('mate_smart_queue.balancing_time_budget', '20.0')),
         }
 
-    def _get_rooms_by_state(self):
-        """Phân loại phòng theo trạng thái (mở/đóng)"""
-        open_rooms = self.env[HR_DEPARTMENT].search([('state', '=', 'open')])
-        closed_rooms = self.env[HR_DEPARTMENT].search([('state', '!=', 'open')])
-        return open_rooms, closed_rooms
-
-    def _classify_rooms_by_load(self, open_rooms, wait_threshold):
-        """Phân loại phòng thành quá tải và nhàn rỗi"""
-        overloaded_rooms = []
-        underloaded_rooms = []
-
-        for room in open_rooms:
-            if room.estimated_wait_time > wait_threshold:
-                overloaded_rooms.append(room)
-            elif room.queue_length <= 2:  # Phòng có ít hơn hoặc bằng 2 token đang chờ
-                underloaded_rooms.append(room)
-
-        return overloaded_rooms, underloaded_rooms
-
-    def _process_closed_rooms(self, closed_rooms, open_rooms):
-        """Xử lý token trong các phòng đã đóng"""
-        for closed_room in closed_rooms:
-            # Tìm các token đang chờ trong phòng đã đóng
-            waiting_tokens = self.search([
-                ('room_id', '=', closed_room.id),
-                ('state', '=', 'waiting')
-            ])
-
-            if not waiting_tokens:
-                continue
-
-            # Tìm phòng mở cùng dịch vụ
-            service_id = closed_room.service_id.id
-            compatible_open_rooms = [r for r in open_rooms if r.service_id.id == service_id]
-
-            if not compatible_open_rooms:
-                continue
-
-            # Tìm phòng ít tải nhất
-            target_room = min(compatible_open_rooms, key=lambda r: r.estimated_wait_time)
+    @api.model
+    def _plan_service_balancing(self, service, rooms, loads, distances, config, deadline):
+        """
+        Tính phương án chuyển token giữa các phòng của một dịch vụ
 
-            # Di chuyển token
-            self._move_tokens_to_room(waiting_tokens, closed_room, target_room)
+        Thời gian chờ của token thứ k trong phòng là k * thời gian trung bình / công suất,
+        nên tổng thời gian chờ của phòng là hàm lồi theo số token. Bài toán vận chuyển với
+        chi phí lồi này được giải bằng cách lặp: mỗi bước chọn lượt chuyển một token
+        (từ phòng gốc, đang ở phòng hiện tại, sang phòng mới) giảm tổng chi phí nhiều nhất,
+        dừng khi không còn lượt chuyển nào có lợi hoặc hết thời gian.
 
-    def _process_overloaded_rooms(self, overloaded_rooms, underloaded_rooms, max_patients_to_move):
-        """Xử lý các phòng quá tải"""
-        for o_room in overloaded_rooms:
-            service = o_room.service_id
+        Trả về:
+            dict: {'flows': {(source_room_id, target_room_id): số token},
+                   'wait_before': phút, 'wait_after': phút, 'complete': bool}
+        """
+        duration = service.average_duration or 0.0
+        open_ids = set(rooms.filtered(lambda r: r.state == 'open').ids)
+        counts = {room.id: loads.get(room.id, {}).get('waiting_count', 0) for room in rooms}
+        rates = {room.id: duration / (room.capacity or 1) for room in rooms}
+
+        def room_wait(room_id, count):
+            return rates[room_id] * count * (count - 1) / 2
+
+        def marginal_remove(room_id):
+            # Chi phí giảm được khi lấy token cuối hàng ra khỏi phòng
+            penalty = 0.0 if room_id in open_ids else CLOSED_ROOM_PENALTY
+            return rates[room_id] * (counts[room_id] - 1) + penalty
+
+        def travel(source_id, target_id):
+            if source_id == target_id:
+                return 0.0
+            distance = distances.get((source_id, target_id), DEFAULT_ROOM_DISTANCE)
+            return distance * config['travel_weight'] + config['move_penalty']
+
+        wait_before = sum(room_wait(room_id, count) for room_id, count in counts.items())
+        if not open_ids:
+            return {'flows': {}, 'wait_before': wait_before, 'wait_after': wait_before, 'complete': True}
+
+        # flows[source][current]: số token gốc ở source hiện được xếp vào current
+        flows = defaultdict(lambda: defaultdict(int))
+        for room_id, count in counts.items():
+            movable = count if room_id not in open_ids else min(count, config['max_patients_to_move'])
+            if movable:
+                flows[room_id][room_id] = movable
+
+        complete = True
+        while True:
+            if time.monotonic() > deadline:
+                complete = False
+                break
+            best_move, best_delta = None, -FLOAT_EPSILON
+            for source_id, placements in flows.items():
+                for current_id, count in placements.items():
+                    if not count:
+                        continue
+                    gain = marginal_remove(current_id) + travel(source_id, current_id)
+                    for target_id in open_ids:
+                        if target_id == current_id:
+                            continue
+                        delta = rates[target_id] * counts[target_id] + travel(source_id, target_id) - gain
+                        if delta < best_delta:
+                            best_move, best_delta = (source_id, current_id, target_id), delta
+            if not best_move:
+                break
+            source_id, current_id, target_id = best_move
+            flows[source_id][current_id] -= 1
+            flows[source_id][target_id] += 1
+            counts[current_id] -= 1
+            counts[target_id] += 1
 
-            # Tìm các phòng ít tải tương thích
-            compatible_rooms = [
-                r for r in underloaded_rooms
-                if r.service_id.id == service.id
-            ]
+        return {
+            'flows': {
+                (source_id, target_id): count
+                for source_id, placements in flows.items()
+                for target_id, count in placements.items()
+                if count and target_id != source_id
+            },
+            'wait_before': wait_before,
+            'wait_after': sum(room_wait(room_id, count) for room_id, count in counts.items()),
+            'complete': complete,
+        }
 
-            if not compatible_rooms:
-                continue
+    @api.model
+    def _select_tokens_to_move(self, flows):
+        """
+        Chọn token cụ thể cho phương án chuyển phòng: lấy các token cuối hàng của phòng nguồn
 
-            # Lấy các token để di chuyển (tối đa theo cấu hình)
-            tokens_to_move = self.search([
-                ('room_id', '=', o_room.id),
-                ('state', '=', 'waiting')
-            ], order='position desc', limit=max_patients_to_move)
+        Args:
+            flows: {(source_room_id, target_room_id): số token}
 
-            if not tokens_to_move:
-                continue
+        Returns:
+            list: [(token, source_room, target_room)]
+        """
+        if not flows:
+            return []
 
-            # Tìm phòng ít tải nhất
-            target_room = min(compatible_rooms, key=lambda r: r.estimated_wait_time)
+        outgoing = defaultdict(list)
+        for (source_id, target_id), count in sorted(flows.items()):
+            outgoing[source_id].extend([target_id] * count)
 
-            # Di chuyển token
-            self._move_tokens_to_room(tokens_to_move, o_room, target_room)
+        tokens = self.search_fetch([
+            ('room_id', 'in', list(outgoing)),
+            ('state', '=', 'waiting'),
+        ], ['room_id'], order='room_id, queue_sequence desc, position desc, id desc')
 
-    def _move_tokens_to_room(self, tokens, source_room, target_room):
-        """Di chuyển danh sách token từ phòng nguồn sang phòng đích"""
+        rooms = self.env[HR_DEPARTMENT].browse({room_id for flow in flows for room_id in flow})
+        rooms_by_id = {room.id: room for room in rooms}
+        moves = []
         for token in tokens:
-            old_room = token.room_id
-            token.room_id = target_room.id
+            targets = outgoing.get(token.room_id.id)
+            if targets:
+                moves.append((token, token.room_id, rooms_by_id[targets.pop()]))
+        return moves
 
-            # Ghi log chuyển phòng
-            message = _("token_moved_from_room_to_room") % (old_room.name, target_room.name)
-            token.message_post(
-                body=message,
-                subject=_("automatic_room_change_notification")
-            )
-
-            # Gửi thông báo cho bệnh nhân
-            token._send_notifications('room_change')
+    def _apply_load_balancing_moves(self, moves):
+        """
+        Áp dụng phương án chuyển phòng
 
-        # Sắp xếp lại thứ tự trong các phòng
-        self._reorder_room_queue(source_room)
-        self._reorder_room_queue(target_room)
+        Args:
+            moves: [(token, source_room, target_room)]
+        """
+        tokens_by_target = defaultdict(lambda: self.browse())
+        for token, source_room, target_room in moves:
+            tokens_by_target[target_room] |= token
+        for target_room, tokens in tokens_by_target.items():
+            tokens.write({'room_id': target_room.id})
+
+        # Ghi log chuyển phòng cho tất cả token trong một lần
+        self.env['mail.message'].sudo().create([{
+            'model': MATE_QUEUE_TOKEN,
+            'res_id': token.id,
+            'message_type': 'notification',
+            'subject': _("automatic_room_change_notification"),
+            'body': _("token_moved_from_room_to_room") % (source_room.name, target_room.name),
+        } for token, source_room, target_room in moves])
+
+        # Sắp xếp lại thứ tự trong các phòng liên quan một lần
+        touched_rooms = self.env[HR_DEPARTMENT].browse(
+            {room.id for _token, source_room, target_room in moves for room in (source_room, target_room)})
+        self._renumber_room_queues(touched_rooms.ids)
+
+        # Thông báo cho bệnh nhân được đưa vào hàng đợi gửi, không gửi ngay trong cron
+        self.browse([token.id for token, _source_room, _target_room in moves])._send_notifications('room_change')
 
         # Thông báo cho màn hình hiển thị
-        self._notify_queue_change(source_room)
-        self._notify_queue_change(target_room)
+        self._notify_queue_change(touched_rooms)
 
     # Thêm phương thức hỗ trợ sắp xếp lại hàng đợi trong phòng
     def _reorder_room_queue(self, room):
         """Sắp xếp lại thứ tự hàng đợi trong một phòng"""
-        waiting_tokens = self.search([
-            ('room_id', '=', room.id),
-            ('state', '=', 'waiting')
-        ])
+        self._renumber_room_queues(room.ids)
+
+    @api.model
+    def _renumber_room_queues(self, room_ids, order_sql=QUEUE_ORDER_SQL, log_changes=True):
+        """
+        Đánh số lại vị trí hàng đợi của các phòng bằng một câu lệnh SQL
 
-        # Sắp xếp theo mức ưu tiên (giảm dần) và thời gian tạo (tăng dần)
-        sorted_tokens = waiting_tokens.sorted(key=lambda r: (-r.priority, r.create_date))
+        Vị trí được tính bằng ROW_NUMBER() theo order_sql (mặc định QUEUE_ORDER_SQL),
+        queue_sequence được giãn đều lại theo QUEUE_SEQUENCE_GAP, và chỉ các token
+        thay đổi mới bị ghi. Việc ghi trực tiếp bỏ qua tracking từng token;
+        thay vào đó mỗi phòng nhận một ghi chú tóm tắt trên chatter.
 
-        # Cập nhật vị trí
-        for index, token in enumerate(sorted_tokens):
-            token.position = index + 1
+        Tham số:
+            room_ids: Danh sách ID phòng, None để đánh số lại tất cả phòng
+
+        Trả về:
+            dict: {room_id: [(token_id, old_position, new_position), ...]}
+        """
+        room_params = []
+        if room_ids is None:
+            room_clause = "room_id IS NOT NULL"
+        else:
+            room_ids = tuple({room_id for room_id in room_ids if room_id})
+            if not room_ids:
+                return {}
+            room_clause = "room_id IN %s"
+            room_params.append(room_ids)
+
+        self.flush_model(['room_id', 'state', 'emergency', 'priority', 'position', 'queue_sequence'])
+        self.env.cr.execute(f"""
+            UPDATE {self._table} AS token
+               SET position = ranked.new_position,
+                   queue_sequence = ranked.new_position * %s,
+                   write_uid = %s,
+                   write_date = (now() at time zone 'UTC')
+              FROM (
+                    SELECT id,
+                           position AS old_position,
+                           ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY {order_sql}) AS new_position
+                      FROM {self._table}
+                     WHERE state = 'waiting'
+                       AND {room_clause}
+                   ) AS ranked
+             WHERE token.id = ranked.id
+               AND (token.position IS DISTINCT FROM ranked.new_position
+                    OR token.queue_sequence IS DISTINCT FROM ranked.new_position * %s)
+         RETURNING token.id, token.room_id, ranked.old_position, ranked.new_position
+        """, [QUEUE_SEQUENCE_GAP, self.env.uid, *room_params, QUEUE_SEQUENCE_GAP])
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return {}
+
+        self.invalidate_model(['position', 'queue_sequence', 'queue_rank', 'write_uid', 'write_date'])
+
+        changes = defaultdict(list)
+        for token_id, room_id, old_position, new_position in rows:
+            if (old_position or 0) != new_position:
+                changes[room_id].append((token_id, old_position or 0, new_position))
+        if log_changes and changes:
+            self._log_queue_renumbering(changes)
+        return changes
+
+    @api.model
+    def _log_queue_renumbering(self, changes):
+        """
+        Ghi một dòng log cho cả lần đánh số lại thay vì tracking từng token
+
+        Không ghi vào chatter của phòng: việc đánh số lại xảy ra ở mọi sự kiện hàng đợi
+        nên mỗi tin nhắn / phòng sẽ làm ngập chatter. Chi tiết từng token ở mức debug.
+        """
+        moved = sum(len(moves) for moves in changes.values())
+        _logger.info("Đánh số lại hàng đợi: %d phòng, %d token đổi vị trí", len(changes), moved)
+        if _logger.isEnabledFor(logging.DEBUG):
+            for room_id, moves in changes.items():
+                _logger.debug("Đánh số lại hàng đợi phòng %s: %s", room_id, ", ".join(
+                    f"{token_id}: {old_position} → {new_position}"
+                    for token_id, old_position, new_position in sorted(moves, key=lambda move: move[2])
+                ))
 
     # Thêm các phương thức mới vào queue_token.py để xử lý nhóm dịch vụ
     def _process_service_group_completion(self, token, service_group, patient, package):
@@ -826,16 +1182,16 @@ class QueueToken(models.Model):
         group_completed = self._check_service_group_completion(service_group, patient)
 
         if group_completed:
-            _logger.info("Nhóm dịch vụ %s đã hoàn thành. Tìm nhóm tiếp theo", service_group.name)
+            _logger.debug("Nhóm dịch vụ %s đã hoàn thành. Tìm nhóm tiếp theo", service_group.name)
             # Tìm nhóm dịch vụ tiếp theo
             next_group = self._get_next_service_group(service_group, package)
 
             if next_group:
-                _logger.info("Tìm thấy nhóm dịch vụ tiếp theo: %s", next_group.name)
+                _logger.debug("Tìm thấy nhóm dịch vụ tiếp theo: %s", next_group.name)
                 # Tạo token cho tất cả dịch vụ trong nhóm tiếp theo
                 self._create_tokens_for_service_group(next_group, patient, token)
             else:
-                _logger.info("Không có nhóm dịch vụ tiếp theo cho bệnh nhân %s", patient.name)
+                _logger.debug("Không có nhóm dịch vụ tiếp theo cho bệnh nhân %s", patient.name)
                 # Thông báo hoàn thành
                 return {
                     'type': IR_ACTIONS_CLIENT,
@@ -862,7 +1218,7 @@ class QueueToken(models.Model):
         # Lấy tất cả dịch vụ trong nhóm
         group_services = service_group.service_ids
 
-        _logger.info(
+        _logger.debug(
             "Kiểm tra hoàn thành nhóm %s: Dịch vụ hoàn thành: %s, Dịch vụ trong nhóm: %s",
             service_group.name,
             ', '.join(completed_services.mapped('name')),
@@ -873,7 +1229,7 @@ class QueueToken(models.Model):
         completed_in_group = len(group_services & completed_services)
         total_in_group = len(group_services)
 
-        _logger.info(
+        _logger.debug(
             "Đã hoàn thành %d/%d dịch vụ trong nhóm %s",
             completed_in_group, total_in_group, service_group.name
         )
@@ -898,149 +1254,119 @@ class QueueToken(models.Model):
         if not current_group:
             return False
 
-        # Tìm tất cả tuyến đường từ nhóm hiện tại
-        routes = self.env[MATE_QUEUE_SERVICE_GROUP_ROUTE].search([
-            ('group_from_id', '=', current_group.id)
-        ], order='sequence')
-
-        if not routes:
-            _logger.info("Không tìm thấy tuyến đường nào từ nhóm %s", current_group.name)
+        route = self.env[MATE_QUEUE_SERVICE_GROUP_ROUTE]._resolve_route(
+            current_group.id, package.id if package else False)
+        if not route:
+            _logger.debug("Không tìm thấy tuyến đường nào từ nhóm %s", current_group.name)
             return False
-
-        # Tìm tuyến đường phù hợp với gói
-        if package:
-            package_routes = routes.filtered(lambda r: r.package_id and r.package_id.id == package.id)
-            if package_routes:
-                return package_routes[0].group_to_id
-
-        # Tìm tuyến đường không có gói cụ thể
-        general_routes = routes.filtered(lambda r: not r.package_id)
-        if general_routes:
-            return general_routes[0].group_to_id
-
-        # Nếu không có tuyến đường nào phù hợp, trả về nhóm đầu tiên
-        return routes[0].group_to_id
+        return self.env[MATE_HEALTH_CHECK_GROUP].browse(route.to_id)
 
     # Thêm các phương thức mới
     def _compute_next_recommended_service(self):
         """Tính toán dịch vụ nên thực hiện tiếp theo"""
+        # Gom các token song song còn token draft để chấm điểm chung một lần
+        requests = []
         for token in self:
-            # Nếu là token song song và còn token khác chưa hoàn thành
             if token.is_parallel and token.parallel_token_ids:
-                # Lấy các token song song ở trạng thái draft
                 draft_tokens = token.parallel_token_ids.filtered(lambda t: t.state == 'draft')
-
                 if draft_tokens:
-                    # Tìm token tối ưu nhất
-                    optimal_token = self._calculate_optimal_service(draft_tokens.ids)
-                    if optimal_token:
-                        token.next_recommended_service_id = optimal_token.service_id
-                        continue
+                    requests.append((token, draft_tokens))
 
-            # Nếu không phải trường hợp song song hoặc không tìm thấy token tối ưu
-            token.next_recommended_service_id = False
+        optimal_tokens = self._recommend_next_tokens(requests)
+        recommended = {token.id: optimal for (token, _candidates), optimal in zip(requests, optimal_tokens)}
+        for token in self:
+            optimal_token = recommended.get(token.id)
+            token.next_recommended_service_id = optimal_token.service_id if optimal_token else False
 
     def _calculate_optimal_service(self, token_ids):
-        """Tính toán dịch vụ tối ưu nhất để thực hiện tiếp theo"""
+        """
+        Tính toán dịch vụ tối ưu nhất để thực hiện tiếp theo, tính từ phòng hiện tại của token
+
+        Gọi trên đúng token gốc của bệnh nhân (không phải cả lô đang xử lý).
+        """
+        self.ensure_one()
         tokens = self.browse(token_ids)
 
         if not tokens:
             return False
 
-        # Trọng số cho các tiêu chí
-        WEIGHT_MOVEMENT = 0.4  # Trọng số cho thời gian di chuyển
-        WEIGHT_WAITING = 0.35  # Trọng số cho thời gian chờ đợi tại phòng
-        WEIGHT_DURATION = 0.15  # Trọng số cho thời gian thực hiện dịch vụ
-        WEIGHT_MEDICAL = 0.1  # Trọng số cho ưu tiên y tế
-
-        best_token = False
-        best_score = float('inf')  # Điểm càng thấp càng tốt
+        return self._recommend_next_tokens([(self, tokens)])[0]
 
-        # Lấy vị trí hiện tại (phòng hiện tại)
-        current_location = self.room_id if self.room_id else None
-
-        for token in tokens:
-            # 1. Điểm di chuyển (dựa trên khoảng cách giữa các phòng)
-            movement_score = self._calculate_distance_score(current_location, token.room_id) if current_location else 5
-
-            # 2. Điểm thời gian chờ
-            waiting_tokens = self.search_count([
-                ('room_id', '=', token.room_id.id),
-                ('state', '=', 'waiting')
-            ])
-            capacity = token.room_id.capacity if token.room_id.capacity > 0 else 1
-            waiting_score = waiting_tokens / capacity * 10  # Chuẩn hóa 0-10
-
-            # 3. Điểm thời gian thực hiện
-            duration_score = token.service_id.average_duration / 10  # Chuẩn hóa, giả sử max 100 phút
-
-            # 4. Điểm ưu tiên y tế (càng thấp càng ưu tiên)
-            medical_priority = {
-                'BLOOD': 1,  # Xét nghiệm máu ưu tiên cao nhất
-                'XRAY': 3,
-                'ULTRA': 4,
-                'DOC': 2,
-                'VITAL': 5,
-                'REG': 10
-            }
-            med_score = medical_priority.get(token.service_id.code, 5)
+    def _get_recommendation_weights(self):
+        """Lấy trọng số chấm điểm dịch vụ tiếp theo từ tham số hệ thống"""
+        ir_config = self.env['ir.config_parameter'].sudo()
+        return {
+            criterion: float(ir_config.get_param(f'mate_smart_queue.recommend_weight_{criterion}', default))
+            for criterion, default in RECOMMENDATION_WEIGHTS.items()
+        }
 
-            # Tính tổng điểm (điểm thấp hơn = ưu tiên cao hơn)
-            total_score = (
-                WEIGHT_MOVEMENT * movement_score + WEIGHT_WAITING * waiting_score + WEIGHT_DURATION * duration_score + WEIGHT_MEDICAL * med_score)
+    @api.model
+    def _recommend_next_tokens(self, requests):
+        """
+        Chấm điểm tất cả cặp (token gốc, token ứng viên) trong một lượt
 
-            _logger.info(
-                "Token %s - Di chuyển: %.2f, Chờ: %.2f, Thời gian: %.2f, Y tế: %.2f, Tổng: %.2f",
-                token.name, movement_score, waiting_score, duration_score, med_score, total_score
-            )
+        Tải phòng lấy từ snapshot tải phòng (một truy vấn), khoảng cách lấy từ ma trận
+        khoảng cách đã cache, trọng số lấy từ tham số hệ thống.
 
-            if total_score < best_score:
-                best_score = total_score
-                best_token = token
+        Args:
+            requests: [(origin_token, candidate_tokens)], origin_token có thể rỗng
 
-        return best_token
+        Returns:
+            list: token ứng viên tối ưu (hoặc False) theo thứ tự của requests
+        """
+        if not requests:
+            return []
+
+        candidates = self.browse().union(*(candidate_tokens for _origin, candidate_tokens in requests))
+        origins = self.browse().union(*(origin for origin, _candidate_tokens in requests))
+        loads = self.env[MATE_QUEUE_ROOM_LOAD]._get_room_loads(candidates.room_id.ids)
+        distances = self.env[QUEUE_ROOM_DISTANCE]._get_distance_map((origins.room_id | candidates.room_id).ids)
+        weights = self._get_recommendation_weights()
+
+        # Điểm không phụ thuộc vị trí hiện tại được tính một lần cho mỗi ứng viên
+        static_scores = {}
+        for candidate in candidates:
+            room = candidate.room_id
+            waiting_count = loads.get(room.id, {}).get('waiting_count', 0)
+            # Điểm thời gian chờ, chuẩn hóa 0-10
+            waiting_score = waiting_count / (room.capacity if room.capacity > 0 else 1) * 10
+            # Điểm thời gian thực hiện, chuẩn hóa giả sử tối đa 100 phút
+            duration_score = candidate.service_id.average_duration / 10
+            # Điểm ưu tiên y tế (càng thấp càng ưu tiên)
+            med_score = SERVICE_MEDICAL_PRIORITY.get(candidate.service_id.code, 5)
+            static_scores[candidate.id] = (
+                weights['waiting'] * waiting_score + weights['duration'] * duration_score + weights['medical'] * med_score)
+
+        def distance_score(from_room, to_room):
+            if not from_room or not to_room:
+                return DEFAULT_ROOM_DISTANCE
+            if from_room == to_room:
+                return 0.0
+            return distances.get((from_room.id, to_room.id), DEFAULT_ROOM_DISTANCE)
+
+        results = []
+        for origin, candidate_tokens in requests:
+            best_token = False
+            best_score = float('inf')  # Điểm càng thấp càng tốt
+            for candidate in candidate_tokens:
+                # Điểm di chuyển (dựa trên khoảng cách giữa các phòng)
+                movement_score = distance_score(origin.room_id, candidate.room_id)
+                total_score = weights['movement'] * movement_score + static_scores[candidate.id]
+                _logger.debug("Token %s - Di chuyển: %.2f, Tổng: %.2f", candidate.name, movement_score, total_score)
+
+                if total_score < best_score:
+                    best_score = total_score
+                    best_token = candidate
+            results.append(best_token)
+        return results
 
     def _calculate_distance_score(self, from_room, to_room):
         """Tính điểm khoảng cách giữa các phòng"""
         if not from_room or not to_room:
-            return 5  # Giá trị mặc định
-
-        if from_room.id == to_room.id:
-            return 0  # Cùng phòng
-
-        # Ma trận khoảng cách thực tế giữa các phòng
-        distance_matrix = {
-            # Format: ('from_code', 'to_code'): distance_value
-            ('REG01', 'BLOOD01'): 2,
-            ('REG01', 'XRAY01'): 4,
-            ('REG01', 'UTR01'): 4,
-            ('REG01', 'DOC01'): 3,
-            ('REG01', 'DOC02'): 3,
-            ('BLOOD01', 'XRAY01'): 3,
-            ('BLOOD01', 'UTR01'): 2,
-            ('BLOOD01', 'DOC01'): 4,
-            ('BLOOD01', 'DOC02'): 4,
-            ('XRAY01', 'UTR01'): 1,
-            ('XRAY01', 'DOC01'): 3,
-            ('XRAY01', 'DOC02'): 3,
-            ('UTR01', 'DOC01'): 3,
-            ('UTR01', 'DOC02'): 3,
-            ('DOC01', 'DOC02'): 1,
-            ('DOC01', 'PHARM01'): 2,
-            ('DOC02', 'PHARM01'): 2,
-        }
-
-        # Tìm khoảng cách trong ma trận
-        key = (from_room.code, to_room.code)
-        reverse_key = (to_room.code, from_room.code)
+            return DEFAULT_ROOM_DISTANCE  # Giá trị mặc định
 
-        if key in distance_matrix:
-            return distance_matrix[key]
-        elif reverse_key in distance_matrix:
-            return distance_matrix[reverse_key]
-        else:
-            # Nếu không tìm thấy trực tiếp, tìm đường đi gián tiếp (có thể triển khai thuật toán đường đi ngắn nhất)
-            return 5  # Mặc định
+        # Khoảng cách ngắn nhất theo ma trận khoảng cách (đã cache), kể cả đường đi gián tiếp
+        return self.env[QUEUE_ROOM_DISTANCE].get_distance(from_room.id, to_room.id)
 
     def _create_tokens_for_service_group(self, service_group, patient, origin_token, state='draft'):
         """Tạo token cho tất cả dịch vụ trong nhóm"""
@@ -1058,13 +1384,13 @@ class QueueToken(models.Model):
         # Tạo token cho từng dịch vụ trong nhóm
         created_tokens = self.env[MATE_QUEUE_TOKEN]
         for service in service_group.service_ids:
-            _logger.info("Tạo token cho dịch vụ %s trong nhóm %s", service.name, service_group.name)
+            _logger.debug("Tạo token cho dịch vụ %s trong nhóm %s", service.name, service_group.name)
 
             # Tạo token mới với các tham số đã chuẩn bị
             token_vals = dict(token_params, service_id=service.id)
             new_token = self.create(token_vals)
             created_tokens += new_token
-            _logger.info("Đã tạo token %s cho dịch vụ %s thuộc nhóm %s",
+            _logger.debug("Đã tạo token %s cho dịch vụ %s thuộc nhóm %s",
                          new_token.name, service.name, service_group.name)
 
         # Liên kết các token song song nếu có nhiều hơn 1 token
@@ -1092,38 +1418,42 @@ class QueueToken(models.Model):
 
     def _link_parallel_tokens(self, tokens):
         """Liên kết các token song song với nhau"""
-        _logger.info("Liên kết %s token song song với nhau", len(tokens))
+        _logger.debug("Liên kết %s token song song với nhau", len(tokens))
         for token in tokens:
             other_tokens = tokens - token
             token.write({
                 'parallel_token_ids': [(6, 0, other_tokens.ids)],
             })
 
+    @profiled('complete')
     def action_complete_service(self):
-        """Hoàn tất việc phục vụ token này"""
-        for token in self:
-            if token.state != 'in_progress':
-                raise UserError(_("can_only_complete_in_progress_tokens"))
-
-            # Lấy thông tin cơ bản
-            context = self._prepare_completion_context(token)
+        """Hoàn tất việc phục vụ các token (xử lý cả lô trong một lượt)"""
+        if any(token.state != 'in_progress' for token in self):
+            raise UserError(_("can_only_complete_in_progress_tokens"))
+        if not self:
+            return {'type': 'ir.actions.act_window_close'}
 
-            # Cập nhật trạng thái token và thời gian
-            self._update_token_completion_status(token)
+        # Cập nhật trạng thái token và thời gian
+        self._update_token_completion_status()
 
-            # Cập nhật thời gian phục vụ trung bình của dịch vụ
-            self._update_service_stats(context)
+        # Cập nhật thời gian phục vụ trung bình của dịch vụ (một lần cho mỗi dịch vụ)
+        self._update_service_stats()
 
-            # Cập nhật dịch vụ đã hoàn thành cho bệnh nhân
-            self._update_patient_completed_services(context)
+        # Cập nhật dịch vụ đã hoàn thành cho bệnh nhân (một lần cho mỗi bệnh nhân)
+        self._update_patient_completed_services()
 
-            # Xử lý tiếp theo dựa trên loại token
+        # Xử lý tiếp theo dựa trên loại token
+        results = []
+        for token in self:
+            context = self._prepare_completion_context(token)
             result = self._process_token_completion(token, context)
+            if result:
+                results.append(result)
 
-            # Thông báo cho màn hình phòng về sự thay đổi hàng đợi
-            self._notify_queue_change(token.room_id)
+        # Thông báo cho màn hình phòng về sự thay đổi hàng đợi
+        self._notify_queue_change(self.room_id)
 
-            return result if result else {'type': 'ir.actions.act_window_close'}
+        return self._merge_completion_results(results)
 
     def _prepare_completion_context(self, token):
         """Chuẩn bị ngữ cảnh cho việc hoàn thành token"""
@@ -1134,31 +1464,65 @@ class QueueToken(models.Model):
             'package': token.patient_id.queue_package_id,
         }
 
-    def _update_token_completion_status(self, token):
-        """Cập nhật trạng thái hoàn thành cho token"""
-        token.write({
+    def _update_token_completion_status(self):
+        """Cập nhật trạng thái hoàn thành cho các token"""
+        self.write({
             'state': 'completed',
             'end_time': fields.Datetime.now()
         })
 
-    def _update_service_stats(self, context):
-        """Cập nhật thống kê dịch vụ"""
-        token = context['token']
-        current_service = context['current_service']
-
-        if token.actual_duration > 0:
-            current_service._update_average_duration(token.actual_duration)
+    def _update_service_stats(self):
+        """
+        Ghi nhận thời gian phục vụ thực tế
 
-    def _update_patient_completed_services(self, context):
+        Chỉ chèn mẫu vào mate.queue.duration.sample, cron tổng hợp theo lô vào thống kê
+        và average_duration của dịch vụ (không ghi product.product cho từng lượt hoàn thành).
+        """
+        self.env[MATE_QUEUE_DURATION_SAMPLE].sudo().create([{
+            'service_id': token.service_id.id,
+            'room_id': token.room_id.id,
+            'duration': token.actual_duration,
+            'completed_at': token.end_time,
+        } for token in self if token.actual_duration > 0])
+
+    def _update_patient_completed_services(self):
         """Cập nhật dịch vụ đã hoàn thành cho bệnh nhân"""
-        patient = context['patient']
-        current_service = context['current_service']
+        patients = self.patient_id
+        if not patients or 'completed_service_ids' not in patients._fields:
+            return
+
+        services_by_patient = defaultdict(set)
+        for token in self:
+            if token.patient_id and token.service_id:
+                services_by_patient[token.patient_id].add(token.service_id.id)
 
-        if patient and current_service and 'completed_service_ids' in patient._fields:
+        for patient, service_ids in services_by_patient.items():
             patient.write({
-                'completed_service_ids': [(4, current_service.id)]
+                'completed_service_ids': [(4, service_id) for service_id in service_ids]
             })
 
+    def _merge_completion_results(self, results):
+        """Gộp hướng dẫn bước tiếp theo của nhiều bệnh nhân thành một thông báo"""
+        # Chỉ gộp các action (dict), bỏ qua kết quả khác
+        results = [result for result in results if isinstance(result, dict)]
+        if not results:
+            return {'type': 'ir.actions.act_window_close'}
+        if len(results) == 1:
+            return results[0]
+
+        params = [result.get('params', {}) for result in results]
+        notification_types = {param.get('type') for param in params}
+        return {
+            'type': IR_ACTIONS_CLIENT,
+            'tag': 'display_notification',
+            'params': {
+                'title': _(DONE_SERVICE),
+                'message': '\n'.join(param['message'] for param in params if param.get('message')),
+                'sticky': any(param.get('sticky') for param in params),
+                'type': 'warning' if 'warning' in notification_types else 'info',
+            }
+        }
+
     def _process_token_completion(self, token, context):
         """Xử lý logic tiếp theo sau khi hoàn thành token"""
         # Xử lý dựa trên loại token
@@ -1189,7 +1553,7 @@ class QueueToken(models.Model):
         group_completed = self._check_service_group_completion(current_group, patient)
 
         if group_completed:
-            _logger.info("Nhóm REG_VITAL đã hoàn thành. Tìm nhóm tiếp theo")
+            _logger.debug("Nhóm REG_VITAL đã hoàn thành. Tìm nhóm tiếp theo")
 
             # Đối với bệnh nhân VIP, tạo token song song cho nhóm xét nghiệm
             if patient.is_vip:
@@ -1245,14 +1609,14 @@ class QueueToken(models.Model):
 
             if all_completed:
                 # Đã hoàn thành tất cả token song song, tạo token cho bước tiếp theo
-                _logger.info("Tất cả token song song đã hoàn thành, chuyển sang bước tiếp theo")
+                _logger.debug("Tất cả token song song đã hoàn thành, chuyển sang bước tiếp theo")
                 return self._create_next_service_token(token, patient)
 
             # Có thể còn token đang thực hiện, không làm gì
             return None
 
         # Có token chưa hoàn thành, tìm token tối ưu tiếp theo
-        next_token = self._calculate_optimal_service(other_tokens.ids)
+        next_token = token._calculate_optimal_service(other_tokens.ids)
 
         if next_token:
             # Kích hoạt token tiếp theo
@@ -1287,7 +1651,7 @@ class QueueToken(models.Model):
             _logger.warning("Không tìm thấy nhóm dịch vụ song song với mã PARALLEL_TESTS")
             return None
 
-        _logger.info("Tìm thấy nhóm dịch vụ song song: %s", parallel_group.name)
+        _logger.debug("Tìm thấy nhóm dịch vụ song song: %s", parallel_group.name)
 
         # Tạo các token ở trạng thái draft thay vì waiting
         created_tokens = self._create_tokens_for_service_group(parallel_group, patient, token, state='draft')
@@ -1297,7 +1661,7 @@ class QueueToken(models.Model):
             return None
 
         # Tính toán token tối ưu
-        optimal_token = self._calculate_optimal_service(created_tokens.ids)
+        optimal_token = token._calculate_optimal_service(created_tokens.ids)
 
         if not optimal_token:
             # Nếu không tìm thấy token tối ưu, lấy token đầu tiên
@@ -1339,7 +1703,7 @@ class QueueToken(models.Model):
         next_group = self._get_next_service_group(service_group, patient.queue_package_id)
 
         if not next_group:
-            _logger.info("Không tìm thấy nhóm dịch vụ tiếp theo")
+            _logger.debug("Không tìm thấy nhóm dịch vụ tiếp theo")
             return {
                 'type': IR_ACTIONS_CLIENT,
                 'tag': 'display_notification',
@@ -1352,7 +1716,7 @@ class QueueToken(models.Model):
             }
 
         # Tạo token cho nhóm tiếp theo
-        _logger.info("Tạo token cho nhóm dịch vụ tiếp theo: %s", next_group.name)
+        _logger.debug("Tạo token cho nhóm dịch vụ tiếp theo: %s", next_group.name)
         # Kiểm tra xem nhóm tiếp theo có phải là nhóm song song không
         if len(next_group.service_ids) > 1:
             # Tạo token song song cho nhóm tiếp theo
@@ -1360,7 +1724,7 @@ class QueueToken(models.Model):
 
             if new_tokens:
                 # Tìm token tối ưu để thực hiện đầu tiên
-                optimal_token = self._calculate_optimal_service(new_tokens.ids)
+                optimal_token = completed_token._calculate_optimal_service(new_tokens.ids)
 
                 if optimal_token:
                     # Kích hoạt token đầu tiên
@@ -1408,112 +1772,66 @@ class QueueToken(models.Model):
 
     def _compute_wait_time(self):
         """Tính toán thời gian chờ ước tính dựa trên nhiều yếu tố"""
+        estimates = self._estimate_wait_times()
         for token in self:
-            if token.state != 'waiting':
-                token.estimated_wait_time = 0
-                continue
+            token.estimated_wait_time = estimates[token.id]['wait_time']
 
-            room = token.room_id
-            if not room:
-                token.estimated_wait_time = 0
-                continue
+    def _estimate_wait_times(self):
+        """
+        Ước tính thời gian chờ cho cả recordset với số truy vấn cố định
 
-            # Lấy tất cả token đang chờ của phòng này
-            waiting_tokens = self.search([
-                ('room_id', '=', room.id),
-                ('state', '=', 'waiting'),
-                ('position', '<', token.position)
-            ])
+        Token được gom theo phòng; mỗi phòng được sắp xếp một lần theo thứ tự
+        hàng đợi để lấy số người đứng trước của mọi token trong một lượt.
 
-            # Tính toán thời gian cơ bản
-            avg_duration = token.service_id.average_duration
-            base_wait_time = len(waiting_tokens) * avg_duration / room.capacity
-            token.estimated_wait_time = base_wait_time
+        Trả về:
+            dict: {token_id: {'ahead': số token đứng trước, 'wait_time': phút}}
+        """
+        waiting_tokens = self.filtered(lambda t: t.state == 'waiting' and t.room_id)
+        waiting_ids = self._get_waiting_ids_by_room(waiting_tokens.room_id.ids)
+        durations = self.env[MATE_QUEUE_DURATION_STAT]._get_duration_estimates(
+            (token.service_id, token.room_id) for token in waiting_tokens)
 
-    def _recalculate_queue_positions(self, room_id):
-        """Tính lại vị trí trong hàng đợi cho tất cả token của phòng"""
-        waiting_tokens = self.search([
-            ('room_id', '=', room_id),
-            ('state', '=', 'waiting')
-        ])
+        ahead_by_token = {}
+        for room_token_ids in waiting_ids.values():
+            for ahead, token_id in enumerate(room_token_ids):
+                ahead_by_token[token_id] = ahead
 
-        # Sắp xếp token theo ưu tiên, loại dịch vụ và thời gian tạo
-        # Ưu tiên cao hơn, emergency và health_check có quyền ưu tiên
-        sorted_tokens = waiting_tokens.sorted(
-            key=lambda r: (
-                -r.emergency,
-                -r.priority,
-                r.create_date
-            )
-        )
+        estimates = {}
+        for token in self:
+            if token not in waiting_tokens:
+                estimates[token.id] = {'ahead': 0, 'wait_time': 0.0}
+                continue
+            ahead = ahead_by_token.get(token.id, len(waiting_ids[token.room_id.id]))
+            capacity = token.room_id.capacity or 1
+            estimates[token.id] = {
+                'ahead': ahead,
+                'wait_time': ahead * durations.get((token.service_id.id, token.room_id.id), 0.0) / capacity,
+            }
+        return estimates
 
-        # Cập nhật vị trí
-        for position, token in enumerate(sorted_tokens, 1):
-            token.position = position
+    def _recalculate_queue_positions(self, room_id):
+        """Tính lại vị trí trong hàng đợi cho tất cả token của phòng"""
+        self._renumber_room_queues([room_id])
 
     def _process_single_service_completion(self, token, current_service, patient, package):
         """Xử lý hoàn thành dịch vụ theo cách thông thường (không theo nhóm)"""
-        # Tìm tuyến đường dịch vụ tiếp theo
-        routes = self.env[MATE_QUEUE_SERVICE_ROUTE].search([
-            ('service_from_id', '=', current_service.id)
-        ], order='sequence')
-        _logger.info("Tìm thấy %d tuyến đường cho dịch vụ %s", len(routes), current_service.name)
+        # Tìm tuyến đường dịch vụ tiếp theo (theo gói, tuyến chung, rồi tuyến đầu tiên)
+        route = self.env[MATE_QUEUE_SERVICE_ROUTE]._resolve_route(
+            current_service.id, package.id if package else False)
 
         # Kiểm tra nếu không có tuyến đường
-        if not routes:
+        if not route:
             return self._handle_no_routes(token, current_service, patient)
 
-        # Log thông tin về các tuyến đường
-        self._log_route_info(routes)
-
-        # Tìm dịch vụ tiếp theo
-        next_service = self._find_next_service(routes, package)
-
-        # Tạo token mới nếu có dịch vụ tiếp theo
-        if next_service:
-            return self._create_next_token(token, next_service, patient, current_service)
-
-        # Thông báo khi không có dịch vụ tiếp theo phù hợp
-        return self._create_completion_notification(routes, patient)
-
-    def _log_route_info(self, routes):
-        """Ghi log thông tin về các tuyến đường"""
-        for route in routes:
-            _logger.info("Tuyến đường: %s -> %s, Gói: %s",
-                         route.service_from_id.name,
-                         route.service_to_id.name,
-                         route.package_id and route.package_id.name or "Chung")
-
-    def _find_next_service(self, routes, package):
-        """Tìm dịch vụ tiếp theo dựa trên tuyến đường và gói dịch vụ"""
-        next_service = False
-
-        # Tìm tuyến đường phù hợp với gói
-        if package:
-            package_routes = routes.filtered(lambda r: r.package_id and r.package_id.id == package.id)
-            if package_routes:
-                next_service = package_routes[0].service_to_id
-                _logger.info("Sử dụng tuyến đường theo gói %s: %s -> %s",
-                             package.name, package_routes[0].service_from_id.name, next_service.name)
-                return next_service
-
-        # Tìm tuyến đường chung nếu không có tuyến đường theo gói
-        general_routes = routes.filtered(lambda r: not r.package_id)
-        if general_routes:
-            next_service = general_routes[0].service_to_id
-            _logger.info("Sử dụng tuyến đường chung: %s -> %s",
-                         general_routes[0].service_from_id.name, next_service.name)
-            return next_service
-
-        # Sử dụng tuyến đường đầu tiên nếu không có tuyến nào phù hợp
-        next_service = routes[0].service_to_id
-        _logger.info("Sử dụng tuyến đường đầu tiên: %s -> %s",
-                     routes[0].service_from_id.name, next_service.name)
-        return next_service
+        # Tạo token mới cho dịch vụ tiếp theo
+        next_service = self.env[PRODUCT_PRODUCT].browse(route.to_id)
+        _logger.debug("Sử dụng tuyến đường %s: %s -> %s", route.id, current_service.name, next_service.name)
+        new_token = self._create_next_token(token, next_service, patient, current_service)
+        return self._get_next_token_notification(new_token)
 
     def _create_next_token(self, token, next_service, patient, current_service):
         """Tạo token mới cho dịch vụ tiếp theo"""
-        _logger.info("Tạo token mới cho dịch vụ tiếp theo: %s", next_service.name)
+        _logger.debug("Tạo token mới cho dịch vụ tiếp theo: %s", next_service.name)
         new_token = self.create({
             'patient_id': patient.id,
             'service_id': next_service.id,
@@ -1525,16 +1843,29 @@ class QueueToken(models.Model):
             'health_check_batch_id': token.health_check_batch_id.id if token.health_check_batch_id else False,
             'state': 'waiting',
         })
-        _logger.info("Đã tạo token mới: %s", new_token.name)
+        _logger.debug("Đã tạo token mới: %s", new_token.name)
         return new_token
 
+    def _get_next_token_notification(self, new_token):
+        """Thông báo hướng dẫn bệnh nhân đến phòng của token tiếp theo"""
+        return {
+            'type': IR_ACTIONS_CLIENT,
+            'tag': 'display_notification',
+            'params': {
+                'title': _(NEXT_SERVICE),
+                'message': _(TEXT_INSTRUCT) % (new_token.room_id.name, new_token.service_id.name),
+                'sticky': True,
+                'type': 'info',
+            }
+        }
+
     def _handle_no_routes(self, token, current_service, patient):
         """Xử lý trường hợp không có tuyến đường"""
         token.message_post(
             body=_("no_route_found_from_service") % current_service.name,
             subject=_("warning_missing_service_route")
         )
-        _logger.info("Không có dịch vụ tiếp theo cho token %s", token.name)
+        _logger.debug("Không có dịch vụ tiếp theo cho token %s", token.name)
 
         return {
             'type': IR_ACTIONS_CLIENT,
@@ -1547,30 +1878,6 @@ class QueueToken(models.Model):
             }
         }
 
-    def _create_completion_notification(self, routes, patient):
-        """Tạo thông báo khi hoàn thành dịch vụ"""
-        _logger.info("Không có dịch vụ tiếp theo phù hợp")
-
-        if routes:
-            message = _('no_suitable_next_service_found')
-            sticky = True
-            type_notification = 'warning'
-        else:
-            message = _('completed_last_service_for_patient') % patient.name
-            sticky = False
-            type_notification = 'info'
-
-        return {
-            'type': IR_ACTIONS_CLIENT,
-            'tag': 'display_notification',
-            'params': {
-                'title': _(DONE_SERVICE),
-                'message': message,
-                'sticky': sticky,
-                'type': type_notification,
-            }
-        }
-
     def _get_next_service_in_group(self, service_group, current_service):
         """Lấy dịch vụ tiếp theo trong cùng nhóm dịch vụ"""
         if not service_group or not current_service:
@@ -1595,7 +1902,7 @@ class QueueToken(models.Model):
 
     def _handle_vip_service_completion(self, token, patient, parallel_group):
         """Xử lý đặc biệt cho bệnh nhân VIP sau khi hoàn thành nhóm đăng ký"""
-        _logger.info("Bệnh nhân VIP %s đã hoàn thành nhóm đăng ký, tạo token song song", patient.name)
+        _logger.debug("Bệnh nhân VIP %s đã hoàn thành nhóm đăng ký, tạo token song song", patient.name)
 
         # Cập nhật nhóm dịch vụ hiện tại cho bệnh nhân
         patient.write({
@@ -1610,7 +1917,7 @@ class QueueToken(models.Model):
             return None
 
         # Tính toán token tối ưu
-        optimal_token = self._calculate_optimal_service(created_tokens.ids)
+        optimal_token = token._calculate_optimal_service(created_tokens.ids)
 
         if not optimal_token:
             # Nếu không tìm thấy token tối ưu, lấy token đầu tiên
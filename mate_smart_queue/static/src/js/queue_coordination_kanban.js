@@ -49,13 +49,8 @@ export class QueueCoordinationKanbanRenderer extends KanbanRenderer {
                 return;
             }
 
-            const token = await this._getTokenData(recordId);
-            if (!this._validateTokenState(token)) {
-                return;
-            }
-
-            const newPosition = await this._calculateNewPosition(recordId, token, previous);
-            await this._performReorder(recordId, token, newPosition);
+            const previousId = previous ? this._getPreviousElementId(previous, recordId) : null;
+            await this._performMove(recordId, previousId);
 
         } catch (error) {
             await this._handleError(error);
@@ -99,50 +94,6 @@ export class QueueCoordinationKanbanRenderer extends KanbanRenderer {
         return true;
     }
 
-    /**
-     * Get token data from backend
-     */
-    async _getTokenData(recordId) {
-        const token = await this.orm.read('mate.queue.token', [recordId], ['position', 'state', 'room_id']);
-        console.log("Token data:", token);
-
-        if (!token || token.length === 0) {
-            throw new Error('Token không tồn tại');
-        }
-
-        return token[0];
-    }
-
-    /**
-     * Validate token state
-     */
-    _validateTokenState(token) {
-        if (token.state !== 'waiting') {
-            console.log('Token state:', token.state);
-            throw new Error('Chỉ có thể di chuyển token đang chờ');
-        }
-        return true;
-    }
-
-    /**
-     * Calculate new position based on drop location
-     */
-    async _calculateNewPosition(recordId, token, previous) {
-        const oldPosition = token.position;
-
-        if (!previous) {
-            return 1; // Dropped at the beginning
-        }
-
-        const prevId = this._getPreviousElementId(previous, recordId);
-        if (!prevId) {
-            return oldPosition; // Same position
-        }
-
-        const prevPosition = await this._getPreviousTokenPosition(prevId);
-        return this._determineNewPosition(oldPosition, prevPosition);
-    }
-
     /**
      * Get previous element ID
      */
@@ -155,48 +106,58 @@ export class QueueCoordinationKanbanRenderer extends KanbanRenderer {
     }
 
     /**
-     * Get previous token position
+     * Move the token right after the previous card in a single call.
+     * The backend validates the token state and returns the refreshed room slice,
+     * which is applied to the cards in place instead of reloading the whole kanban.
      */
-    async _getPreviousTokenPosition(prevId) {
-        const prevTokenData = await this.orm.read('mate.queue.token', [prevId], ['position']);
-        return prevTokenData && prevTokenData.length > 0 ? prevTokenData[0].position : null;
-    }
+    async _performMove(recordId, previousId) {
+        console.log(`Moving token ${recordId} after token ${previousId}`);
 
-    /**
-     * Determine new position based on movement direction
-     */
-    _determineNewPosition(oldPosition, prevPosition) {
-        if (!prevPosition) return oldPosition;
+        const roomSlice = await this.orm.call(
+            'mate.queue.token',
+            'move_token',
+            [recordId, previousId || false]
+        );
+
+        if (!this._applyRoomSlice(recordId, roomSlice || [])) {
+            await this._reloadView();
+        }
 
-        return oldPosition < prevPosition ? prevPosition : prevPosition + 1;
+        const moved = (roomSlice || []).find(token => token.id === recordId);
+        if (moved) {
+            this.notification.add(
+                `Token ${moved.name} đã được di chuyển đến vị trí ${moved.position}`,
+                { type: 'success' }
+            );
+        }
     }
 
     /**
-     * Perform the reorder operation
+     * Sắp xếp lại thẻ của phòng và cập nhật vị trí theo slice trả về từ move_token
+     * Trả về false nếu slice không khớp với các thẻ đang hiển thị (cần tải lại)
      */
-    async _performReorder(recordId, token, newPosition) {
-        const oldPosition = token.position;
-
-        console.log(`Moving token ${recordId} from position ${oldPosition} to ${newPosition}`);
-
-        if (oldPosition === newPosition) {
-            console.log('Position unchanged, skipping');
-            return;
+    _applyRoomSlice(recordId, roomSlice) {
+        const groups = this.props.list.groups || [];
+        const group = groups.find(g => g.list.records.some(record => record.resId === recordId));
+        if (!group) {
+            return false;
+        }
+        const positions = new Map(roomSlice.map(token => [token.id, token.position]));
+        const records = group.list.records;
+        if (records.some(record => !positions.has(record.resId))) {
+            return false;
         }
 
-        const result = await this.orm.call(
-            'mate.queue.token',
-            'reorder_position',
-            [recordId, newPosition, oldPosition]
-        );
-
-        if (result) {
-            this.notification.add(
-                `Token đã được di chuyển từ vị trí ${oldPosition} đến vị trí ${newPosition}`,
-                { type: 'success' }
-            );
-            await this._reloadView();
+        records.sort((a, b) => positions.get(a.resId) - positions.get(b.resId));
+        for (const record of records) {
+            const position = positions.get(record.resId);
+            for (const fieldName of ['position', 'queue_rank']) {
+                if (fieldName in record.data) {
+                    record.data[fieldName] = position;
+                }
+            }
         }
+        return true;
     }
 
     /**
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import TransactionCase, tagged
+
+
+@tagged('post_install', '-at_install')
+class TestQueueTokenCompletion(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        product_model = cls.env['product.product']
+        cls.service_blood = product_model.create({'name': 'Blood Test', 'code': 'BLOOD'})
+        cls.service_xray = product_model.create({'name': 'X-Ray', 'code': 'XRAY'})
+        cls.env['mate.queue.service.route'].create({
+            'service_from_id': cls.service_blood.id,
+            'service_to_id': cls.service_xray.id,
+        })
+
+        room_model = cls.env['hr.department']
+        cls.room_blood = room_model.create({
+            'name': 'Blood Room', 'code': 'TEST_BLOOD', 'service_id': cls.service_blood.id, 'capacity': 2,
+        })
+        cls.room_xray = room_model.create({
+            'name': 'X-Ray Room', 'code': 'TEST_XRAY', 'service_id': cls.service_xray.id, 'capacity': 1,
+        })
+
+        cls.patients = cls.env['his.patient'].create([{
+            'name': f'Patient {index}',
+            'patient_id_number': f'TEST-PID-{index}',
+            'gender': 'male',
+        } for index in range(2)])
+
+    def _create_in_progress_tokens(self):
+        tokens = self.env['mate.queue.token'].create([{
+            'patient_id': patient.id,
+            'service_id': self.service_blood.id,
+            'room_id': self.room_blood.id,
+            'state': 'waiting',
+        } for patient in self.patients])
+        tokens.action_start_service()
+        return tokens
+
+    def test_complete_single_token_returns_notification(self):
+        token = self._create_in_progress_tokens()[:1]
+
+        result = token.action_complete_service()
+
+        self.assertIsInstance(result, dict)
+        self.assertEqual(result['tag'], 'display_notification')
+        next_token = self.env['mate.queue.token'].search([('origin_token_id', '=', token.id)])
+        self.assertEqual(next_token.service_id, self.service_xray)
+        self.assertEqual(next_token.state, 'waiting')
+
+    def test_complete_two_tokens_in_one_call(self):
+        tokens = self._create_in_progress_tokens()
+
+        result = tokens.action_complete_service()
+
+        self.assertIsInstance(result, dict)
+        self.assertEqual(result['tag'], 'display_notification')
+        self.assertTrue(result['params']['message'])
+        self.assertEqual(set(tokens.mapped('state')), {'completed'})
+        next_tokens = self.env['mate.queue.token'].search([('origin_token_id', 'in', tokens.ids)])
+        self.assertEqual(len(next_tokens), 2)
+        self.assertEqual(next_tokens.patient_id, self.patients)
+        self.assertEqual(set(next_tokens.mapped('service_id').ids), {self.service_xray.id})
+        self.assertEqual(set(next_tokens.mapped('state')), {'waiting'})